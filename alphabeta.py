@@ -0,0 +1,527 @@
+"""
+Iterative deepening alpha-beta search over shogi.Board, used by the AlphaBeta homemade engine in strategies.py.
+"""
+
+import time
+import logging
+from array import array
+
+import shogi
+
+logger = logging.getLogger(__name__)
+
+INFINITE = 32000
+MATE = 31000
+MATE_BOUND = MATE - 1000
+MAX_PLY = 64
+
+EXACT, LOWER, UPPER = 0, 1, 2
+
+PIECE_VALUES = [0, 90, 315, 405, 495, 540, 855, 990, 0, 540, 540, 540, 540, 945, 1395]
+HAND_VALUES = [0, 100, 350, 450, 550, 600, 950, 1100]
+UNPROMOTED = [piece_type if piece_type <= shogi.KING else shogi.PIECE_PROMOTED.index(piece_type) for piece_type in range(15)]
+PROMOTION_GAIN = [PIECE_VALUES[promoted] - PIECE_VALUES[piece_type] if promoted else 0 for piece_type, promoted in enumerate(shogi.PIECE_PROMOTED)]
+
+# Move ordering, from the first tried to the last
+TT_MOVE_ORDER = 1 << 30
+CAPTURE_ORDER = 1 << 28
+PROMOTION_ORDER = 1 << 27
+KILLER_ORDER = 1 << 26
+NO_PROMOTION_ORDER = -(1 << 26)
+
+# Pieces that lose nothing by promoting
+ALWAYS_PROMOTED = (shogi.PAWN, shogi.BISHOP, shogi.ROOK)
+
+
+def piece_square_bonus(piece_type, square):
+    # From black's side, rank 0 is the far end of the board
+    rank = shogi.rank_index(square)
+    advance = 8 - rank
+    if piece_type == shogi.KING:
+        return (30, 20, 0, -20, -40, -60, -80, -100, -120)[advance]
+    if piece_type in (shogi.PAWN, shogi.LANCE, shogi.KNIGHT):
+        return 4 * advance
+    if piece_type == shogi.SILVER:
+        return 6 * min(advance, 5)
+    if piece_type == shogi.GOLD:
+        return 10 if advance in (1, 2) else 0
+    if piece_type >= shogi.PROM_PAWN:
+        return 8 * min(advance, 6)
+    return 0
+
+
+# SQUARE_VALUES[color][piece_type][square]: material and position of a piece for its owner
+SQUARE_VALUES = [[[PIECE_VALUES[piece_type] + piece_square_bonus(piece_type, square if color == shogi.BLACK else 80 - square)
+                   for square in shogi.SQUARES] for piece_type in range(15)] for color in shogi.COLORS]
+
+
+def on_line(first, second):
+    first_rank, first_file = divmod(first, 9)
+    second_rank, second_file = divmod(second, 9)
+    return first_rank == second_rank or first_file == second_file or abs(first_rank - second_rank) == abs(first_file - second_file)
+
+
+# A piece can only leave its king in check by moving away from a line through the king
+ON_LINE = [[on_line(king, square) for square in shogi.SQUARES] for king in shogi.SQUARES]
+
+
+def evaluate(board):
+    """Material and piece squares, from black's side."""
+    balance = 0
+    for square in shogi.SQUARES:
+        piece_type = board.pieces[square]
+        if piece_type:
+            color = shogi.WHITE if board.occupied[shogi.WHITE] & shogi.BB_SQUARES[square] else shogi.BLACK
+            value = SQUARE_VALUES[color][piece_type][square]
+            balance += value if color == shogi.BLACK else -value
+    for color in shogi.COLORS:
+        for piece_type, count in board.pieces_in_hand[color].items():
+            value = HAND_VALUES[piece_type] * count
+            balance += value if color == shogi.BLACK else -value
+    return balance
+
+
+def move_code(move):
+    from_square = move.from_square
+    return (0 if from_square is None else from_square + 1) | move.to_square << 7 | move.promotion << 14 | (move.drop_piece_type or 0) << 15
+
+
+def code_move(code):
+    from_square = (code & 127) - 1
+    return shogi.Move(None if from_square < 0 else from_square, code >> 7 & 127, bool(code >> 14 & 1), code >> 15 or None)
+
+
+def history_index(move):
+    from_square = move.from_square
+    return (81 + move.drop_piece_type if from_square is None else from_square) * 81 + move.to_square
+
+
+class SearchBoard(shogi.Board):
+    """
+    A shogi.Board that updates its evaluation with every move. Unlike shogi.Board it
+    doesn't hash the whole position to count repetitions, the search tracks them itself.
+    """
+    def __init__(self, sfen):
+        super().__init__(sfen)
+        self.balance = evaluate(self)
+        self.balances = []
+
+    def push(self, move):
+        turn = self.turn
+        self.balances.append(self.balance)
+        self.move_number += 1
+        self.move_stack.append(move)
+
+        if not move:
+            self.captured_piece_stack.append(shogi.NONE)
+            self.turn ^= 1
+            return
+
+        to_square = move.to_square
+        captured_piece_type = self.pieces[to_square]
+        self.captured_piece_stack.append(captured_piece_type)
+        values = SQUARE_VALUES[turn]
+        if move.drop_piece_type:
+            piece_type = move.drop_piece_type
+            from_hand = True
+            gain = values[piece_type][to_square] - HAND_VALUES[piece_type]
+        else:
+            from_square = move.from_square
+            piece_type = self.pieces[from_square]
+            from_hand = False
+            gain = -values[piece_type][from_square]
+            if move.promotion:
+                piece_type = shogi.PIECE_PROMOTED[piece_type]
+            gain += values[piece_type][to_square]
+            self.remove_piece_at(from_square, False)
+        if captured_piece_type:
+            gain += SQUARE_VALUES[turn ^ 1][captured_piece_type][to_square] + HAND_VALUES[UNPROMOTED[captured_piece_type]]
+
+        self.set_piece_at(to_square, shogi.Piece(piece_type, turn), from_hand, True)
+        self.turn ^= 1
+        self.balance += gain if turn == shogi.BLACK else -gain
+
+    def pop(self):
+        self.balance = self.balances.pop()
+        move = self.move_stack.pop()
+        self.move_number -= 1
+        captured_piece_type = self.captured_piece_stack.pop()
+        captured_piece_color = self.turn
+
+        if not move:
+            self.turn ^= 1
+            return move
+
+        piece_type = self.pieces[move.to_square]
+        if move.promotion:
+            piece_type = UNPROMOTED[piece_type]
+        if move.from_square is None:
+            self.add_piece_into_hand(piece_type, self.turn ^ 1)
+        else:
+            self.set_piece_at(move.from_square, shogi.Piece(piece_type, self.turn ^ 1))
+
+        if captured_piece_type:
+            self.remove_piece_from_hand(captured_piece_type, captured_piece_color ^ 1)
+            self.set_piece_at(move.to_square, shogi.Piece(captured_piece_type, captured_piece_color))
+        else:
+            self.remove_piece_at(move.to_square)
+
+        self.turn ^= 1
+        return move
+
+
+class TranspositionTable:
+    """
+    Search results by Zobrist hash, kept in arrays allocated once so the table never
+    grows. A result replaces the one in its slot unless that one is a deeper search
+    of the same position.
+    """
+    ENTRY_SIZE = 16
+
+    def __init__(self, megabytes=16):
+        size = 1
+        while size * 2 * self.ENTRY_SIZE <= megabytes * 1024 * 1024:
+            size *= 2
+        self.mask = size - 1
+        self.keys = array("Q", [0]) * size
+        self.moves = array("I", [0]) * size
+        self.scores = array("h", [0]) * size
+        self.depths = array("b", [0]) * size
+        self.flags = array("B", [0]) * size
+
+    def __len__(self):
+        return self.mask + 1
+
+    def probe(self, key):
+        index = key & self.mask
+        if self.keys[index] != key:
+            return None
+        return self.moves[index], self.scores[index], self.depths[index], self.flags[index]
+
+    def store(self, key, code, score, depth, flag):
+        index = key & self.mask
+        if self.keys[index] == key and self.depths[index] > depth and flag != EXACT:
+            return
+        self.keys[index] = key
+        self.moves[index] = code
+        self.scores[index] = score
+        self.depths[index] = max(-128, min(127, depth))
+        self.flags[index] = flag
+
+    def clear(self):
+        size = len(self)
+        self.keys = array("Q", [0]) * size
+        self.moves = array("I", [0]) * size
+
+
+class SearchStopped(Exception):
+    pass
+
+
+class Searcher:
+    """
+    Iterative deepening principal variation search with a transposition table,
+    null move pruning, late move reductions and a capture-only quiescence search.
+    Moves are tried in the order: transposition table move, captures by most valuable
+    victim and least valuable attacker, promotions, killer moves, then the other
+    moves and drops by history.
+    """
+    def __init__(self, hash_megabytes=16):
+        self.tt = TranspositionTable(hash_megabytes)
+        self.history = [0] * (89 * 81)
+        self.killers = [[0, 0] for _ in range(MAX_PLY + 1)]
+        self.board = None
+        self.game_keys = set()
+        self.path = []
+        self.nodes = 0
+        self.max_nodes = None
+        self.deadline = None
+        self.should_stop = lambda: False
+        self.root_best = None
+        self.root_score = None
+
+    def new_game(self):
+        self.tt.clear()
+        self.history = [0] * (89 * 81)
+
+    def iterate(self, board, max_depth=MAX_PLY):
+        """
+        Searches `board` one depth deeper at a time and yields (depth, score, pv) after each
+        depth, with `pv` a list of shogi.Move. Stops early when `should_stop` returns true,
+        `deadline` (time.monotonic()) passes or `max_nodes` nodes are searched.
+        """
+        self.board = SearchBoard(board.sfen())
+        self.game_keys = {key for key, count in board.transpositions.items() if count > 0}
+        self.path = []
+        self.nodes = 0
+        self.killers = [[0, 0] for _ in range(MAX_PLY + 1)]
+        self.history = [value // 8 for value in self.history]
+        root_moves = list(self.board.legal_moves)
+        if not root_moves:
+            return
+        best_move = root_moves[0]
+        for depth in range(1, min(max_depth, MAX_PLY - 1) + 1):
+            root_moves.remove(best_move)
+            root_moves.insert(0, best_move)
+            try:
+                score = self.search_root(root_moves, depth)
+            except SearchStopped:
+                while self.board.move_stack:
+                    self.board.pop()
+                self.path.clear()
+                # A move that beat the previous best before the search stopped is better than it
+                if self.root_best is not None and self.root_best is not best_move:
+                    yield depth, self.root_score, self.tt_pv(self.root_best, depth)
+                return
+            best_move = self.root_best
+            yield depth, score, self.tt_pv(best_move, depth)
+            if abs(score) > MATE_BOUND or len(root_moves) == 1:
+                return
+
+    def search_root(self, root_moves, depth):
+        board = self.board
+        alpha, beta = -INFINITE, INFINITE
+        key = board.zobrist_hash()
+        self.root_best = None
+        self.root_score = None
+        self.path.append(key)
+        for index, move in enumerate(root_moves):
+            board.push(move)
+            if index == 0:
+                score = -self.search(depth - 1, -beta, -alpha, 1)
+            else:
+                score = -self.search(depth - 1, -alpha - 1, -alpha, 1)
+                if score > alpha:
+                    score = -self.search(depth - 1, -beta, -alpha, 1)
+            board.pop()
+            if score > alpha:
+                alpha = score
+                self.root_best = move
+                self.root_score = score
+        self.path.pop()
+        self.tt.store(key, move_code(self.root_best), alpha, depth, EXACT)
+        return alpha
+
+    def tt_pv(self, first_move, depth):
+        board = self.board
+        pv = [first_move]
+        board.push(first_move)
+        seen = {board.zobrist_hash()}
+        while len(pv) < depth:
+            entry = self.tt.probe(board.zobrist_hash())
+            if entry is None or not entry[0]:
+                break
+            move = code_move(entry[0])
+            if not board.is_pseudo_legal(move):
+                break
+            board.push(move)
+            key = board.zobrist_hash()
+            if board.was_suicide() or key in seen:
+                board.pop()
+                break
+            seen.add(key)
+            pv.append(move)
+        for _ in pv:
+            board.pop()
+        return pv
+
+    def check_limits(self):
+        if self.should_stop() or (self.deadline is not None and time.monotonic() >= self.deadline) \
+                or (self.max_nodes is not None and self.nodes >= self.max_nodes):
+            raise SearchStopped()
+
+    def evaluate(self):
+        board = self.board
+        return board.balance if board.turn == shogi.BLACK else -board.balance
+
+    def search(self, depth, alpha, beta, ply, can_null=True):
+        self.nodes += 1
+        if self.nodes & 1023 == 0:
+            self.check_limits()
+        board = self.board
+        key = board.zobrist_hash()
+        if key in self.game_keys or key in self.path:
+            return 0
+
+        tt_code = 0
+        entry = self.tt.probe(key)
+        if entry is not None:
+            tt_code, tt_score, tt_depth, flag = entry
+            if tt_depth >= depth:
+                score = score_from_tt(tt_score, ply)
+                if flag == EXACT or (flag == LOWER and score >= beta) or (flag == UPPER and score <= alpha):
+                    return score
+
+        in_check = board.is_check()
+        if in_check:
+            depth += 1
+        if depth <= 0 or ply >= MAX_PLY:
+            return self.quiesce(alpha, beta, ply)
+
+        self.path.append(key)
+        if can_null and not in_check and depth >= 3 and self.evaluate() >= beta and abs(beta) < MATE_BOUND:
+            board.push(shogi.Move.null())
+            score = -self.search(depth - 3, -beta, -beta + 1, ply + 1, False)
+            board.pop()
+            if score >= beta:
+                self.path.pop()
+                return beta
+
+        king_square = board.king_squares[board.turn]
+        on_king_line = ON_LINE[king_square] if king_square is not None else ON_LINE[0]
+        best_score = -INFINITE
+        best_code = 0
+        flag = UPPER
+        legal = 0
+        for order, code, move in self.ordered_moves(ply, tt_code):
+            from_square = move.from_square
+            board.push(move)
+            # Only king moves, moves from a line through the king and check evasions can be illegal
+            if (in_check or from_square == king_square or (from_square is not None and on_king_line[from_square])) and board.was_suicide():
+                board.pop()
+                continue
+            legal += 1
+            quiet = order < KILLER_ORDER
+            if legal == 1:
+                score = -self.search(depth - 1, -beta, -alpha, ply + 1)
+            else:
+                reduction = 1 if depth >= 3 and legal > 4 and quiet and not in_check else 0
+                score = -self.search(depth - 1 - reduction, -alpha - 1, -alpha, ply + 1)
+                if score > alpha and (reduction or score < beta):
+                    score = -self.search(depth - 1, -beta, -alpha, ply + 1)
+            board.pop()
+
+            if score > best_score:
+                best_score = score
+                best_code = code
+                if score > alpha:
+                    alpha = score
+                    flag = EXACT
+                    if score >= beta:
+                        flag = LOWER
+                        if quiet:
+                            killers = self.killers[ply]
+                            if killers[0] != code:
+                                killers[1] = killers[0]
+                                killers[0] = code
+                            self.history[history_index(move)] += depth * depth
+                        break
+        self.path.pop()
+
+        if not legal:
+            last_move = board.move_stack[-1] if board.move_stack else None
+            # Mating with a pawn drop is illegal, so the side that dropped it loses
+            if last_move and last_move.drop_piece_type == shogi.PAWN:
+                return MATE - ply
+            return -MATE + ply
+
+        self.tt.store(key, best_code, score_to_tt(best_score, ply), depth, flag)
+        return best_score
+
+    def ordered_moves(self, ply, tt_code):
+        pieces = self.board.pieces
+        turn = self.board.turn
+        killers = self.killers[ply]
+        history = self.history
+        scored = []
+        for move in self.board.generate_pseudo_legal_moves():
+            code = move_code(move)
+            victim = pieces[move.to_square]
+            if code == tt_code:
+                order = TT_MOVE_ORDER
+            elif victim:
+                order = CAPTURE_ORDER + 16 * PIECE_VALUES[victim] - PIECE_VALUES[pieces[move.from_square]]
+            elif move.promotion:
+                order = PROMOTION_ORDER + PROMOTION_GAIN[pieces[move.from_square]]
+            elif code == killers[0] or code == killers[1]:
+                order = KILLER_ORDER + (code == killers[0])
+            elif move.drop_piece_type:
+                # Between drops with the same history, the cheapest piece is tried first
+                order = history[history_index(move)] * 16 - HAND_VALUES[move.drop_piece_type] // 64
+            else:
+                order = history[history_index(move)] * 16
+                piece_type = pieces[move.from_square]
+                if piece_type in ALWAYS_PROMOTED and (shogi.can_promote(move.from_square, piece_type, turn) or shogi.can_promote(move.to_square, piece_type, turn)):
+                    order += NO_PROMOTION_ORDER
+            scored.append((order, code, move))
+        scored.sort(reverse=True)
+        return scored
+
+    def quiesce(self, alpha, beta, ply):
+        self.nodes += 1
+        if self.nodes & 1023 == 0:
+            self.check_limits()
+        stand_pat = self.evaluate()
+        if stand_pat >= beta:
+            return stand_pat
+        if stand_pat > alpha:
+            alpha = stand_pat
+
+        captures = self.captures()
+        if captures is None:
+            # The king can be captured, so the last move was illegal
+            return MATE - ply
+        board = self.board
+        for order, victim, move in captures:
+            if stand_pat + PIECE_VALUES[victim] + 200 < alpha:
+                continue
+            board.push(move)
+            score = -self.quiesce(-beta, -alpha, ply + 1)
+            board.pop()
+            if score > alpha:
+                alpha = score
+                if score >= beta:
+                    break
+        return alpha
+
+    def captures(self):
+        """Captures by the side to move, promoting whenever possible. None if the other king can be captured."""
+        board = self.board
+        turn = board.turn
+        occupied = board.occupied
+        targets = occupied[turn ^ 1]
+        pieces = board.pieces
+        attacks_from = shogi.Board.attacks_from
+        captures = []
+        for piece_type in shogi.PIECE_TYPES:
+            movers = board.piece_bb[piece_type] & occupied[turn]
+            while movers:
+                bit = movers & -movers
+                movers ^= bit
+                from_square = bit.bit_length() - 1
+                attacks = attacks_from(piece_type, from_square, occupied, turn) & targets
+                while attacks:
+                    bit = attacks & -attacks
+                    attacks ^= bit
+                    to_square = bit.bit_length() - 1
+                    victim = pieces[to_square]
+                    if victim == shogi.KING:
+                        return None
+                    promotion = shogi.can_promote(from_square, piece_type, turn) or shogi.can_promote(to_square, piece_type, turn)
+                    captures.append((16 * PIECE_VALUES[victim] - PIECE_VALUES[piece_type], victim, shogi.Move(from_square, to_square, promotion)))
+        captures.sort(key=lambda capture: capture[0], reverse=True)
+        return captures
+
+
+def score_to_tt(score, ply):
+    if score > MATE_BOUND:
+        return score + ply
+    if score < -MATE_BOUND:
+        return score - ply
+    return score
+
+
+def score_from_tt(score, ply):
+    if score > MATE_BOUND:
+        return score - ply
+    if score < -MATE_BOUND:
+        return score + ply
+    return score
+
+
+def usi_score(score):
+    if score > MATE_BOUND:
+        return {"mate": (MATE - score + 1) // 2}
+    if score < -MATE_BOUND:
+        return {"mate": -((MATE + score + 1) // 2)}
+    return {"cp": score}
@@ -0,0 +1,209 @@
+"""
+Offline analysis of positions with the configured engine, for `lishogi-bot.py analyze`.
+"""
+
+import os
+import json
+import time
+import queue
+import logging
+import collections
+import concurrent.futures
+import shogi
+import shogi.KIF
+import engine_wrapper
+from search_cache import board_key
+
+logger = logging.getLogger(__name__)
+
+KIF_EXTENSIONS = (".kif", ".kifu")
+
+
+def parse_position(line):
+    """
+    Reads a line like "startpos moves 7g7f 3c3d", an SFEN optionally followed by "moves ...",
+    or either one after "position" or "position sfen" as in USI. Returns the SFEN ("startpos"
+    for the starting position) and the moves, or None for an empty line or a comment.
+    """
+    tokens = line.split()
+    if not tokens or tokens[0].startswith("#"):
+        return None
+    if tokens[0] == "position":
+        tokens = tokens[1:]
+    if tokens and tokens[0] == "sfen":
+        tokens = tokens[1:]
+    moves_index = tokens.index("moves") if "moves" in tokens else len(tokens)
+    sfen = " ".join(tokens[:moves_index])
+    if not sfen:
+        raise ValueError(f"No position in {line.strip()!r}")
+    return sfen, tokens[moves_index + 1:]
+
+
+def input_paths(paths):
+    for path in paths:
+        if os.path.isdir(path):
+            for directory, subdirectories, files in os.walk(path):
+                subdirectories.sort()
+                for name in sorted(files):
+                    yield os.path.join(directory, name)
+        else:
+            yield path
+
+
+def read_positions(paths):
+    """
+    Yields (id, sfen, moves, key) for each position of the input files, always in the same
+    order so that an interrupted analysis can be resumed by skipping the analysed ones. The
+    key is that of the search cache, None for a position that can't be read.
+    """
+    for path in input_paths(paths):
+        if path.lower().endswith(KIF_EXTENSIONS):
+            yield from kif_positions(path)
+            continue
+        with open(path, encoding="utf-8") as file:
+            for number, line in enumerate(file, 1):
+                try:
+                    position = parse_position(line)
+                    if position is None:
+                        continue
+                    sfen, moves = position
+                    board = shogi.Board() if sfen == "startpos" else shogi.Board(sfen)
+                    for move in moves:
+                        board.push_usi(move)
+                    key = board_key(board)
+                except ValueError as error:
+                    logger.warning(f"{path}:{number}: {error}")
+                    sfen, moves, key = line.strip(), [], None
+                yield f"{path}:{number}", sfen, moves, key
+
+
+def kif_positions(path):
+    """The position before each move of a KIF game and the final position, identified by the ply."""
+    games = shogi.KIF.Parser.parse_file(path)
+    if not games:
+        logger.warning(f"{path}: Unable to read KIF")
+        return
+    game = games[0]
+    sfen, moves = game["sfen"], game["moves"]
+    board = shogi.Board(sfen)
+    for ply in range(len(moves) + 1):
+        yield f"{path}:{ply}", sfen, moves[:ply], board_key(board)
+        if ply < len(moves):
+            try:
+                board.push_usi(moves[ply])
+            except ValueError as error:
+                logger.warning(f"{path}:{ply + 1}: {error}")
+                return
+
+
+def read_output(path):
+    """
+    Counts the complete lines of an earlier output and returns their number and the id of
+    the last one. A last line cut short by an interruption is dropped.
+    """
+    if not os.path.exists(path):
+        return 0, None
+    lines = 0
+    end = 0
+    last = None
+    with open(path, "rb") as file:
+        for line in file:
+            if line.endswith(b"\n"):
+                lines += 1
+                end += len(line)
+                last = line
+    if end < os.path.getsize(path):
+        with open(path, "rb+") as file:
+            file.truncate(end)
+    try:
+        last_id = json.loads(last)["id"] if last else None
+    except (ValueError, KeyError, TypeError):
+        last_id = None
+    return lines, last_id
+
+
+def analyse_position(engines, limits, record):
+    position_id, sfen, moves, key = record
+    result = {"id": position_id, "sfen": sfen, "moves": " ".join(moves), "key": key}
+    if key is None:
+        # Still written, so that the output stays in step with the input
+        result["error"] = "invalid position"
+        return result
+    engine = engines.get()
+    try:
+        best_move, ponder_move = engine.search(sfen, moves, **limits)
+        info = engine.get_info()
+    finally:
+        engines.put(engine)
+    result.update(best_move=best_move, ponder_move=ponder_move, score=info.get("score"), depth=info.get("depth"),
+                  nodes=info.get("nodes"), pv=info.get("pv"))
+    return result
+
+
+def analyse(config, paths, output, limits, engine_count=1, window=None):
+    """
+    Searches every position of `paths` with `limits` (depth, nodes and/or movetime) on
+    `engine_count` engines at once and appends one JSON line per position to `output`, in
+    input order. Only `window` positions are in flight at a time, so memory use doesn't
+    grow with the input, and positions already in `output` are skipped.
+    """
+    engine_cfg = config["engine"]
+    racers = (engine_cfg.get("race") or {}).get("engines") or []
+    protocols = {engine_cfg.get("protocol")} | {racer.get("protocol", engine_cfg.get("protocol")) for racer in racers}
+    if not protocols <= {"usi", "remote"}:
+        raise Exception('analyze needs a USI engine (protocol "usi" or "remote"). Homemade engines can\'t search to a given depth or number of nodes.')
+
+    window = window or 4 * engine_count
+    done, last_id = read_output(output)
+    records = read_positions(paths)
+    record = None
+    for _ in range(done):
+        record = next(records, None)
+        if record is None:
+            break
+    if done and (record is None or record[0] != last_id):
+        raise Exception(f"{output} doesn't continue these inputs: its last position is {last_id} where the inputs have "
+                        f"{record[0] if record else 'fewer positions'}. Use another output file.")
+    if done:
+        logger.info(f"Resuming after the {done} positions in {output}")
+    # Each search would log its stats
+    logging.getLogger(engine_wrapper.__name__).setLevel(logging.WARNING)
+    engines = queue.Queue()
+    started_engines = []
+    for _ in range(engine_count):
+        engine = engine_wrapper.create_engine(config)
+        engine.set_variant_options("standard")
+        started_engines.append(engine)
+        engines.put(engine)
+
+    analysed = 0
+    started = time.monotonic()
+    pending = collections.deque()
+    try:
+        with open(output, "a", encoding="utf-8") as file, concurrent.futures.ThreadPoolExecutor(engine_count) as executor:
+            def write_oldest():
+                nonlocal analysed
+                file.write(json.dumps(pending.popleft().result()) + "\n")
+                analysed += 1
+                if analysed % 1000 == 0:
+                    file.flush()
+                    logger.info(f"Analysed {done + analysed} positions ({analysed / (time.monotonic() - started):.1f} per second)")
+
+            try:
+                for record in records:
+                    if len(pending) >= window:
+                        write_oldest()
+                    pending.append(executor.submit(analyse_position, engines, limits, record))
+                while pending:
+                    write_oldest()
+            except BaseException:
+                for future in pending:
+                    future.cancel()
+                for engine in started_engines:
+                    engine.stop()
+                raise
+    finally:
+        for engine in started_engines:
+            engine.quit()
+            engine.kill_process()
+    logger.info(f"Analysed {analysed} positions, {done + analysed} in {output}")
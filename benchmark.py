@@ -0,0 +1,363 @@
+"""
+Benchmarks for Lishogi-Bot. They don't need a lishogi.org account or an engine.
+
+python3 benchmark.py startup    Time from launching lishogi-bot.py until it is ready to accept challenges.
+python3 benchmark.py dispatch   Time to hand a game to a game process.
+python3 benchmark.py updates    Time to handle the gameState updates of a game and memory per game.
+python3 benchmark.py ndjson     Time to decode game and event stream lines.
+python3 benchmark.py nps        Nodes per second of the AlphaBeta homemade engine.
+python3 benchmark.py perft      Move generation of position.Position against shogi.Board.
+python3 benchmark.py tsume      Time to solve mate problems with the tsume solver.
+"""
+
+import argparse
+import importlib
+import json
+import multiprocessing
+import multiprocessing.pool
+import os
+import random
+import signal
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import yaml
+
+
+class FakeLishogiHandler(BaseHTTPRequestHandler):
+    """Answers the requests lishogi-bot.py makes at startup."""
+    responses = {
+        "/api/account": {"username": "benchmark", "title": "BOT"},
+        "/api/account/playing": {"nowPlaying": []}
+    }
+
+    def do_GET(self):
+        if self.path == "/api/stream/event":
+            self.send_response(200)
+            self.end_headers()
+            try:
+                while True:
+                    self.wfile.write(b"\n")
+                    self.wfile.flush()
+                    time.sleep(1)
+            except OSError:
+                return
+        body = json.dumps(self.responses.get(self.path, {})).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_fake_lishogi():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FakeLishogiHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}/"
+
+
+def write_config(directory, url):
+    with open("config.yml.default") as stream:
+        config = yaml.safe_load(stream)
+    config["token"] = "benchmark"
+    config["url"] = url
+    config["engine"].update({"dir": directory, "name": "RandomMove", "protocol": "homemade"})
+    config["checkpoint_dir"] = ""
+    path = os.path.join(directory, "config.yml")
+    with open(path, "w") as stream:
+        yaml.safe_dump(config, stream)
+    return path
+
+
+def launch_until_ready(config_path):
+    started = time.perf_counter()
+    process = subprocess.Popen([sys.executable, "lishogi-bot.py", "--config", config_path, "--profile-startup"],
+                               stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, start_new_session=True,
+                               env=dict(os.environ, COLUMNS="200"))
+    output = []
+    try:
+        for line in process.stdout:
+            output.append(line)
+            if "Startup profile" in line:
+                return time.perf_counter() - started
+        raise RuntimeError("lishogi-bot.py exited before it was ready:\n" + "".join(output))
+    finally:
+        os.killpg(process.pid, signal.SIGKILL)
+        process.wait()
+
+
+def benchmark_startup(args):
+    server, url = start_fake_lishogi()
+    with tempfile.TemporaryDirectory() as directory:
+        config_path = write_config(directory, url)
+        times = [launch_until_ready(config_path) for _ in range(args.runs)]
+    server.shutdown()
+    print(f"Launch until ready over {args.runs} runs: "
+          f"min {min(times) * 1000:.0f} ms, median {statistics.median(times) * 1000:.0f} ms, max {max(times) * 1000:.0f} ms")
+
+
+def play_game_with_arguments(li, game_id, *args):
+    return game_id
+
+
+def play_game_by_id(game_id):
+    return game_id
+
+
+def time_dispatch(pool, function, args, games):
+    pool.apply(function, args)  # wait for the processes to start
+    started = time.perf_counter()
+    for _ in range(games):
+        pool.apply(function, args)
+    return (time.perf_counter() - started) / games
+
+
+def benchmark_dispatch(args):
+    lishogi_bot = importlib.import_module("lishogi-bot")
+    with open("config.yml.default") as stream:
+        config = yaml.safe_load(stream)
+    li = lishogi_bot.lishogi.Lishogi("benchmark", config["url"], lishogi_bot.__version__, 0)
+    user_profile = {"username": "benchmark", "title": "BOT"}
+    manager = multiprocessing.Manager()
+    queues = [manager.Queue(), manager.list(), manager.Queue(), manager.Queue()]
+    control_queue, challenge_queue, correspondence_queue, logging_queue = queues
+    game_args = [li, "abcdefgh", control_queue, user_profile, config, challenge_queue, correspondence_queue, logging_queue,
+                 lishogi_bot.game_logging_configurer, 0]
+
+    # every argument of play_game sent with each game
+    with multiprocessing.pool.Pool(1) as pool:
+        before = time_dispatch(pool, play_game_with_arguments, game_args, args.games)
+    # only the game id sent to a process started by the fork server
+    context = multiprocessing.get_context("forkserver")
+    with multiprocessing.pool.Pool(1, context=context) as pool:
+        after = time_dispatch(pool, play_game_by_id, ["abcdefgh"], args.games)
+    manager.shutdown()
+    print(f"Dispatch per game over {args.games} games: all arguments {before * 1e6:.0f} µs, game id only {after * 1e6:.0f} µs")
+
+
+def random_game(plies, seed=1):
+    import shogi
+    random.seed(seed)
+    board = shogi.Board()
+    moves = []
+    while len(moves) < plies and not board.is_game_over():
+        move = random.choice(list(board.legal_moves))
+        board.push(move)
+        moves.append(move.usi())
+    return moves
+
+
+def game_json(moves):
+    state = {"type": "gameState", "moves": " ".join(moves), "btime": 60000, "wtime": 60000, "binc": 0, "winc": 0, "byo": 0, "status": "started"}
+    return {"id": "abcdefgh", "variant": {"name": "Standard"}, "speed": "blitz", "perf": {"name": "Blitz"},
+            "clock": {"initial": 60000, "increment": 0, "byoyomi": 0}, "sente": {"name": "benchmark", "rating": 1500},
+            "gote": {"name": "opponent", "rating": 1500}, "initialSfen": "startpos", "state": state}
+
+
+def benchmark_updates(args):
+    lishogi_bot = importlib.import_module("lishogi-bot")
+    moves = random_game(args.plies)
+    lines = [json.dumps(game_json(moves[:ply])["state"]).encode("utf-8") for ply in range(1, len(moves) + 1)]
+
+    def play(incremental):
+        game = lishogi_bot.model.Game(game_json([]), "benchmark", "https://lishogi.org/", 20)
+        board = None
+        started = time.perf_counter()
+        for line in lines:
+            game.state.update(json.loads(line))
+            board = lishogi_bot.update_board(game, board) if incremental else lishogi_bot.setup_board(game)
+        return (time.perf_counter() - started) / len(lines)
+
+    replay = play(False)
+    incremental = play(True)
+    print(f"Per gameState update over {len(lines)} plies: replaying all moves {replay * 1e6:.0f} µs, pushing new moves only {incremental * 1e6:.0f} µs")
+
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    games = [lishogi_bot.model.Game(game_json(moves), "benchmark", "https://lishogi.org/", 20) for _ in range(1000)]
+    size = (tracemalloc.get_traced_memory()[0] - before) / len(games)
+    tracemalloc.stop()
+    print(f"Memory per game with {len(moves)} plies: {size:.0f} bytes")
+
+
+def recorded_stream(plies):
+    # A game stream as sent by lishogi: the full game, then a gameState per move with chat and keep-alive lines in between
+    moves = random_game(plies)
+    game = game_json([])
+    game.update({"type": "gameFull", "rated": True, "createdAt": 1700000000000})
+    lines = [json.dumps(game).encode("utf-8")]
+    for ply in range(1, len(moves) + 1):
+        state = game_json(moves[:ply])["state"]
+        state.update({"btime": 60000 - ply * 100, "wtime": 60000 - ply * 90})
+        lines.append(json.dumps(state).encode("utf-8"))
+        if ply % 10 == 0:
+            lines.append(json.dumps({"type": "chatLine", "room": "spectator", "username": "someone", "text": "!eval"}).encode("utf-8"))
+            lines.append(b"")
+    return lines
+
+
+def benchmark_ndjson(args):
+    import ndjson
+    if args.file:
+        with open(args.file, "rb") as stream:
+            lines = [line.rstrip(b"\n") for line in stream]
+    else:
+        lines = recorded_stream(args.plies)
+
+    def time_decoding(decode):
+        started = time.perf_counter()
+        for _ in range(args.repeat):
+            for line in lines:
+                decode(line)
+        return (time.perf_counter() - started) / (args.repeat * len(lines))
+
+    decoders = {"json.loads(line.decode())": lambda line: json.loads(line.decode("utf-8")) if line else None,
+                "json.loads(line)": lambda line: json.loads(line) if line else None}
+    decoders[f"ndjson.decode ({ndjson.backend})"] = ndjson.decode
+    print(f"Per line over {len(lines)} lines ({sum(map(len, lines)) / len(lines):.0f} bytes on average):")
+    for name, decode in decoders.items():
+        print(f"  {name:<28}{time_decoding(decode) * 1e6:6.2f} µs")
+
+
+SEARCH_POSITIONS = [
+    "lnsgkgsnl/1r5b1/ppppppppp/9/9/9/PPPPPPPPP/1B5R1/LNSGKGSNL b - 1",
+    "ln1g3nl/1r1sk1gb1/p1pppp1pp/1p4p2/7P1/2P6/PPSPPPP1P/1B3S1R1/LN1GKG1NL b - 19",
+    "ln1g5/1r2S1k2/p2pppn2/2ps2p2/1p7/2P6/PPSPPPPLP/2G2K1pr/LN4G1b w BGSLPnp 62",
+    "l6nl/5+P1gk/2np1S3/p1p4Pp/3P2Sp1/1PPb2P1P/P5GS1/R8/LN4bKL w RGgsn5p 1",
+]
+
+
+# Mate problems and the length of their shortest mate in plies
+TSUME_PROBLEMS = [
+    ("1n3p3/3k5/4N4/4G4/9/9/9/9/9 b RGNr2b2g4sn4l17p 1", 3),
+    ("9/6n1k/6R1s/9/7NL/9/9/9/9 b GLr2b3g3s2n2l18p 1", 3),
+    ("1kg6/3g5/B1S6/9/9/9/9/9/9 b RGrbg3s4n4l18p 1", 3),
+    ("1glks4/R8/9/9/9/9/9/9/9 b RG2b2g3s4n3l18p 1", 5),
+    ("5S2k/8l/6P2/8S/9/9/9/9/9 b 2R2b4g2s4n3l17p 1", 5),
+    ("kpp6/p8/Ll7/GL7/9/9/9/9/9 b P2r2b3g4s4nl14p 1", 5),
+    ("2k1n4/L4R3/2s6/3B5/9/9/9/9/9 b R2Pb4g3s3n3l16p 1", 5),
+    ("7sg/5B2k/8p/9/8B/9/9/9/9 b SN2r3g2s3n4l17p 1", 5),
+    ("4n4/4k4/9/3B5/9/9/9/9/9 b BGS2r3g3s3n4l18p 1", 5),
+    ("kgG6/9/n1L6/P8/9/9/9/9/9 b G2N2r2bg4sn3l17p 1", 5),
+    ("k1S6/n1gL5/p8/B8/9/9/9/9/9 b RBLr3g3s3n2l17p 1", 7),
+    ("4S2kg/5L2p/6gBp/9/9/9/9/9/9 b RGLrbg3s4n2l16p 1", 7),
+    ("5g2s/5Sk1L/4Gp3/9/9/9/9/9/9 b GLP2r2bg2s4n2l16p 1", 7),
+    ("9/5k3/6pg1/6BSP/9/9/9/9/9 b 2Rb3g3s4n4l16p 1", 7),
+    ("9/7k1/4P2n1/9/7BB/9/9/9/9 b S2N2r4g3sn4l17p 1", 7),
+    ("k1G6/9/pl7/L2N5/9/9/9/9/9 b 2BL2r3g4s3nl17p 1", 7),
+    ("8k/8s/8R/5L1R1/9/9/9/9/9 b NP2b4g3s3n3l17p 1", 9),
+    ("7lk/5P1np/8B/6B2/9/9/9/9/9 b 2G2r2g4s3n3l16p 1", 9),
+]
+
+
+def benchmark_nps(args):
+    import shogi
+    import alphabeta
+    nodes = 0
+    seconds = 0
+    for sfen in SEARCH_POSITIONS:
+        searcher = alphabeta.Searcher(args.hash)
+        started = time.perf_counter()
+        searcher.deadline = time.monotonic() + args.seconds
+        for depth, score, pv in searcher.iterate(shogi.Board(sfen), args.depth):
+            pass
+        elapsed = time.perf_counter() - started
+        nodes += searcher.nodes
+        seconds += elapsed
+        print(f"  depth {depth:2} {searcher.nodes:8} nodes {searcher.nodes / elapsed:8.0f} nps  {sfen}")
+    print(f"Over {len(SEARCH_POSITIONS)} positions: {nodes / seconds:.0f} nodes per second")
+
+
+def board_perft(board, depth):
+    moves = list(board.legal_moves)
+    if depth <= 1:
+        return len(moves) if depth == 1 else 1
+    nodes = 0
+    for move in moves:
+        board.push(move)
+        nodes += board_perft(board, depth - 1)
+        board.pop()
+    return nodes
+
+
+def benchmark_perft(args):
+    import shogi
+    import position
+    sfens = [args.sfen] if args.sfen else SEARCH_POSITIONS[:2]
+    for sfen in sfens:
+        print(sfen)
+        for depth in range(1, args.depth + 1):
+            started = time.perf_counter()
+            nodes = position.Position(sfen).perft(depth)
+            compact = time.perf_counter() - started
+            started = time.perf_counter()
+            board_nodes = board_perft(shogi.Board(sfen), depth)
+            board = time.perf_counter() - started
+            if nodes != board_nodes:
+                raise RuntimeError(f"perft {depth}: position.Position counts {nodes} moves, shogi.Board {board_nodes}")
+            print(f"  perft {depth} {nodes:9}  shogi.Board {board:8.3f} s  position.Position {compact:8.3f} s  {board / compact:5.1f}x")
+
+
+def benchmark_tsume(args):
+    import tsume
+    solved = 0
+    seconds = 0
+    for sfen, plies in TSUME_PROBLEMS:
+        solver = tsume.MateSolver(args.size)
+        started = time.perf_counter()
+        moves = solver.solve(sfen, args.seconds * 1000)
+        elapsed = time.perf_counter() - started
+        seconds += elapsed
+        if moves:
+            solved += 1
+        found = f"mate in {len(moves):2}" if moves else "no mate   "
+        print(f"  {elapsed:7.3f} s {solver.nodes:8} nodes  {found} (shortest {plies})  {sfen}")
+    print(f"Solved {solved} of {len(TSUME_PROBLEMS)} problems in {seconds:.2f} s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks for Lishogi-Bot")
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+    startup = subparsers.add_parser("startup", help="Time from launching lishogi-bot.py until it is ready to accept challenges.")
+    startup.add_argument("--runs", type=int, default=5)
+    startup.set_defaults(run=benchmark_startup)
+    dispatch = subparsers.add_parser("dispatch", help="Time to hand a game to a game process.")
+    dispatch.add_argument("--games", type=int, default=1000)
+    dispatch.set_defaults(run=benchmark_dispatch)
+    updates = subparsers.add_parser("updates", help="Time to handle the gameState updates of a game and memory per game.")
+    updates.add_argument("--plies", type=int, default=150)
+    updates.set_defaults(run=benchmark_updates)
+    decoding = subparsers.add_parser("ndjson", help="Time to decode game and event stream lines.")
+    decoding.add_argument("--file", help="A recorded NDJSON stream to decode instead of a generated game stream.")
+    decoding.add_argument("--plies", type=int, default=150)
+    decoding.add_argument("--repeat", type=int, default=200)
+    decoding.set_defaults(run=benchmark_ndjson)
+    nps = subparsers.add_parser("nps", help="Nodes per second of the AlphaBeta homemade engine.")
+    nps.add_argument("--depth", type=int, default=5)
+    nps.add_argument("--seconds", type=float, default=10, help="Time limit for each position.")
+    nps.add_argument("--hash", type=int, default=16, help="Transposition table size in megabytes.")
+    nps.set_defaults(run=benchmark_nps)
+    perft = subparsers.add_parser("perft", help="Move generation of position.Position against shogi.Board.")
+    perft.add_argument("--depth", type=int, default=3)
+    perft.add_argument("--sfen", help="The position to count moves from instead of the built-in ones.")
+    perft.set_defaults(run=benchmark_perft)
+    mates = subparsers.add_parser("tsume", help="Time to solve mate problems with the tsume solver.")
+    mates.add_argument("--seconds", type=float, default=10, help="Time limit for each problem.")
+    mates.add_argument("--size", type=int, default=200000, help="Maximum number of positions the solver remembers.")
+    mates.set_defaults(run=benchmark_tsume)
+    args = parser.parse_args()
+    args.run(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,136 @@
+"""
+An opening book learnt from the bot's own finished games, kept in SQLite.
+"""
+
+import time
+import random
+import logging
+import sqlite3
+import shogi
+from search_cache import board_key
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS games (
+    id TEXT PRIMARY KEY,
+    finished_at REAL,
+    initial_sfen TEXT,
+    moves TEXT,
+    color TEXT,
+    result REAL,
+    status TEXT,
+    opponent TEXT,
+    opponent_rating INTEGER,
+    opponent_is_bot INTEGER,
+    speed TEXT,
+    clock_initial INTEGER,
+    clock_increment INTEGER,
+    clock_byoyomi INTEGER
+);
+CREATE TABLE IF NOT EXISTS book (
+    key TEXT,
+    move TEXT,
+    games INTEGER,
+    weight REAL,
+    score REAL,
+    PRIMARY KEY (key, move)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS meta (
+    name TEXT PRIMARY KEY,
+    value INTEGER
+);
+"""
+
+# Games that were never really played
+UNPLAYED = ["aborted", "noStart", "started", "created"]
+
+
+def game_weight(rating):
+    """Results against stronger opponents count more: twice as much for each 400 rating points above 1500."""
+    if rating is None:
+        return 1.0
+    return min(4.0, max(0.25, 2 ** ((rating - 1500) / 400)))
+
+
+class OpeningBook:
+    """
+    Finished games are appended to the `games` table, and `compile` adds the ones it hasn't
+    seen yet to the `book` table: for each position of the first `max_plies` plies where the
+    bot moved, how often it played each move, and the results weighted by the opponent's rating.
+    `choose` picks one of the moves played in at least `min_games` games that scored at least
+    `min_score`, the better scoring ones more often.
+    """
+    def __init__(self, cfg):
+        self.path = cfg.get("path", "opening_book.sqlite")
+        self.max_plies = cfg.get("max_plies", 20)
+        self.min_games = cfg.get("min_games", 3)
+        self.min_score = cfg.get("min_score", 0.55)
+        self.connection = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+        self.connection.executescript(SCHEMA)
+
+    def record_game(self, game):
+        """Appends a finished game with its result for the bot (1 for a win, 0.5 for a draw, 0 for a loss)."""
+        status = game.state.status
+        if status in UNPLAYED or not game.state.moves:
+            return
+        winner = game.state.winner
+        result = 0.5 if winner is None else 1.0 if winner == game.my_color else 0.0
+        opponent = game.opponent
+        self.connection.execute("INSERT OR IGNORE INTO games VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                                (game.id, time.time(), game.initial_sfen, " ".join(game.state.moves), game.my_color, result, status,
+                                 opponent.name, opponent.rating, opponent.title == "BOT", game.speed,
+                                 game.clock_initial, game.clock_increment, game.clock_byoyomi))
+
+    def compile(self):
+        """Adds the games recorded since the last compilation to the book. Returns how many there were."""
+        connection = self.connection
+        # Another game process may be compiling the same games
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            row = connection.execute("SELECT value FROM meta WHERE name = 'compiled'").fetchone()
+            compiled = row[0] if row else 0
+            games = connection.execute("SELECT rowid, initial_sfen, moves, color, result, opponent_rating FROM games WHERE rowid > ? ORDER BY rowid",
+                                       (compiled,)).fetchall()
+            for rowid, initial_sfen, moves, color, result, rating in games:
+                weight = game_weight(rating)
+                for key, move in self.bot_moves(initial_sfen, moves.split(), color):
+                    connection.execute("INSERT INTO book VALUES (?, ?, 1, ?, ?) ON CONFLICT (key, move) DO UPDATE SET "
+                                       "games = games + 1, weight = weight + excluded.weight, score = score + excluded.score",
+                                       (key, move, weight, weight * result))
+                compiled = rowid
+            connection.execute("INSERT OR REPLACE INTO meta VALUES ('compiled', ?)", (compiled,))
+            connection.execute("COMMIT")
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        if games:
+            logger.info(f"Added {len(games)} games to the opening book")
+        return len(games)
+
+    def bot_moves(self, initial_sfen, moves, color):
+        board = shogi.Board() if initial_sfen == "startpos" else shogi.Board(initial_sfen)
+        bot_turn = shogi.BLACK if color == "sente" else shogi.WHITE
+        for move in moves[:self.max_plies]:
+            if board.turn == bot_turn:
+                yield board_key(board), move
+            try:
+                board.push_usi(move)
+            except ValueError:
+                return
+
+    def choose(self, board):
+        """A book move for the side to move of `board` (a USI string), or None."""
+        if len(board.move_stack) >= self.max_plies:
+            return None
+        rows = self.connection.execute("SELECT move, games, weight, score FROM book WHERE key = ?", (board_key(board),)).fetchall()
+        candidates = [(move, score) for move, games, weight, score in rows
+                      if games >= self.min_games and score >= self.min_score * weight and score > 0
+                      and board.is_legal(shogi.Move.from_usi(move))]
+        if not candidates:
+            return None
+        moves, scores = zip(*candidates)
+        return random.choices(moves, weights=scores)[0]
+
+    def close(self):
+        self.connection.close()
@@ -0,0 +1,75 @@
+import os
+import json
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class GameCheckpoint:
+    """
+    An append-only record of one game, written after every move so a restarted bot
+    can pick up where it left off. Each line is a JSON object; later lines override
+    the fields of earlier ones, except "results" which accumulate. A line cut short
+    by a crash is ignored when loading.
+    """
+    def __init__(self, directory, game_id):
+        self.directory = directory
+        self.game_id = game_id
+        self.path = os.path.join(directory, f"{game_id}.jsonl")
+
+    def append(self, record):
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(self.path, "ab+") as file:
+                # Start a new line if the last write was cut short
+                if file.seek(0, os.SEEK_END) > 0:
+                    file.seek(-1, os.SEEK_END)
+                    if file.read(1) != b"\n":
+                        file.write(b"\n")
+                file.write((json.dumps(record) + "\n").encode("utf-8"))
+        except OSError as error:
+            logger.warning(f"Unable to write checkpoint for {self.game_id}: {error}")
+
+    def load(self):
+        state = {"results": []}
+        try:
+            with open(self.path) as file:
+                for line in file:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue
+                    state["results"].extend(record.pop("results", []))
+                    state.update(record)
+        except OSError:
+            return None
+        return state
+
+    def remove(self):
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+
+def load_checkpoints(directory):
+    checkpoints = {}
+    if not directory or not os.path.isdir(directory):
+        return checkpoints
+    for name in os.listdir(directory):
+        if name.endswith(".jsonl"):
+            game_id = name[:-len(".jsonl")]
+            state = GameCheckpoint(directory, game_id).load()
+            if state is not None:
+                checkpoints[game_id] = state
+    return checkpoints
+
+
+def remove_finished(directory, ongoing_game_ids):
+    if not directory or not os.path.isdir(directory):
+        return
+    for name in os.listdir(directory):
+        game_id = name[:-len(".jsonl")]
+        if name.endswith(".jsonl") and game_id not in ongoing_game_ids:
+            logger.debug(f"Removing checkpoint of finished game {game_id}")
+            GameCheckpoint(directory, game_id).remove()
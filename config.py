@@ -1,4 +1,3 @@
-import yaml
 import os
 import os.path
 import logging
@@ -7,6 +6,7 @@ logger = logging.getLogger(__name__)
 
 
 def load_config(config_file):
+    import yaml
     with open(config_file) as stream:
         try:
             CONFIG = yaml.safe_load(stream)
@@ -39,6 +39,15 @@ def load_config(config_file):
         if CONFIG["token"] == "xxxxxxxxxxxxxxxx":
             raise Exception("Your config.yml has the default Lishogi API token. This is probably wrong.")
 
+        engine = os.path.join(CONFIG["engine"]["dir"], CONFIG["engine"]["name"])
+        fallback = CONFIG["engine"].get("fallback")
+        configured_engine = dict(CONFIG["engine"])
+        fallback_used = False
+        if fallback and CONFIG["engine"]["protocol"] == "usi" and not os.access(engine, os.X_OK):
+            logger.error(f"The engine {engine} does not exist or can't be executed. Playing with the homemade engine {fallback} instead.")
+            CONFIG["engine"].update({"protocol": "homemade", "name": fallback})
+            fallback_used = True
+
         if not os.path.isdir(CONFIG["engine"]["dir"]):
             raise Exception(f'Your engine directory `{CONFIG["engine"]["dir"]}` is not a directory.')
 
@@ -46,12 +55,46 @@ def load_config(config_file):
         if working_dir and not os.path.isdir(working_dir):
             raise Exception(f"Your engine's working directory `{working_dir}` is not a directory.")
 
-        engine = os.path.join(CONFIG["engine"]["dir"], CONFIG["engine"]["name"])
+        is_local = CONFIG["engine"]["protocol"] not in ["homemade", "remote"]
 
-        if not os.path.isfile(engine) and CONFIG["engine"]["protocol"] != "homemade":
+        if not os.path.isfile(engine) and is_local:
             raise Exception(f"The engine {engine} file does not exist.")
 
-        if not os.access(engine, os.X_OK) and CONFIG["engine"]["protocol"] != "homemade":
+        if not os.access(engine, os.X_OK) and is_local:
             raise Exception(f"The engine {engine} doesn't have execute (x) permission. Try: chmod +x {engine}")
 
+        profiles = CONFIG.get("engine_profiles") or {}
+        if not isinstance(profiles, dict):
+            raise Exception("Section `engine_profiles` must be a dictionary with indented keys followed by colons..")
+        for name, profile in profiles.items():
+            if not isinstance(profile, dict):
+                raise Exception(f"Engine profile `{name}` must be a dictionary with indented keys followed by colons..")
+            profile_cfg = {**configured_engine, **profile}
+            profile_engine = os.path.join(profile_cfg["dir"], profile_cfg["name"])
+            if fallback and profile_cfg["protocol"] == "usi" and not os.access(profile_engine, os.X_OK):
+                if profile_engine != engine:
+                    logger.error(f"The engine {profile_engine} of engine profile `{name}` does not exist or can't be executed. Playing with the homemade engine {fallback} instead.")
+                profile.update({"protocol": "homemade", "name": fallback})
+                fallback_used = True
+                profile_cfg = {**configured_engine, **profile}
+            if not os.path.isfile(profile_engine) and profile_cfg["protocol"] not in ["homemade", "remote"]:
+                raise Exception(f"The engine {profile_engine} of engine profile `{name}` does not exist.")
+
+        for name, engine_cfg in [("engine", CONFIG["engine"])] + [(f"engine profile `{name}`", {**CONFIG["engine"], **profile}) for name, profile in profiles.items()]:
+            racers = (engine_cfg.get("race") or {}).get("engines") or []
+            if racers and "homemade" in [engine_cfg["protocol"]] + [racer.get("protocol", engine_cfg["protocol"]) for racer in racers]:
+                raise Exception(f"The race of {name} has a homemade engine. Only USI engines (protocol \"usi\" or \"remote\") can race.")
+
+        modes = CONFIG["challenge"].get("modes") or []
+        if fallback_used and "rated" in modes:
+            # the homemade engine is only there to keep the bot online, not to play for rating
+            logger.error("Declining rated challenges while the homemade fallback engine is used.")
+            CONFIG["challenge"]["modes"] = [mode for mode in modes if mode != "rated"]
+
+        idle_cfg = CONFIG.get("idle_analysis") or {}
+        search_cache_cfg = CONFIG["engine"].get("search_cache") or {}
+        if idle_cfg.get("enabled", False) and not search_cache_cfg.get("min_depth", 20):
+            # games only play idle results through the search cache
+            raise Exception("`idle_analysis` needs `engine: search_cache: min_depth` above 0, otherwise its results are never played.")
+
     return CONFIG
\ No newline at end of file
@@ -4,12 +4,14 @@ logger = logging.getLogger(__name__)
 
 
 class Conversation:
-    def __init__(self, game, engine, xhr, version, challenge_queue):
+    def __init__(self, game, engine, xhr, version, challenge_queue, admins=(), toggle_profiling=None):
         self.game = game
         self.engine = engine
         self.xhr = xhr
         self.version = version
         self.challengers = challenge_queue
+        self.admins = {admin.lower() for admin in admins}
+        self.toggle_profiling = toggle_profiling
 
     command_prefix = "!"
 
@@ -40,16 +42,21 @@ class Conversation:
                 self.send_reply(line, f"Challenge queue: {challengers}")
             else:
                 self.send_reply(line, "No challenges queued.")
+        elif cmd == "profile" and self.toggle_profiling is not None and (line.username or "").lower() in self.admins:
+            self.toggle_profiling()
+            self.send_reply(line, "Profiling toggled.")
 
     def send_reply(self, line, reply):
         self.xhr.chat(self.game.id, line.room, reply)
 
     def send_message(self, room, message):
         if message:
-            self.send_reply(ChatLine({"room": room}), message)
+            self.xhr.chat(self.game.id, room, message, droppable=False)
 
 
 class ChatLine:
+    __slots__ = ("room", "username", "text")
+
     def __init__(self, json):
         self.room = json.get("room")
         self.username = json.get("username")
@@ -0,0 +1,86 @@
+import time
+import heapq
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Used for games without a clock, e.g. unlimited correspondence games
+NO_DEADLINE = 3600 * 24 * 365 * 10
+
+
+class CorrespondenceScheduler:
+    """
+    Decides which correspondence games to check in on.
+    Games where it is the bot's turn are kept in a min-heap ordered by the
+    time their clock runs out, so the most urgent game is searched first.
+    Games where it is the opponent's turn are not visited until
+    /api/account/playing reports that the opponent has moved.
+    """
+    def __init__(self):
+        self.heap = []
+        self.entries = {}
+        self.waiting = set()
+        self.in_progress = set()
+
+    def update(self, ongoing_games):
+        now = time.time()
+        ongoing = set()
+        for game in ongoing_games:
+            if game.get("perf") != "correspondence":
+                continue
+            game_id = game["gameId"]
+            ongoing.add(game_id)
+            if game_id in self.in_progress:
+                continue
+            if game.get("isMyTurn"):
+                seconds_left = game.get("secondsLeft")
+                self.push(game_id, now + (seconds_left if seconds_left is not None else NO_DEADLINE))
+            else:
+                self.wait(game_id)
+
+        for game_id in list(self.entries):
+            if game_id not in ongoing:
+                self.remove(game_id)
+        self.waiting &= ongoing
+        self.in_progress &= ongoing
+        logger.info(f"Correspondence games: {len(self.entries)} to move, {len(self.waiting)} waiting for the opponent, {len(self.in_progress)} in progress")
+
+    def push(self, game_id, deadline=None):
+        deadline = time.time() if deadline is None else deadline
+        self.remove(game_id)
+        entry = [deadline, game_id, True]
+        self.entries[game_id] = entry
+        heapq.heappush(self.heap, entry)
+
+    def remove(self, game_id):
+        self.waiting.discard(game_id)
+        entry = self.entries.pop(game_id, None)
+        if entry is not None:
+            # Lazily removed from the heap in pop()
+            entry[2] = False
+
+    def wait(self, game_id):
+        self.in_progress.discard(game_id)
+        self.remove(game_id)
+        self.waiting.add(game_id)
+
+    def pop(self):
+        while self.heap:
+            deadline, game_id, valid = heapq.heappop(self.heap)
+            if valid:
+                del self.entries[game_id]
+                self.in_progress.add(game_id)
+                return game_id
+        return None
+
+    def done(self, game_id):
+        self.in_progress.discard(game_id)
+
+    def has_due_games(self):
+        return bool(self.entries)
+
+    def __contains__(self, game_id):
+        return game_id in self.entries or game_id in self.waiting or game_id in self.in_progress
+
+    def __len__(self):
+        return len(self.entries)
@@ -0,0 +1,156 @@
+import time
+import queue
+import socket
+import logging
+import threading
+from collections import deque
+
+from engine_ctrl import usi
+
+logger = logging.getLogger(__name__)
+
+# Idle connections to engine servers, keyed by address
+idle_connections = {}
+idle_connections_lock = threading.Lock()
+
+
+def connect(address, heartbeat, timeout, token):
+    with idle_connections_lock:
+        connections = idle_connections.get(address, [])
+        while connections:
+            connection = connections.pop()
+            if connection.alive:
+                logger.debug(f"Reusing connection to engine server {address[0]}:{address[1]}")
+                return connection
+    return Connection(address, heartbeat, timeout, token)
+
+
+def release(connection):
+    if not connection.alive or not connection.release():
+        connection.close()
+        return
+    with idle_connections_lock:
+        idle_connections.setdefault(connection.address, []).append(connection)
+
+
+class Connection:
+    """
+    A line based connection to an engine server.
+    Lines starting with "#" are handled by the server itself and never reach the engine.
+    The first one sends the server's token. The server answers every "#ping" with a "#pong"
+    once the engine has answered "isready", so a connection without any traffic for
+    `timeout` seconds is considered hung.
+    """
+    def __init__(self, address, heartbeat=5, timeout=15, token=None):
+        self.address = address
+        self.heartbeat = heartbeat
+        self.sock = socket.create_connection(address, timeout=timeout)
+        self.sock.settimeout(timeout)
+        self.file = self.sock.makefile("r", encoding="utf-8", newline="\n")
+        self.send_lock = threading.Lock()
+        self.lines = queue.Queue()
+        self.latencies = deque(maxlen=100)
+        self.alive = True
+        self.send(f"#auth {token or ''}")
+        logger.info(f"Connected to engine server {address[0]}:{address[1]}")
+        threading.Thread(target=self.read_loop, daemon=True).start()
+        threading.Thread(target=self.heartbeat_loop, daemon=True).start()
+
+    def send(self, line):
+        with self.send_lock:
+            self.sock.sendall((line + "\n").encode("utf-8"))
+
+    def readline(self):
+        line = self.lines.get()
+        if line is None:
+            # Let every later reader see the end of the stream as well
+            self.lines.put(None)
+            return ""
+        return line
+
+    def read_loop(self):
+        try:
+            for line in self.file:
+                line = line.rstrip("\n")
+                if line.startswith("#pong "):
+                    self.latencies.append((time.perf_counter() - float(line.split()[1])) * 1000)
+                elif line == "#denied":
+                    logger.error(f"Engine server {self.address[0]}:{self.address[1]} refused the token. Check remote: token.")
+                else:
+                    self.lines.put(line)
+        except OSError as error:
+            if self.alive:
+                logger.warning(f"Engine server {self.address[0]}:{self.address[1]} stopped responding: {error}")
+        self.alive = False
+        self.lines.put(None)
+
+    def heartbeat_loop(self):
+        while self.alive:
+            try:
+                self.send(f"#ping {time.perf_counter()}")
+            except OSError:
+                break
+            time.sleep(self.heartbeat)
+
+    def release(self):
+        # Wait until the server has returned the engine to its pool, discarding late engine output
+        try:
+            self.send("#release")
+            while True:
+                line = self.readline()
+                if line == "":
+                    return False
+                if line == "#released":
+                    return True
+        except OSError:
+            return False
+
+    def latency(self):
+        if not self.latencies:
+            return None
+        return sum(self.latencies) / len(self.latencies)
+
+    def close(self):
+        self.alive = False
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+
+
+class Engine(usi.Engine):
+    def __init__(self, address, heartbeat=5, timeout=15, token=None):
+        self.heartbeat = heartbeat
+        self.timeout = timeout
+        self.token = token
+        super().__init__(address)
+
+    def open_process(self, address, cwd=None):
+        return connect(address, self.heartbeat, self.timeout, self.token)
+
+    def kill_process(self):
+        release(self.proccess)
+
+    def send(self, line):
+        logger.debug("<< %s", line)
+        try:
+            self.proccess.send(line)
+        except OSError:
+            raise EOFError()
+
+    def recv(self):
+        while True:
+            line = self.proccess.readline()
+            if line == "":
+                raise EOFError()
+
+            line = line.rstrip()
+
+            logger.debug(">> %s", line)
+
+            if line:
+                return line
+
+    def latency(self):
+        return self.proccess.latency()
@@ -0,0 +1,231 @@
+"""
+Hosts a pool of local USI engines for Lishogi-Bot clients using the "remote" protocol.
+
+Run it on the compute node with a config.yml whose `engine` section points at a local engine
+and sets `remote: token`, the secret every client has to send first:
+python3 -m engine_ctrl.server --config config.yml --host 0.0.0.0 --port 5005 --engines 4
+"""
+
+import argparse
+import logging
+import hmac
+import os
+import queue
+import collections
+import socketserver
+import threading
+import yaml
+
+from engine_ctrl import usi
+
+logger = logging.getLogger(__name__)
+
+
+class PooledEngine:
+    def __init__(self, commands, cwd, startup_lines, on_idle, on_exit):
+        self.engine = usi.Engine(commands, cwd=cwd)
+        for _ in range(startup_lines):
+            self.engine.recv()
+        self.on_idle = on_idle
+        self.on_exit = on_exit
+        self.lock = threading.Lock()
+        self.sink = None
+        self.close_client = None
+        self.drained = None
+        # What to send to the client for each "readyok" still to come, None for the one that ends a detach
+        self.ready_replies = collections.deque()
+        threading.Thread(target=self.read_loop, daemon=True).start()
+
+    def attach(self, sink, close_client):
+        with self.lock:
+            self.sink = sink
+            self.close_client = close_client
+
+    def send(self, line):
+        with self.lock:
+            if line == "isready":
+                self.ready_replies.append("readyok")
+            self.engine.send(line)
+
+    def ping(self, pong):
+        # Only an engine that still answers "isready" keeps the client's connection alive
+        with self.lock:
+            self.ready_replies.append(pong)
+            self.engine.send("isready")
+
+    def detach(self):
+        # Forward output until the engine has answered "isready", then put it back in the pool
+        drained = threading.Event()
+        with self.lock:
+            self.drained = drained
+            self.engine.send("stop")
+            self.ready_replies.append(None)
+            self.engine.send("isready")
+        return drained
+
+    def read_loop(self):
+        while True:
+            try:
+                line = self.engine.recv()
+            except EOFError:
+                break
+            with self.lock:
+                if line == "readyok" and self.ready_replies:
+                    line = self.ready_replies.popleft()
+                    if line is None:
+                        drained, self.drained = self.drained, None
+                        self.sink = self.close_client = None
+                        drained.set()
+                        self.on_idle(self)
+                        continue
+                sink = self.sink
+            if sink is not None:
+                sink(line)
+
+        logger.warning("Engine process exited")
+        with self.lock:
+            close_client, drained = self.close_client, self.drained
+        if drained is not None:
+            drained.set()
+        if close_client is not None:
+            close_client()
+        self.on_exit(self)
+
+
+class EnginePool:
+    def __init__(self, commands, cwd, startup_lines, size):
+        self.commands = commands
+        self.cwd = cwd
+        self.startup_lines = startup_lines
+        self.size = size
+        self.count = 0
+        self.idle = queue.Queue()
+        self.lock = threading.Lock()
+
+    def acquire(self, sink, close_client):
+        try:
+            engine = self.idle.get_nowait()
+        except queue.Empty:
+            with self.lock:
+                spawn = self.count < self.size
+                if spawn:
+                    self.count += 1
+            if spawn:
+                logger.info(f"Starting engine {self.count}/{self.size}")
+                engine = PooledEngine(self.commands, self.cwd, self.startup_lines, self.idle.put, self.exited)
+            else:
+                engine = self.idle.get()
+        engine.attach(sink, close_client)
+        return engine
+
+    def release(self, engine):
+        return engine.detach()
+
+    def exited(self, engine):
+        with self.lock:
+            self.count -= 1
+
+
+class EngineHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        client = f"{self.client_address[0]}:{self.client_address[1]}"
+        logger.info(f"Client {client} connected")
+        pool = self.server.pool
+        send_lock = threading.Lock()
+        engine = None
+        drained = None
+
+        def reply(line):
+            try:
+                with send_lock:
+                    self.wfile.write((line + "\n").encode("utf-8"))
+                    self.wfile.flush()
+            except OSError:
+                pass
+
+        def close_client():
+            try:
+                self.request.shutdown(2)
+            except OSError:
+                pass
+
+        try:
+            # Nothing reaches an engine before the client has sent the token
+            line = self.rfile.readline().decode("utf-8").rstrip()
+            if not line.startswith("#auth ") or not hmac.compare_digest(line[6:].encode("utf-8"), self.server.token.encode("utf-8")):
+                logger.warning(f"Client {client} sent no valid token")
+                reply("#denied")
+                return
+            for line in self.rfile:
+                line = line.decode("utf-8").rstrip()
+                if line.startswith("#ping"):
+                    if engine is None:
+                        reply("#pong" + line[5:])
+                    else:
+                        engine.ping("#pong" + line[5:])
+                elif line == "#release":
+                    if engine is not None:
+                        drained = pool.release(engine)
+                        engine = None
+                    if drained is not None:
+                        drained.wait()
+                        drained = None
+                    reply("#released")
+                elif line == "quit":
+                    # Keep the engine running for the next client
+                    if engine is not None:
+                        drained = pool.release(engine)
+                        engine = None
+                elif line:
+                    if engine is None:
+                        engine = pool.acquire(reply, close_client)
+                    engine.send(line)
+        except OSError:
+            pass
+        finally:
+            if engine is not None:
+                try:
+                    pool.release(engine)
+                except OSError:
+                    pass
+            logger.info(f"Client {client} disconnected")
+
+
+class EngineServer(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, address, pool, token):
+        super().__init__(address, EngineHandler)
+        self.pool = pool
+        self.token = token
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Host USI engines for Lishogi-Bot")
+    parser.add_argument("--config", help="Specify a configuration file (defaults to ./config.yml)", default="./config.yml")
+    parser.add_argument("--host", help="Address to listen on. Use 0.0.0.0 to accept clients from other machines.", default="127.0.0.1")
+    parser.add_argument("--port", help="Port to listen on.", type=int, default=5005)
+    parser.add_argument("--engines", help="Maximum number of engines to run at once.", type=int, default=1)
+    parser.add_argument("-v", action="store_true", help="Make output more verbose. Include all communication with the engines.")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.DEBUG if args.v else logging.INFO)
+    with open(args.config) as stream:
+        cfg = yaml.safe_load(stream)["engine"]
+    token = (cfg.get("remote") or {}).get("token")
+    if not token:
+        parser.error("Set engine: remote: token in the config, clients have to send it before they get an engine.")
+    from engine_wrapper import engine_commands
+    commands = engine_commands(cfg)
+    commands = commands[0] if len(commands) == 1 else commands
+    cwd = cfg.get("working_dir") or os.getcwd()
+    pool = EnginePool(commands, cwd, cfg.get("startup_lines", 0), args.engines)
+
+    with EngineServer((args.host, args.port), pool, str(token)) as server:
+        logger.info(f"Serving up to {args.engines} engines on {args.host}:{args.port}")
+        server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+"""
+Throttled, immutable snapshots of the info an engine sends while it searches.
+"""
+
+import time
+import collections
+from types import MappingProxyType
+
+# Scores of mates in the search history, minus the number of plies to mate
+MATE_SCORE = 100000
+
+
+class InfoSnapshot(collections.namedtuple("InfoSnapshot", ["depth", "seldepth", "score", "nodes", "nps", "hashfull", "time", "pv", "published_at"])):
+    __slots__ = ()
+
+    def as_info(self):
+        """The snapshot as an engine info dict, without the fields the engine didn't send."""
+        info = {field: value for field, value in zip(self._fields[:-1], self) if value is not None}
+        if self.score is not None:
+            info["score"] = dict(self.score)
+        return info
+
+
+def score_value(score):
+    if not score:
+        return None
+    if "mate" in score:
+        mate = score["mate"]
+        return MATE_SCORE - mate if mate > 0 else -MATE_SCORE - mate
+    return score.get("cp")
+
+
+class InfoChannel:
+    """
+    Publishes the info lines of a search as InfoSnapshots, at most `rate` per second and once
+    more when the search ends. The search thread is the only writer: it replaces `snapshot`
+    and `history` instead of changing them, so other threads read them without a lock.
+    `history` holds one (depth, seldepth, time, nodes, score, move) tuple per depth of the
+    last finished search, from the last info line of each depth, with mates scored as in
+    `score_value`.
+    """
+    def __init__(self, rate=10):
+        self.interval = 1 / rate
+        self.snapshot = None
+        self.history = ()
+        self.depths = []
+        self.current = None
+        self.next_publish = 0
+
+    def begin(self):
+        self.depths = []
+        self.current = None
+        self.next_publish = 0
+
+    def offer(self, info):
+        depth = info.get("depth")
+        if depth is not None and info.get("multipv", 1) == 1:
+            if self.current is not None and depth != self.current[0]:
+                self.depths.append(self.current)
+            pv = info.get("pv") or ""
+            self.current = (depth, info.get("seldepth"), info.get("time"), info.get("nodes"), score_value(info.get("score")), pv.partition(" ")[0] or None)
+        now = time.monotonic()
+        if now >= self.next_publish:
+            self.next_publish = now + self.interval
+            self.publish(info, now)
+
+    def end(self, info):
+        if self.current is not None:
+            self.depths.append(self.current)
+            self.current = None
+        self.history = tuple(self.depths)
+        self.publish(info, time.monotonic())
+
+    def publish(self, info, now):
+        score = info.get("score")
+        self.snapshot = InfoSnapshot(info.get("depth"), info.get("seldepth"), MappingProxyType(dict(score)) if score else None, info.get("nodes"),
+                                     info.get("nps"), info.get("hashfull"), info.get("time"), info.get("pv"), now)
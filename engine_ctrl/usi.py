@@ -4,17 +4,22 @@ import os
 import signal
 import logging
 
+from engine_ctrl.snapshots import InfoChannel
+
 logger = logging.getLogger(__name__)
 
 
 class Engine:
     def __init__(self, command, cwd=None):
         self.info = {}
+        self.info_channel = InfoChannel()
         self.id = {}
         cwd = cwd or os.path.realpath(os.path.expanduser("."))
         self.proccess = self.open_process(command, cwd)
         self.go_commands = None
         self.current_variant = None 
+        # Set from sending `go` until `bestmove`
+        self.searching = threading.Event()
 
     def set_go_commands(self, go_comm):
         self.go_commands = go_comm
@@ -53,7 +58,7 @@ class Engine:
             os.killpg(self.proccess.pid, signal.SIGKILL)
 
     def send(self, line):
-        logger.debug(f"<< {line}")
+        logger.debug("<< %s", line)
         assert self.proccess.stdin is not None
         self.proccess.stdin.write(line + "\n")
         self.proccess.stdin.flush()
@@ -67,7 +72,7 @@ class Engine:
 
             line = line.rstrip()
 
-            logger.debug(f">> {line}")
+            logger.debug(">> %s", line)
 
             if line:
                 return line
@@ -140,7 +145,8 @@ class Engine:
             else:
                 self.setoption("USI_Variant", variant.replace(" ", ""))
 
-    def go(self, position, moves, movetime=None, btime=None, wtime=None, binc=None, winc=None, byo=None, depth=None, nodes=None, ponder=False):
+    def go(self, position, moves, movetime=None, btime=None, wtime=None, binc=None, winc=None, byo=None, depth=None, nodes=None, ponder=False, stop_condition=None):
+        self.searching.clear()
         self.position(position, moves)
 
         builder = []
@@ -174,11 +180,13 @@ class Engine:
             builder.append(str(byo))
 
         self.send(" ".join(builder))
-        logger.info(" ".join(builder))
+        self.searching.set()
 
         info = {}
         info["bestmove"] = None
         info["pondermove"] = None
+        stopped = False
+        self.info_channel.begin()
 
         while True:
             command, arg = self.recv_usi()
@@ -193,6 +201,8 @@ class Engine:
                         ponder_move = arg_split[2]
                         if ponder_move and ponder_move != "(none)":
                             info["pondermove"] = ponder_move
+                self.info_channel.end(info)
+                self.searching.clear()
                 return (info["bestmove"], info["pondermove"])
 
             elif command == "info":
@@ -252,6 +262,12 @@ class Engine:
                     if upperbound:
                         info["score"]["upperbound"] = upperbound
                 self.info = info
+                self.info_channel.offer(info)
+
+                # Soft time limit: stop before movetime runs out once the search looks settled
+                if stop_condition is not None and not stopped and stop_condition(info):
+                    self.stop()
+                    stopped = True
             else:
                 logger.error("Unexpected engine response to go: %s %s" % (command, arg))
 
@@ -259,7 +275,6 @@ class Engine:
         if position != "startpos":
             position = "sfen " + position
         self.send("position %s moves %s" % (position, " ".join(moves)))
-        logger.debug("position %s moves %s" % (position, " ".join(moves)))
 
     def stop(self):
         self.send("stop")
@@ -1,25 +1,129 @@
 import os
+import json
+import time
+import queue
 import backoff
 import logging
+import threading
+import functools
 from enum import Enum
+from collections import Counter, defaultdict
 
 logger = logging.getLogger(__name__)
 
-from engine_ctrl import usi
+from engine_ctrl import usi, remote
 
 
 @backoff.on_exception(backoff.expo, BaseException, max_time=120)
-def create_engine(config):
+def create_engine(config, profile=None):
+    cfg = get_engine_cfg(config, profile)
+    race_cfg = cfg.get("race") or {}
+    if race_cfg.get("engines"):
+        engines = [engine_from_cfg(cfg)] + [engine_from_cfg({**cfg, **racer_cfg}) for racer_cfg in race_cfg["engines"]]
+        return RacingEngine(engines, race_cfg.get("policy", "first"), race_cfg.get("deadline", 500))
+    return engine_from_cfg(cfg)
+
+
+def get_engine_cfg(config, profile=None):
     cfg = config["engine"]
+    if profile is None:
+        return cfg
+    return {**cfg, **config["engine_profiles"][profile]}
+
+
+def choose_profile(config, game):
+    profiles = config.get("engine_profiles") or {}
+    variant = game.variant_name.lower().replace(" ", "")
+    for name, profile in profiles.items():
+        if variant in (profile.get("variants") or []):
+            return name
+    for name, profile in profiles.items():
+        if game.speed in (profile.get("speeds") or []):
+            return name
+    return None
+
+
+class EnginePool:
+    """
+    Idle engines kept running between the games of a game process: up to `warm` of each
+    profile, and at most `max_warm` of all profiles together. When a released engine would go
+    over `max_warm`, idle engines of the profile that was released least recently are quit.
+    """
+    def __init__(self):
+        self.idle = defaultdict(list)
+        self.released = {}
+        self.lock = threading.Lock()
+
+    def warm(self, config, profile=None):
+        warm = min(get_engine_cfg(config, profile).get("warm", 0), max_warm(config) - self.idle_count())
+        while len(self.idle[profile]) < warm:
+            logger.info(f"Warming up engine for profile {profile or 'default'}")
+            self.idle[profile].append(create_engine(config, profile))
+        self.released.setdefault(profile, time.monotonic())
+
+    def acquire(self, config, profile=None):
+        with self.lock:
+            if self.idle[profile]:
+                return self.idle[profile].pop()
+        return create_engine(config, profile)
+
+    def release(self, config, engine, profile=None, keep=0):
+        """Keeps `engine` for the next game if fewer than `warm` (or `keep`) engines of `profile` are idle, else quits it."""
+        warm = max(get_engine_cfg(config, profile).get("warm", 0), keep)
+        stopped = [engine]
+        with self.lock:
+            if len(self.idle[profile]) < warm:
+                try:
+                    engine.reset()
+                    self.idle[profile].append(engine)
+                    self.released[profile] = time.monotonic()
+                    stopped = self.evict(max(max_warm(config), keep))
+                except Exception:
+                    logger.exception("Unable to reset engine")
+        for stopped_engine in stopped:
+            stopped_engine.quit()
+            stopped_engine.kill_process()
+
+    def evict(self, limit):
+        stopped = []
+        while self.idle_count() > limit:
+            profile = min((profile for profile, engines in self.idle.items() if engines), key=self.released.get)
+            stopped.append(self.idle[profile].pop(0))
+        return stopped
+
+    def idle_count(self):
+        return sum(map(len, self.idle.values()))
+
+
+engine_pool = EnginePool()
+
+
+def max_warm(config):
+    # By default every profile keeps its own `warm` engines
+    profiles = [None] + list(config.get("engine_profiles") or {})
+    return config["engine"].get("max_warm", sum(get_engine_cfg(config, profile).get("warm", 0) for profile in profiles))
+
+
+def warm_engines(config):
+    for profile in [None] + list(config.get("engine_profiles") or {}):
+        engine_pool.warm(config, profile)
+
+
+def engine_commands(cfg):
     engine_path = os.path.realpath(os.path.join(cfg["dir"], cfg["name"]))
-    engine_working_dir = cfg.get("working_dir") or os.getcwd()
-    engine_type = cfg.get("protocol")
     engine_options = cfg.get("engine_options")
-    usi_options = cfg.get("usi_options") or {}
     commands = [engine_path]
     if engine_options:
         for k, v in engine_options.items():
             commands.append(f"--{k}={v}")
+    return commands
+
+
+def engine_from_cfg(cfg):
+    engine_working_dir = cfg.get("working_dir") or os.getcwd()
+    engine_type = cfg.get("protocol")
+    usi_options = cfg.get("usi_options") or {}
+    commands = engine_commands(cfg)
     go_commands = cfg.get("go_commands") or {}
 
     silence_stderr = cfg.get("silence_stderr", False)
@@ -27,14 +131,22 @@ def create_engine(config):
 
     if engine_type == "homemade":
         Engine = getHomemadeEngine(cfg["name"])
+        usi_options = cfg.get("homemade_options") or {}
     elif engine_type == "usi":
         Engine = USIEngine
+    elif engine_type == "remote":
+        remote_cfg = cfg.get("remote") or {}
+        commands = [(remote_cfg.get("host", "localhost"), remote_cfg.get("port", 5005))]
+        Engine = functools.partial(RemoteUSIEngine, heartbeat=remote_cfg.get("heartbeat", 5), timeout=remote_cfg.get("timeout", 15),
+                                   token=remote_cfg.get("token"))
     else:
         raise ValueError(
-            f"Invalid engine type: {engine_type}. Expected usi or homemade.")
+            f"Invalid engine type: {engine_type}. Expected usi, remote or homemade.")
 
-    logger.debug(f"Starting engine: {' '.join(commands)}")
-    return Engine(commands, usi_options, go_commands, silence_stderr, startup_lines=startup_lines, cwd=engine_working_dir)
+    logger.debug(f"Starting engine: {' '.join(map(str, commands))}")
+    engine = Engine(commands, usi_options, go_commands, silence_stderr, startup_lines=startup_lines, cwd=engine_working_dir)
+    engine.search_trace_dir = cfg.get("search_trace_dir") or None
+    return engine
 
 
 class Termination(str, Enum):
@@ -52,24 +164,21 @@ class Termination(str, Enum):
 class EngineWrapper:
     def __init__(self, go_commands):
         self.go_commands = go_commands
-        pass
+        self.search_trace_dir = None
 
     def search_for(self, board, game, movetime):
-        if game.variant_name == "Kyoto shogi":
-            moves = game.state["fairyMoves"].split()
-        else:
-            moves = "" if game.variant_name == "Standard" else game.state["moves"].split()
+        moves = "" if game.variant_name == "Standard" else game.moves()
         sfen = board.sfen() if game.variant_name == "Standard" else game.initial_sfen
-        self.engine.set_variant_options(game.variant_name.lower())
+        self.set_variant_options(game.variant_name.lower())
         return self.search(sfen, moves, movetime=movetime)
     
+    def get_position(self, game, board):
+        moves = [m.usi() for m in list(board.move_stack)] if game.variant_name == "Standard" else game.moves()
+        return game.initial_sfen, moves
+
     def search_with_ponder(self, game, board, btime, wtime, binc, winc, byo, ponder=False):
-        if game.variant_name == "Kyoto shogi":
-            moves = game.state["fairyMoves"].split()
-        else:
-            moves = [m.usi() for m in list(board.move_stack)] if game.variant_name == "Standard" else game.state["moves"].split()
-        sfen = game.initial_sfen
-        self.engine.set_variant_options(game.variant_name.lower())
+        sfen, moves = self.get_position(game, board)
+        self.set_variant_options(game.variant_name.lower())
         cmds = self.go_commands
         movetime = cmds.get("movetime")
         if movetime is not None:
@@ -86,8 +195,14 @@ class EngineWrapper:
                                              movetime=movetime,
                                              ponder=ponder)
         return best_move, ponder_move
-    
-    def search(self, sfen, moves, btime=None, wtime=None, binc=None, winc=None, byo=None, nodes=None, depth=None, movetime=None, ponder=False):
+
+    def search_with_budget(self, game, board, budget):
+        sfen, moves = self.get_position(game, board)
+        self.set_variant_options(game.variant_name.lower())
+        stop_condition = None if budget.is_fixed() else budget.should_stop
+        return self.search(sfen, moves, movetime=budget.hard, stop_condition=stop_condition)
+
+    def search(self, sfen, moves, btime=None, wtime=None, binc=None, winc=None, byo=None, nodes=None, depth=None, movetime=None, ponder=False, stop_condition=None):
         best_move, ponder_move = self.engine.go(sfen,
                                                 moves,
                                                 btime=btime,
@@ -98,8 +213,10 @@ class EngineWrapper:
                                                 nodes=nodes,
                                                 depth=depth,
                                                 movetime=movetime,
-                                                ponder=ponder)
+                                                ponder=ponder,
+                                                stop_condition=stop_condition)
         self.print_stats()
+        self.write_search_trace(sfen, moves, ponder, best_move)
         return best_move, ponder_move
 
     def print_stats(self, stats=None):
@@ -109,9 +226,41 @@ class EngineWrapper:
     def get_stats(self, stats=None):
         if stats is None:
             stats = ["score", "depth", "nodes", "nps"]
-        info = self.engine.info
+        snapshot = self.get_snapshot()
+        info = snapshot.as_info() if snapshot is not None else {}
         return [f"{stat}: {info[stat]}" for stat in stats if stat in info]
 
+    def get_info(self):
+        return self.engine.info
+
+    def wait_searching(self, timeout):
+        """Waits up to `timeout` seconds for the engine to be sent `go`. Returns whether it is searching."""
+        return self.engine.searching.wait(timeout)
+
+    def get_snapshot(self):
+        """The latest InfoSnapshot of the engine, safe to read from any thread."""
+        return self.engine.info_channel.snapshot
+
+    def get_search_history(self):
+        """(depth, seldepth, time, nodes, score, move) for each depth of the last finished search."""
+        return self.engine.info_channel.history
+
+    def write_search_trace(self, sfen, moves, ponder, best_move):
+        # One line per search in a file per process, so that game processes don't write to the same file
+        if self.search_trace_dir is None:
+            return
+        record = {"finished_at": round(time.time(), 3), "sfen": sfen, "ply": len(moves), "ponder": ponder, "bestmove": best_move,
+                  "depths": self.get_search_history()}
+        try:
+            os.makedirs(self.search_trace_dir, exist_ok=True)
+            with open(os.path.join(self.search_trace_dir, f"{os.getpid()}.jsonl"), "a") as file:
+                file.write(json.dumps(record, separators=(",", ":")) + "\n")
+        except OSError as error:
+            logger.warning(f"Unable to write search trace: {error}")
+
+    def set_variant_options(self, variant):
+        self.engine.set_variant_options(variant)
+
     def get_opponent_info(self, game):
         pass
 
@@ -124,6 +273,9 @@ class EngineWrapper:
     def ponderhit(self):
         pass
 
+    def reset(self):
+        pass
+
     def stop(self):
         pass
 
@@ -139,7 +291,7 @@ class USIEngine(EngineWrapper):
         commands = commands[0] if len(commands) == 1 else commands
         super(USIEngine, self).__init__(go_commands)
 
-        self.engine = usi.Engine(commands, cwd=cwd)
+        self.engine = self.open_engine(commands, cwd)
         for _ in range(startup_lines): 
             self.engine.recv()
         self.engine.usi()
@@ -149,6 +301,12 @@ class USIEngine(EngineWrapper):
                 self.engine.setoption(name, value)
         self.engine.isready()
 
+    def open_engine(self, commands, cwd):
+        return usi.Engine(commands, cwd=cwd)
+
+    def reset(self):
+        self.engine.isready()
+
     def ponderhit(self):
         self.engine.ponderhit()
 
@@ -172,6 +330,167 @@ class USIEngine(EngineWrapper):
         self.engine.position(game.initial_sfen, moves)
 
 
+class RemoteUSIEngine(USIEngine):
+    """A USI engine hosted by an engine server (engine_ctrl/server.py) on another machine."""
+    def __init__(self, commands, options, go_commands, silence_stderr=False, startup_lines=0, cwd=None, heartbeat=5, timeout=15, token=None):
+        self.heartbeat = heartbeat
+        self.timeout = timeout
+        self.token = token
+        # The server skips the engine's startup lines itself
+        super(RemoteUSIEngine, self).__init__(commands, options, go_commands, silence_stderr, 0, cwd)
+
+    def open_engine(self, address, cwd):
+        return remote.Engine(address, self.heartbeat, self.timeout, None if self.token is None else str(self.token))
+
+    def get_stats(self, stats=None):
+        latency = self.engine.latency()
+        latency_stats = [f"latency: {latency:.1f} ms"] if latency is not None else []
+        return super(RemoteUSIEngine, self).get_stats(stats) + latency_stats
+
+
+class RacingEngine(EngineWrapper):
+    """
+    Searches every position with several engines at once.
+    The "first" policy plays the first answer. The "deepest" and "vote" policies
+    wait up to `deadline` milliseconds after the first answer for the other engines,
+    then play the deepest answer or the move with the most score-weighted votes.
+    """
+    def __init__(self, engines, policy="first", deadline=500):
+        super(RacingEngine, self).__init__({})
+        if policy not in ["first", "deepest", "vote"]:
+            raise ValueError(f"Invalid race policy: {policy}. Expected first, deepest or vote.")
+        self.engines = engines
+        self.engine = engines[0].engine
+        self.policy = policy
+        self.deadline = deadline
+        self.chosen = Counter()
+        self.threads = []
+
+    def search(self, sfen, moves, btime=None, wtime=None, binc=None, winc=None, byo=None, nodes=None, depth=None, movetime=None, ponder=False, stop_condition=None):
+        finished = queue.Queue()
+        threads = []
+        for index, engine in enumerate(self.engines):
+            # A stop condition keeps state between info lines, so only the main engine gets it
+            kwargs = dict(btime=btime, wtime=wtime, binc=binc, winc=winc, byo=byo, nodes=nodes, depth=depth, movetime=movetime, ponder=ponder,
+                          stop_condition=stop_condition if index == 0 else None)
+            thread = threading.Thread(target=self.race, args=(index, engine, finished, sfen, moves, kwargs))
+            thread.start()
+            threads.append(thread)
+        self.threads = threads
+
+        results = {}
+        # An engine that failed answers without a move, so the race goes on until the first real answer
+        while len(results) < len(self.engines):
+            index, result = finished.get()
+            results[index] = result
+            if result[0] is not None:
+                break
+        if self.policy != "first":
+            deadline = time.monotonic() + self.deadline / 1000
+            while len(results) < len(self.engines):
+                try:
+                    index, result = finished.get(timeout=max(0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                results[index] = result
+
+        for index, engine in self.searching_engines():
+            if index not in results:
+                engine.stop()
+        for thread in threads:
+            thread.join()
+
+        results = {index: result for index, result in results.items() if result[0] is not None}
+        if not results:
+            return None, None
+        index, best_move, ponder_move = self.choose(results)
+        self.engine = self.engines[index].engine
+        self.chosen[index] += 1
+        counts = ", ".join(f"{engine.name()}: {self.chosen[i]}" for i, engine in enumerate(self.engines))
+        logger.info(f"Race ({self.policy}) won by {self.engines[index].name()} with {best_move}. Moves chosen: {counts}")
+        return best_move, ponder_move
+
+    def searching_engines(self):
+        """
+        (index, engine) for each engine still racing, once it has been sent `go`: an engine sent
+        `stop` or `ponderhit` before `go` ignores it, and would then search on, maybe forever.
+        """
+        for index, (engine, thread) in enumerate(zip(self.engines, self.threads)):
+            while thread.is_alive() and not engine.wait_searching(0.01):
+                pass
+            if thread.is_alive():
+                yield index, engine
+
+    def race(self, index, engine, finished, sfen, moves, kwargs):
+        try:
+            best_move, ponder_move = engine.search(sfen, moves, **kwargs)
+            finished.put((index, (best_move, ponder_move, dict(engine.get_info()))))
+        except Exception:
+            logger.exception(f"Engine {index} failed during race")
+            finished.put((index, (None, None, {})))
+
+    def choose(self, results):
+        if self.policy == "deepest":
+            index = max(results, key=lambda i: results[i][2].get("depth", 0))
+            return index, results[index][0], results[index][1]
+        if self.policy == "vote":
+            votes = Counter()
+            for best_move, _, info in results.values():
+                votes[best_move] += win_probability(info.get("score"))
+            best_move = votes.most_common(1)[0][0]
+            voters = [i for i in results if results[i][0] == best_move]
+            index = max(voters, key=lambda i: results[i][2].get("depth", 0))
+            return index, best_move, results[index][1]
+        index = next(iter(results))
+        return index, results[index][0], results[index][1]
+
+    def get_stats(self, stats=None):
+        return super(RacingEngine, self).get_stats(stats) + [f"{engine.name()} chosen: {self.chosen[i]}" for i, engine in enumerate(self.engines)]
+
+    def name(self):
+        return " + ".join(engine.name() for engine in self.engines)
+
+    def set_variant_options(self, variant):
+        for engine in self.engines:
+            engine.set_variant_options(variant)
+
+    def get_opponent_info(self, game):
+        for engine in self.engines:
+            engine.get_opponent_info(game)
+
+    def report_game_result(self, game, moves):
+        for engine in self.engines:
+            engine.report_game_result(game, moves)
+
+    def ponderhit(self):
+        for _, engine in self.searching_engines():
+            engine.ponderhit()
+
+    def reset(self):
+        for engine in self.engines:
+            engine.reset()
+
+    def stop(self):
+        for _, engine in self.searching_engines():
+            engine.stop()
+
+    def quit(self):
+        for engine in self.engines:
+            engine.quit()
+
+    def kill_process(self):
+        for engine in self.engines:
+            engine.kill_process()
+
+
+def win_probability(score):
+    if not score:
+        return 0.5
+    if "mate" in score:
+        return 1.0 if score["mate"] > 0 else 0.0
+    return 1 / (1 + 10 ** (-score.get("cp", 0) / 600))
+
+
 def getHomemadeEngine(name):
     import strategies
     return eval(f"strategies.{name}")
@@ -0,0 +1,140 @@
+"""
+Searches run while game processes are free, to have results ready in the search cache.
+"""
+
+import logging
+import threading
+import collections
+import shogi
+import engine_wrapper
+from search_cache import SearchResult, board_key
+
+logger = logging.getLogger(__name__)
+
+
+class StandardGame:
+    # All engine_wrapper needs to search a standard position on its own
+    variant_name = "Standard"
+
+
+class IdleScheduler:
+    """
+    Decides what to search when the bot has free game processes. In order:
+    - the positions where the bot moved in its games that just finished,
+    - the replies the engine expects to the positions it searched (its best move and ponder
+      move), to follow the likely opening lines,
+    - the positions the bot meets most often in the first `max_plies` plies of its games,
+      searched longer each time they come up again, up to `max_movetime`.
+    Results are kept in `results`, a dict shared with the game processes, for at most `size` positions.
+    """
+    def __init__(self, cfg, results):
+        self.results = results
+        self.movetime = cfg.get("movetime", 5000)
+        self.max_movetime = cfg.get("max_movetime", 60000)
+        self.review_movetime = cfg.get("review_movetime", 1000)
+        self.max_plies = cfg.get("max_plies", 30)
+        self.size = cfg.get("size", 2000)
+        self.reviews = collections.deque(maxlen=self.size)
+        self.lines = collections.deque([shogi.STARTING_SFEN], maxlen=self.size)
+        self.counts = collections.Counter()
+        self.sfens = {}
+        self.searched = {}
+        self.stored = collections.OrderedDict()
+        self.retry = None
+
+    def record_game(self, initial_sfen, moves, is_sente):
+        """Counts the positions of a finished standard game where the bot was to move and queues them for review."""
+        board = shogi.Board() if initial_sfen == "startpos" else shogi.Board(initial_sfen)
+        color = shogi.BLACK if is_sente else shogi.WHITE
+        for ply, move in enumerate(moves + [None]):
+            if board.turn == color and not board.is_game_over():
+                sfen = board.sfen()
+                self.reviews.append(sfen)
+                if ply < self.max_plies:
+                    key = board_key(board)
+                    self.counts[key] += 1
+                    self.sfens[key] = sfen
+            if move is not None:
+                board.push_usi(move)
+        if len(self.counts) > 10 * self.size:
+            self.counts = collections.Counter(dict(self.counts.most_common(self.size)))
+            self.sfens = {key: self.sfens[key] for key in self.counts}
+
+    def next_job(self):
+        """The (sfen, movetime) to search next, or None if there is nothing left to do."""
+        if self.retry is not None:
+            job, self.retry = self.retry, None
+            return job
+        if self.reviews:
+            return self.reviews.popleft(), self.review_movetime
+        while self.lines:
+            sfen = self.lines.popleft()
+            if board_key(shogi.Board(sfen)) not in self.searched:
+                return sfen, self.movetime
+        for key, count in self.counts.most_common(self.size):
+            movetime = min(self.max_movetime, self.movetime * count)
+            if count > 1 and self.searched.get(key, 0) < movetime:
+                return self.sfens[key], movetime
+        return None
+
+    def record_result(self, job, result):
+        """Keeps the result of a job. A stopped job is done again next time."""
+        if result is None:
+            return
+        if result["stopped"]:
+            self.retry = job
+            return
+        sfen, movetime = job
+        search = result["result"]
+        key = search["key"]
+        self.searched[key] = max(self.searched.get(key, 0), movetime)
+        if len(self.searched) > 10 * self.size:
+            self.searched = dict(list(self.searched.items())[-self.size:])
+        self.results[key] = search
+        self.stored[key] = None
+        self.stored.move_to_end(key)
+        while len(self.stored) > self.size:
+            old_key, _ = self.stored.popitem(last=False)
+            self.results.pop(old_key, None)
+
+        board = shogi.Board(sfen)
+        if board.move_number <= self.max_plies and search["best_move"] and search["ponder_move"]:
+            try:
+                board.push_usi(search["best_move"])
+                board.push_usi(search["ponder_move"])
+            except ValueError:
+                return
+            self.lines.append(board.sfen())
+
+
+def search_position(config, sfen, movetime, stop_event):
+    """
+    Searches `sfen` for `movetime` ms with an engine of the engine pool, which gets it back at
+    once when `stop_event` (shared with the main process) is set.
+    """
+    if stop_event.is_set():
+        return {"stopped": True}
+    board = shogi.Board(sfen)
+    engine = engine_wrapper.engine_pool.acquire(config)
+    finished = threading.Event()
+    watcher = threading.Thread(target=stop_when_set, args=(engine, stop_event, finished))
+    watcher.start()
+    try:
+        best_move, ponder_move = engine.search_for(board, StandardGame, movetime)
+        info = engine.get_info()
+    finally:
+        finished.set()
+        watcher.join()
+        # The next idle search (or the next game) reuses the engine rather than starting one
+        engine_wrapper.engine_pool.release(config, engine, keep=1)
+    if stop_event.is_set():
+        return {"stopped": True}
+    return {"stopped": False, "result": SearchResult(board_key(board), best_move, ponder_move, info).to_dict()}
+
+
+def stop_when_set(engine, stop_event, finished):
+    # stop_event is a proxy to the main process, so it is checked every 50 ms rather than waited for
+    while not finished.wait(0.05):
+        if stop_event.is_set():
+            engine.stop()
+            return
@@ -0,0 +1,78 @@
+"""
+Entering-king (jishogi) declaration under the 27-point impasse rule.
+"""
+
+import shogi
+
+# The USI move that declares a win by impasse
+DECLARATION = "win"
+
+# Points needed to declare, by color: sente needs 28 and gote 27
+MIN_POINTS = [28, 27]
+MIN_PIECES = 10
+
+BIG_PIECES = {shogi.ROOK, shogi.BISHOP, shogi.PROM_ROOK, shogi.PROM_BISHOP}
+PIECE_POINTS = [0] + [5 if piece_type in BIG_PIECES else 1 for piece_type in shogi.PIECE_TYPES]
+PIECE_POINTS[shogi.KING] = 0
+
+# The three ranks of the opponent's camp, by color
+IN_ZONE = [[rank < 3 for rank in map(shogi.rank_index, shogi.SQUARES)], [rank > 5 for rank in map(shogi.rank_index, shogi.SQUARES)]]
+
+
+class ImpasseTracker:
+    """
+    Keeps the declaration conditions of both players: where their king is, how many of their
+    pieces are in the opponent's camp and their points there and in hand. The board is scanned
+    once by `reset` and `push` then updates the counts from each move before it is played.
+    """
+    def __init__(self, board=None):
+        self.kings = [None, None]
+        self.pieces = [0, 0]
+        self.points = [0, 0]
+        if board is not None:
+            self.reset(board)
+
+    def reset(self, board):
+        for color in shogi.COLORS:
+            self.kings[color] = board.king_squares[color]
+            in_zone = IN_ZONE[color]
+            self.pieces[color] = 0
+            self.points[color] = sum(PIECE_POINTS[piece_type] * count for piece_type, count in board.pieces_in_hand[color].items())
+            for square in shogi.SQUARES:
+                piece = board.piece_at(square)
+                if piece is not None and piece.color == color and piece.piece_type != shogi.KING and in_zone[square]:
+                    self.pieces[color] += 1
+                    self.points[color] += PIECE_POINTS[piece.piece_type]
+
+    def push(self, board, move):
+        """Updates the counts for `move`, which must not have been pushed on `board` yet."""
+        color = board.turn
+        in_zone = IN_ZONE[color]
+        to_square = move.to_square
+        if move.drop_piece_type:
+            # A drop moves points from the hand to the board
+            if in_zone[to_square]:
+                self.pieces[color] += 1
+            else:
+                self.points[color] -= PIECE_POINTS[move.drop_piece_type]
+            return
+        piece_type = board.piece_type_at(move.from_square)
+        if piece_type == shogi.KING:
+            self.kings[color] = to_square
+        elif in_zone[move.from_square] != in_zone[to_square]:
+            change = 1 if in_zone[to_square] else -1
+            self.pieces[color] += change
+            self.points[color] += change * PIECE_POINTS[piece_type]
+        captured = board.piece_type_at(to_square)
+        if captured:
+            self.points[color] += PIECE_POINTS[captured]
+            if IN_ZONE[color ^ 1][to_square]:
+                self.pieces[color ^ 1] -= 1
+                self.points[color ^ 1] -= PIECE_POINTS[captured]
+
+    def can_declare(self, board):
+        """Whether the side to move of `board` wins by declaring now."""
+        color = board.turn
+        king = self.kings[color]
+        return king is not None and IN_ZONE[color][king] and self.pieces[color] >= MIN_PIECES \
+            and self.points[color] >= MIN_POINTS[color] and not board.is_check()
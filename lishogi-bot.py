@@ -1,33 +1,64 @@
+from startup import StartupProfile, lazy_import
+startup_profile = StartupProfile()  # created before the other imports to time them
 import argparse
-import shogi
+import os
 import engine_wrapper
 import model
-import json
+import ndjson
 import lishogi
 import logging
 import logging.handlers
 import multiprocessing
+import multiprocessing.forkserver
 import signal
 import time
 import backoff
 import sys
 import threading
 import random
+import heapq
 import traceback
+import checkpoint
 from config import load_config
 from conversation import Conversation, ChatLine
+from search_cache import SearchCache, SearchResult, PonderStore, position_key
+from time_manager import TimeManager
+from correspondence import CorrespondenceScheduler, NO_DEADLINE
+from timers import timer_service
+from outbox import Outbox
+from log_handlers import GameLog, make_formatter
+from profiler import profiler
 from requests.exceptions import ChunkedEncodingError, ConnectionError, HTTPError, ReadTimeout
-from rich.logging import RichHandler
 import copy
 from collections import defaultdict
 from http.client import RemoteDisconnected
 
+# only game processes use python-shogi, the other processes never load it
+shogi = lazy_import("shogi")
+tsume = lazy_import("tsume")
+impasse = lazy_import("impasse")
+analysis = lazy_import("analysis")
+idle = lazy_import("idle")
+book = lazy_import("book")
+startup_profile.mark("imports")
+
 logger = logging.getLogger(__name__)
 
 __version__ = "1.1.2"
 
 terminated = False
 
+EVENT_STREAM_CONNECT_TIMEOUT = 10
+EVENT_STREAM_IDLE_TIMEOUT = 30
+EVENT_STREAM_MAX_BACKOFF = 60
+
+# game streams get an empty line every few seconds as well, so the game thread sees deadlines that passed soon enough
+GAME_STREAM_CONNECT_TIMEOUT = 10
+GAME_STREAM_IDLE_TIMEOUT = 30
+
+# seconds left on the bot's clock below which replies to chat commands are dropped
+CHAT_TIME_PRESSURE = 10
+
 
 def signal_handler(signal, frame):
     global terminated
@@ -38,6 +69,23 @@ def signal_handler(signal, frame):
 signal.signal(signal.SIGINT, signal_handler)
 
 
+def toggle_profiling(*args):
+    profiler.toggle()
+    if multiprocessing.parent_process() is None and hasattr(signal, "SIGUSR1"):
+        # the main process passes the request on to the game processes
+        for process in multiprocessing.active_children():
+            if "PoolWorker" in process.name:
+                os.kill(process.pid, signal.SIGUSR1)
+
+
+def watch_profiling_signal():
+    if hasattr(signal, "SIGUSR1"):
+        signal.signal(signal.SIGUSR1, toggle_profiling)
+
+
+watch_profiling_signal()
+
+
 def is_final(exception):
     return isinstance(exception, HTTPError) and exception.response.status_code < 500
 
@@ -51,18 +99,48 @@ def upgrade_account(li):
 
 
 def watch_control_stream(control_queue, li):
+    connections = 0
+    failures = 0
     while not terminated:
+        connected_at = None
         try:
-            with li.get_event_stream() as response:
+            # lishogi sends an empty line every few seconds, so a longer silence means the stream stalled
+            with li.get_event_stream(timeout=(EVENT_STREAM_CONNECT_TIMEOUT, EVENT_STREAM_IDLE_TIMEOUT)) as response:
+                if response.status_code != 200:
+                    # an error body is never read as events, the reconnect below backs off (a minute longer when rate limited)
+                    lishogi.rate_limit_check(response)
+                    raise HTTPError(f"Event stream answered with status {response.status_code}", response=response)
+                connections += 1
+                if connections > 1:
+                    logger.info(f"Event stream reconnected ({connections - 1} reconnects)")
+                    reconcile_ongoing_games(control_queue, li)
+                connected_at = time.monotonic()
                 lines = response.iter_lines()
                 for line in lines:
-                    if line:
-                        event = json.loads(line.decode("utf-8"))
-                        control_queue.put_nowait(event)
-                    else:
-                        control_queue.put_nowait({"type": "ping"})
-        except:
-            pass
+                    event = ndjson.decode(line)
+                    control_queue.put_nowait(event if event is not None else {"type": "ping"})
+        except Exception as error:
+            logger.debug(f"Event stream error: {error}")
+        if terminated:
+            break
+        # only a connection that lasted a while resets the backoff
+        if connected_at is not None and time.monotonic() - connected_at > EVENT_STREAM_IDLE_TIMEOUT:
+            failures = 0
+        failures += 1
+        delay = min(EVENT_STREAM_MAX_BACKOFF, 2 ** failures) * random.uniform(0.5, 1)
+        logger.warning(f"Event stream disconnected ({failures} consecutive failures). Reconnecting in {delay:.1f} seconds.")
+        time.sleep(delay)
+
+
+def reconcile_ongoing_games(control_queue, li):
+    # gameStart events sent while the stream was down are lost, so replay them for all ongoing games
+    try:
+        ongoing_games = li.get_ongoing_games()
+    except Exception:
+        logger.warning("Unable to get ongoing games after reconnecting.")
+        return
+    for game in ongoing_games:
+        control_queue.put_nowait({"type": "gameStart", "game": {"id": game["gameId"], "perf": game["perf"], "secondsLeft": game.get("secondsLeft")}})
 
 
 def do_correspondence_ping(control_queue, period):
@@ -71,16 +149,21 @@ def do_correspondence_ping(control_queue, period):
         control_queue.put_nowait({"type": "correspondence_ping"})
 
 
-def logging_configurer(level, filename):
-    console_handler = RichHandler()
-    console_formatter = logging.Formatter("%(message)s")
+def logging_configurer(level, filename, log_format="rich"):
+    if log_format == "rich":
+        from rich.logging import RichHandler
+        console_handler = RichHandler()
+        console_formatter = logging.Formatter("%(message)s")
+    else:
+        # plain and json output are much cheaper to write than rich output
+        console_handler = logging.StreamHandler(sys.stdout)
+        console_formatter = make_formatter(log_format)
     console_handler.setFormatter(console_formatter)
     all_handlers = [console_handler]
 
     if filename:
         file_handler = logging.FileHandler(filename, delay=True)
-        FORMAT = "%(asctime)s %(name)s %(levelname)s %(message)s"
-        file_formatter = logging.Formatter(FORMAT)
+        file_formatter = make_formatter(log_format)
         file_handler.setFormatter(file_formatter)
         all_handlers.append(file_handler)
 
@@ -89,8 +172,8 @@ def logging_configurer(level, filename):
                         force=True)
 
 
-def logging_listener_proc(queue, configurer, level, log_filename):
-    configurer(level, log_filename)
+def logging_listener_proc(queue, configurer, level, log_filename, log_format):
+    configurer(level, log_filename, log_format)
     logger = logging.getLogger()
     while not terminated:
         try:
@@ -100,7 +183,8 @@ def logging_listener_proc(queue, configurer, level, log_filename):
 
 
 def game_logging_configurer(queue, level):
-    if sys.platform == "win32":
+    # processes that were not forked from the main process don't inherit its handlers
+    if not logging.getLogger().handlers:
         h = logging.handlers.QueueHandler(queue)
         root = logging.getLogger()
         root.handlers.clear()
@@ -108,43 +192,136 @@ def game_logging_configurer(queue, level):
         root.setLevel(level)
 
 
+def game_process_context():
+    # a fork server starts game processes from a process that has already imported what they use
+    if "forkserver" not in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context()
+    context = multiprocessing.get_context("forkserver")
+    context.set_forkserver_preload(["__main__", "shogi", "engine_wrapper", "strategies", "tsume", "impasse", "idle", "book", "lishogi", "model", "conversation"])
+    # start it right away, it imports the game modules while the helper processes start
+    multiprocessing.forkserver.ensure_running()
+    return context
+
+
+game_process_state = None
+game_log = None
+
+
+def init_game_process(li, control_queue, user_profile, config, challenge_queue, correspondence_queue, logging_queue, logging_level, idle_results, idle_stop):
+    # everything but the game id stays in the process, along with its HTTP session and warm engines
+    global game_process_state, game_log
+    game_process_state = (li, control_queue, user_profile, config, challenge_queue, correspondence_queue, logging_queue, logging_level, idle_results, idle_stop)
+    game_logging_configurer(logging_queue, logging_level)
+    profiler.directory = config.get("profile_dir", "profiles")
+    watch_profiling_signal()
+    logging_cfg = config.get("logging") or {}
+    if logging_cfg.get("game_buffer", 0) > 0:
+        game_log = GameLog(logging_cfg["game_buffer"], logging_cfg.get("dump_dir", "game_logs"), logging_cfg.get("format", "plain"))
+        game_log.attach(logging_level, [__name__, "engine_wrapper", "engine_ctrl", "strategies", "alphabeta", "tsume", "time_manager",
+                                        "lishogi", "conversation", "outbox", "checkpoint"])
+    # load python-shogi and warm engines before the first game instead of during it
+    shogi.Board
+    engine_wrapper.warm_engines(config)
+
+
+def play_game_in_process(game_id):
+    li, control_queue, user_profile, config, challenge_queue, correspondence_queue, logging_queue, logging_level, idle_results, idle_stop = game_process_state
+    if game_log is not None:
+        game_log.clear()
+    # what was searched while the bot was idle, wherever it ran
+    for result in idle_results.values():
+        search_cache.put(SearchResult.from_dict(result))
+    # the game is counted as done even if it failed after all its retries
+    done = {"type": "free_process", "id": game_id}
+    try:
+        done = play_game(li, game_id, control_queue, user_profile, config, challenge_queue, correspondence_queue, logging_queue, game_logging_configurer, logging_level)
+    except BaseException:
+        if game_log is not None:
+            logger.exception(f"Game {game_id} failed")
+            game_log.dump(game_id, "error")
+        raise
+    finally:
+        control_queue.put_nowait(done)
+
+
+def search_idle_position_in_process(sfen, movetime):
+    li, control_queue, user_profile, config, challenge_queue, correspondence_queue, logging_queue, logging_level, idle_results, idle_stop = game_process_state
+    result = idle.search_position(config, sfen, movetime, idle_stop)
+    if not result["stopped"]:
+        search_cache.put(SearchResult.from_dict(result["result"]))
+    return result
+
+
 def game_error_handler(error):
     logger.error("".join(traceback.format_exception(error)))
 
 
-def start(li, user_profile, config, logging_level, log_filename, one_game=False):
+def start(li, user_profile, config, logging_level, log_filename, one_game=False, profile_startup=False):
     challenge_config = config["challenge"]
     max_games = challenge_config.get("concurrency", 1)
     logger.info(f"You're now connected to {config['url']} and awaiting challenges.")
+    game_context = game_process_context()
+    profiler.directory = config.get("profile_dir", "profiles")
     manager = multiprocessing.Manager()
     challenge_queue = manager.list()
     control_queue = manager.Queue()
     control_stream = multiprocessing.Process(target=watch_control_stream, args=[control_queue, li])
     control_stream.start()
+    startup_profile.mark("manager and stream")
     correspondence_cfg = config.get("correspondence") or {}
     correspondence_checkin_period = correspondence_cfg.get("checkin_period", 600)
     correspondence_pinger = multiprocessing.Process(target=do_correspondence_ping, args=[control_queue, correspondence_checkin_period])
     correspondence_pinger.start()
     correspondence_queue = manager.Queue()
-    correspondence_queue.put("")
+    correspondence_scheduler = CorrespondenceScheduler()
+    correspondence_batch = correspondence_cfg.get("batch", False)
+    if correspondence_batch:
+        correspondence_batch_queue = manager.Queue()
+        correspondence_worker = multiprocessing.Process(target=correspondence_batch_worker, args=[li, config, user_profile, correspondence_batch_queue, control_queue])
+        correspondence_worker.start()
     ongoing_games = li.get_ongoing_games()
+    startup_profile.mark("ongoing games request")
+    correspondence_scheduler.update(ongoing_games)
     startup_correspondence_games = [game["gameId"] for game in ongoing_games if game["perf"] == "correspondence"]
     startup_ponder_games = [game["gameId"] for game in ongoing_games if not game["isMyTurn"]]
-    wait_for_correspondence_ping = False
+    checkpoint_dir = config.get("checkpoint_dir")
+    checkpoint.remove_finished(checkpoint_dir, {game["gameId"] for game in ongoing_games})
+    checkpoints = checkpoint.load_checkpoints(checkpoint_dir)
+    if checkpoints:
+        logger.info(f"Found checkpoints of {len(checkpoints)} ongoing games")
+    # real-time games to resume after a restart, with the time the bot has left for each
+    startup_games = {game["gameId"]: game.get("secondsLeft") for game in ongoing_games if game["perf"] != "correspondence"}
+    resume_games = []
+    starting_games = set()
+    max_engine_starts = config.get("max_engine_starts", 2)
 
     busy_processes = 0
     queued_processes = 0
+    active_games = set()
+    idle_cfg = config.get("idle_analysis") or {}
+    idle_results = manager.dict()
+    idle_stop = manager.Event()
+    idle_scheduler = idle.IdleScheduler(idle_cfg, idle_results) if idle_cfg.get("enabled", False) else None
+    idle_job = None
 
 
     logging_queue = manager.Queue()
-    logging_listener = multiprocessing.Process(target=logging_listener_proc, args=(logging_queue, logging_configurer, logging_level, log_filename))
+    log_format = (config.get("logging") or {}).get("format", "rich")
+    logging_listener = multiprocessing.Process(target=logging_listener_proc, args=(logging_queue, logging_configurer, logging_level, log_filename, log_format))
     logging_listener.start()
-
-    with multiprocessing.pool.Pool(max_games + 1) as pool:
+    startup_profile.mark("helper processes")
+
+    game_process_args = [li, control_queue, user_profile, config, challenge_queue, correspondence_queue, logging_queue, logging_level, idle_results, idle_stop]
+    if idle_scheduler is not None:
+        control_queue.put_nowait({"type": "idle"})
+    with multiprocessing.pool.Pool(max_games + 1, initializer=init_game_process, initargs=game_process_args, context=game_context) as pool:
+        startup_profile.mark("game processes")
+        if profile_startup:
+            logger.info(startup_profile.report())
         while not terminated:
             try:
                 event = control_queue.get()
-                logger.debug(f"Event: {event}")
+                logger.debug("Event: %s", event)
             except InterruptedError:
                 continue
 
@@ -155,13 +332,44 @@ def start(li, user_profile, config, logging_level, log_filename, one_game=False)
                     logger.warning('Please check that the API access token for your bot has the scope "Play games with the bot API" (bot:play).')
                 continue
 
+            if event["type"] in ["challenge", "gameStart"] and idle_job is not None:
+                # games come first, the idle search gives its engine back right away
+                idle_stop.set()
+
             if event["type"] == "terminated":
                 break
             elif event["type"] == "free_process":
                 busy_processes -= 1
+                active_games.discard(event.get("id"))
+                starting_games.discard(event.get("id"))
                 logger.info(f"+++ Process Free. Total Queued: {queued_processes}. Total Used: {busy_processes}")
+                if idle_scheduler is not None and event.get("moves") is not None:
+                    idle_scheduler.record_game(event["initial_sfen"], event["moves"], event["is_sente"])
+                # correspondence games the bot disconnected from wait for the opponent's move
+                while not correspondence_queue.empty():
+                    correspondence_scheduler.wait(correspondence_queue.get_nowait())
+                # a correspondence game that ended or failed is scheduled again by the next update if it is still going on
+                correspondence_scheduler.done(event.get("id"))
                 if one_game:
                     break
+            elif event["type"] == "toggle_profiling":
+                toggle_profiling()
+            elif event["type"] == "idle_result":
+                busy_processes -= 1
+                idle_scheduler.record_result(idle_job, event["result"])
+                idle_job = None
+                idle_stop.clear()
+            elif event["type"] == "engine_started":
+                starting_games.discard(event["id"])
+            elif event["type"] == "correspondence_move":
+                correspondence_scheduler.wait(event["id"])
+            elif event["type"] == "correspondence_ping":
+                try:
+                    correspondence_scheduler.update(li.get_ongoing_games())
+                except (HTTPError, ReadTimeout, ConnectionError):
+                    logger.warning("Unable to check in on correspondence games.")
+                if idle_job is not None and not correspondence_batch and correspondence_scheduler.has_due_games():
+                    idle_stop.set()
             elif event["type"] == "challenge":
                 chlng = model.Challenge(event["challenge"])
                 if chlng.is_supported(challenge_config):
@@ -177,45 +385,68 @@ def start(li, user_profile, config, logging_level, log_filename, one_game=False)
                     except:
                         pass
             elif event["type"] == "gameStart":
-                game_id = event["game"]["id"]
+                game = event["game"]
+                game_id = game["id"]
                 # future work: do not ponder using play_game if pondering is disabled
                 engine_cfg = config["engine"]
-                if busy_processes >= max_games or (engine_can_ponder(correspondence_cfg, engine_cfg, game_id in startup_correspondence_games) and game_id in startup_ponder_games):
+                is_correspondence = game_id in startup_correspondence_games or game.get("perf") == "correspondence"
+                # the idle search was stopped above, so its process doesn't keep the game waiting
+                at_capacity = busy_processes - (idle_job is not None) >= max_games
+                can_ponder = engine_can_ponder(correspondence_cfg, engine_cfg, is_correspondence) and game_id in startup_ponder_games
+                action = game_start_action(game_id, is_correspondence, active_games, correspondence_scheduler, startup_games,
+                                           startup_correspondence_games, at_capacity, can_ponder)
+                if action == "ignore":
+                    # the event stream repeats gameStart for ongoing games when it reconnects
+                    logger.debug(f"Already playing {config['url'] + game_id}")
+                elif action == "scheduled":
+                    # the scheduler starts correspondence games once it is the bot's turn
+                    logger.info(f'--- Enqueue {config["url"] + game_id}')
+                elif action == "resume":
+                    # resumed below, the game with the least time left first
+                    seconds_left = startup_games.pop(game_id, None)
+                    if seconds_left is None:
+                        seconds_left = (checkpoints.get(game_id) or {}).get("seconds_left", game.get("secondsLeft", NO_DEADLINE))
+                    if queued_processes > 0:
+                        queued_processes -= 1
+                    logger.info(f'--- Resume {config["url"] + game_id} ({seconds_left} seconds left)')
+                    push_resumed_game(resume_games, active_games, game_id, seconds_left)
+                elif action == "wait":
                     # if during error recovery too many games are in progress, do not panic
                     logger.info(f'--- Enqueue {config["url"] + game_id}')
                     if game_id not in startup_correspondence_games:
                         startup_correspondence_games.append(game_id)
-                elif game_id in startup_correspondence_games:
+                elif action == "schedule":
                     logger.info(f'--- Enqueue {config["url"] + game_id}')
-                    correspondence_queue.put(game_id)
+                    correspondence_scheduler.push(game_id)
                     startup_correspondence_games.remove(game_id)
                 else:
                     if queued_processes > 0:
                         queued_processes -= 1
                     busy_processes += 1
                     logger.info(f"--- Process Used. Total Queued: {queued_processes}. Total Used: {busy_processes}")
-                    pool.apply_async(play_game, [li, game_id, control_queue, user_profile, config, challenge_queue, correspondence_queue, logging_queue, game_logging_configurer, logging_level], error_callback=game_error_handler)
-
-            is_correspondence_ping = event["type"] == "correspondence_ping"
-            is_free_process = event["type"] == "free_process"
-            if (is_correspondence_ping or (is_free_process and not wait_for_correspondence_ping)) and not challenge_queue:
-                if is_correspondence_ping and wait_for_correspondence_ping:
-                    correspondence_queue.put("")
-
-                wait_for_correspondence_ping = False
-                while (busy_processes + queued_processes) < max_games:
-                    game_id = correspondence_queue.get()
-                    # stop checking in on games if we have checked in on all games since the last correspondence_ping
-                    if not game_id:
-                        if is_correspondence_ping and not correspondence_queue.empty():
-                            correspondence_queue.put("")
-                        else:
-                            wait_for_correspondence_ping = True
-                            break
-                    else:
-                        busy_processes += 1
-                        logger.info(f"--- Process Used. Total Queued: {queued_processes}. Total Used: {busy_processes}")
-                        pool.apply_async(play_game, [li, game_id, control_queue, user_profile, config, challenge_queue, correspondence_queue, logging_queue, game_logging_configurer, logging_level], error_callback=game_error_handler)
+                    active_games.add(game_id)
+                    pool.apply_async(play_game_in_process, [game_id], error_callback=game_error_handler)
+
+            # limit how many engines start at once after a restart
+            while resume_games and len(starting_games) < max_engine_starts and (busy_processes + queued_processes) < max_games:
+                _, game_id = heapq.heappop(resume_games)
+                busy_processes += 1
+                logger.info(f"--- Process Used. Total Queued: {queued_processes}. Total Used: {busy_processes}")
+                starting_games.add(game_id)
+                pool.apply_async(play_game_in_process, [game_id], error_callback=game_error_handler)
+
+            if correspondence_batch:
+                # the batch worker searches one game after another without using game processes
+                while correspondence_scheduler.has_due_games():
+                    correspondence_batch_queue.put(correspondence_scheduler.pop())
+            elif event["type"] in ["correspondence_ping", "free_process", "idle_result"] and not challenge_queue:
+                # most urgent games first, only those where it is the bot's turn
+                while (busy_processes + queued_processes) < max_games and correspondence_scheduler.has_due_games():
+                    game_id = correspondence_scheduler.pop()
+                    busy_processes += 1
+                    logger.info(f"--- Process Used. Total Queued: {queued_processes}. Total Used: {busy_processes}")
+                    active_games.add(game_id)
+                    pool.apply_async(play_game_in_process, [game_id], error_callback=game_error_handler)
 
             while (queued_processes + busy_processes) < max_games and challenge_queue:  # keep processing the queue until empty or max_games is reached
                 chlng = challenge_queue.pop(0)
@@ -229,6 +460,16 @@ def start(li, user_profile, config, logging_level, log_filename, one_game=False)
                         logger.info(f"Skip missing {chlng}")
                     queued_processes -= 1
 
+            if idle_scheduler is not None and idle_job is None and not challenge_queue and not resume_games and (busy_processes + queued_processes) < max_games \
+                    and (correspondence_batch or not correspondence_scheduler.has_due_games()):
+                idle_job = idle_scheduler.next_job()
+                if idle_job is not None:
+                    busy_processes += 1
+                    logger.debug("Idle search: %s", idle_job)
+                    pool.apply_async(search_idle_position_in_process, idle_job,
+                                     callback=lambda result: control_queue.put_nowait({"type": "idle_result", "result": result}),
+                                     error_callback=lambda error: (game_error_handler(error), control_queue.put_nowait({"type": "idle_result", "result": None})))
+
             control_queue.task_done()
 
     logger.info("Terminated")
@@ -236,11 +477,46 @@ def start(li, user_profile, config, logging_level, log_filename, one_game=False)
     control_stream.join()
     correspondence_pinger.terminate()
     correspondence_pinger.join()
+    if correspondence_batch:
+        correspondence_batch_queue.put(None)
+        correspondence_worker.join(10)
+        correspondence_worker.terminate()
     logging_listener.terminate()
     logging_listener.join()
 
 
-ponder_results = {}
+ponder_results = PonderStore()
+outbox = None
+search_cache = SearchCache()
+
+
+def game_start_action(game_id, is_correspondence, active_games, correspondence_scheduler, startup_games, startup_correspondence_games, at_capacity, can_ponder):
+    """
+    What to do with a gameStart event:
+    - "ignore" a game that is already played,
+    - "scheduled" for a correspondence game the scheduler knows,
+    - "resume" a real-time game that was ongoing at startup, or that can't get a process yet,
+    - "wait" for a correspondence game that can't be played now, to schedule it later,
+    - "schedule" a correspondence game that was waited for,
+    - "play" any other game at once.
+    """
+    if game_id in active_games:
+        return "ignore"
+    if game_id in correspondence_scheduler:
+        return "scheduled"
+    if not is_correspondence and (game_id in startup_games or at_capacity):
+        return "resume"
+    if is_correspondence and (at_capacity or can_ponder):
+        return "wait"
+    if game_id in startup_correspondence_games:
+        return "schedule"
+    return "play"
+
+
+def push_resumed_game(resume_games, active_games, game_id, seconds_left):
+    # the game counts as played from now on, so that the gameStart repeated when the event stream reconnects doesn't start it twice
+    heapq.heappush(resume_games, (seconds_left, game_id))
+    active_games.add(game_id)
 
 
 def engine_can_ponder(correspondence_cfg, engine_cfg, is_correspondence):
@@ -253,145 +529,296 @@ def play_game(li, game_id, control_queue, user_profile, config, challenge_queue,
     game_logging_configurer(logging_queue, logging_level)
     logger = logging.getLogger(__name__)
 
-    response = li.get_game_stream(game_id)
+    response = li.get_game_stream(game_id, timeout=(GAME_STREAM_CONNECT_TIMEOUT, GAME_STREAM_IDLE_TIMEOUT))
     lines = response.iter_lines()
 
     # Initial response of stream will be the full game info. Store it
-    initial_state = json.loads(next(lines).decode("utf-8"))
+    initial_state = ndjson.decode(next(lines))
     logger.debug(initial_state)
     game = model.Game(initial_state, user_profile["username"], li.baseUrl, config.get("abort_time", 20))
 
-    engine = engine_wrapper.create_engine(config)
-    engine.get_opponent_info(game)
-    conversation = Conversation(game, engine, li, __version__, challenge_queue)
-
-    logger.info(f"+++ Playing {game}")
-
-    is_correspondence = game.perf_name == "Correspondence"
-    correspondence_cfg = config.get("correspondence") or {}
-    correspondence_move_time = correspondence_cfg.get("move_time", 60) * 1000
-
-    engine_cfg = config["engine"]
-    can_ponder = engine_can_ponder(correspondence_cfg, engine_cfg, is_correspondence)
-    move_overhead = config.get("move_overhead", 1000)
-    delay_seconds = config.get("rate_limiting_delay", 0)/1000
-    online_moves_cfg = engine_cfg.get("online_moves", {})
-
+    checkpoint_dir = config.get("checkpoint_dir")
+    game_checkpoint = checkpoint.GameCheckpoint(checkpoint_dir, game.id) if checkpoint_dir else None
+    saved_state = (game_checkpoint.load() if game_checkpoint else None) or {}
+    for result in saved_state.get("results", []):
+        search_cache.put(SearchResult.from_dict(result))
+    if saved_state:
+        logger.info(f"Resuming {game.url()} from its checkpoint with {len(saved_state['results'])} search results")
+
+    engine_profile = engine_wrapper.choose_profile(config, game)
+    if saved_state.get("profile") in (config.get("engine_profiles") or {}):
+        # keep playing with the engine the game was started with
+        engine_profile = saved_state["profile"]
+    engine = engine_wrapper.engine_pool.acquire(config, engine_profile)
     ponder_thread = None
-    ponder_usi = None
-
-    logger.debug(f"Game state: {game.state}")
-
-    greeting_cfg = config.get("greeting") or {}
-    keyword_map = defaultdict(str, me=game.me.name, opponent=game.opponent.name)
-    get_greeting = lambda greeting: str(greeting_cfg.get(greeting) or "").format_map(keyword_map)
-    hello = get_greeting("hello")
-    goodbye = get_greeting("goodbye")
-
-    first_move = True
-    correspondence_disconnect_time = 0
-
-    while not terminated:
-        move_attempted = False
-        try:
-            if first_move:
-                upd = game.state
-                first_move = False
-            else:
-                binary_chunk = next(lines)
-                upd = json.loads(binary_chunk.decode("utf-8")) if binary_chunk else None
-
-            logger.debug(f"Update: {upd}")
-            u_type = upd["type"] if upd else "ping"
-            if u_type == "chatLine":
-                conversation.react(ChatLine(upd), game)
-            elif u_type == "gameState":
-                game.state = upd
-                if is_game_over(game):
-                    if game.variant_name == "Kyoto shogi":
-                        engine.report_game_result(game, game.state["fairyMoves"].split(" "))
-                    else:
-                        engine.report_game_result(game, game.state["moves"].split(" "))
-                    tell_user_game_result(game)
-                    conversation.send_message("player", goodbye)
-                    break
-
-                board = setup_board(game)
-                if is_engine_move(game, board):
-                    if len(board.move_stack) < 2:
-                        conversation.send_message("player", hello)
-                    else:
-                        if game.variant_name == "Kyoto shogi":
-                            print_move_number(game.state["fairyMoves"])
+    mate_search = None
+    global outbox
+    try:
+        control_queue.put_nowait({"type": "engine_started", "id": game_id})
+        engine.get_opponent_info(game)
+        if outbox is None:
+            # chat messages are posted on their own session, never in the way of the game's requests
+            chat_li = lishogi.Lishogi(config["token"], config["url"], __version__, logging_level)
+            chat_li.set_user_agent(user_profile["username"])
+            outbox = Outbox(chat_li)
+        conversation = Conversation(game, engine, outbox, __version__, challenge_queue, config.get("admins") or [],
+                                    lambda: control_queue.put_nowait({"type": "toggle_profiling"}))
+
+        logger.info(f"+++ Playing {game}{f' with engine profile {engine_profile}' if engine_profile else ''}")
+
+        is_correspondence = game.perf_name == "Correspondence"
+        correspondence_cfg = config.get("correspondence") or {}
+        correspondence_move_time = correspondence_cfg.get("move_time", 60) * 1000
+
+        engine_cfg = engine_wrapper.get_engine_cfg(config, engine_profile)
+        can_ponder = engine_can_ponder(correspondence_cfg, engine_cfg, is_correspondence)
+        move_overhead = config.get("move_overhead", 1000)
+        delay_seconds = config.get("rate_limiting_delay", 0)/1000
+        online_moves_cfg = engine_cfg.get("online_moves", {})
+        search_cache_cfg = engine_cfg.get("search_cache") or {}
+        search_cache.max_size = search_cache_cfg.get("size", 10000)
+        search_cache_min_depth = search_cache_cfg.get("min_depth", 20)
+        search_cache_low_time = search_cache_cfg.get("low_time", 1000)
+        time_manager_cfg = config.get("time_manager") or {}
+        time_manager = TimeManager(time_manager_cfg, move_overhead, correspondence_move_time) if time_manager_cfg.get("enabled", False) else None
+        tsume_cfg = engine_cfg.get("tsume") or {}
+        mate_solver = tsume.MateSolver(tsume_cfg.get("size", 200000)) if tsume_cfg.get("enabled", False) and game.variant_name == "Standard" else None
+        impasse_tracker = impasse.ImpasseTracker() if engine_cfg.get("declare_impasse", True) and game.variant_name == "Standard" else None
+        opening_book_cfg = config.get("opening_book") or {}
+        opening_book = book.OpeningBook(opening_book_cfg) if opening_book_cfg.get("enabled", False) and game.variant_name == "Standard" else None
+        if opening_book is not None:
+            opening_book.compile()
+
+        ponder_usi = None
+
+        logger.debug("Game state: %s", game.state)
+
+        greeting_cfg = config.get("greeting") or {}
+        keyword_map = defaultdict(str, me=game.me.name, opponent=game.opponent.name)
+        get_greeting = lambda greeting: str(greeting_cfg.get(greeting) or "").format_map(keyword_map)
+        hello = get_greeting("hello")
+        goodbye = get_greeting("goodbye")
+
+        first_move = True
+        correspondence_disconnect_time = 0
+        board = None
+        # the timers end the read of the game stream at once, this thread then leaves (and aborts) the game
+        stream_closed = threading.Event()
+        abort_requested = threading.Event()
+
+        def close_stream():
+            stream_closed.set()
+            lishogi.shutdown_stream(response)
+
+        def abort_game():
+            if game.should_abort_now():
+                logger.info(f"Aborting {game.url()} by lack of activity")
+                abort_requested.set()
+                close_stream()
+
+        def terminate_game():
+            if game.should_terminate_now():
+                logger.info(f"Terminating {game.url()} by lack of activity")
+                if game.is_abortable():
+                    abort_requested.set()
+                close_stream()
+
+        def disconnect_game():
+            if is_correspondence and board is not None and not is_engine_move(game, board) and game.should_disconnect_now():
+                close_stream()
+
+        # deadlines are checked on time even if the game stream stops sending anything
+        game.watch(timer_service, abort_game, terminate_game, disconnect_game)
+
+        while not terminated and not stream_closed.is_set():
+            move_attempted = False
+            try:
+                if first_move:
+                    upd = initial_state["state"]
+                    first_move = False
+                else:
+                    binary_chunk = next(lines)
+                    upd = ndjson.decode(binary_chunk)
+
+                logger.debug("Update: %s", upd)
+                u_type = upd["type"] if upd else "ping"
+                if u_type == "chatLine":
+                    conversation.react(ChatLine(upd), game)
+                elif u_type == "gameState":
+                    game.state.update(upd)
+                    outbox.set_time_pressure(game.id, game.my_remaining_seconds() + game.state.byo / 1000 < CHAT_TIME_PRESSURE)
+                    if is_game_over(game):
+                        engine.report_game_result(game, game.moves())
+                        tell_user_game_result(game)
+                        conversation.send_message("player", goodbye)
+                        break
+
+                    board = update_board(game, board, impasse_tracker)
+                    if is_engine_move(game, board):
+                        if len(board.move_stack) < 2:
+                            conversation.send_message("player", hello)
                         else:
-                            print_move_number(game.state["moves"])
-                    start_time = time.perf_counter_ns()
-                    fake_thinking(config, board, game)
-                    correspondence_disconnect_time = correspondence_cfg.get("disconnect_time", 300)
-
-                    if len(board.move_stack) < 2:
-                        # need to hardcode first movetime since Lishogi has 30 sec limit
-                        best_move, ponder_move = choose_move_time(engine, board, game, 1000)
-                    elif is_correspondence:
-                        best_move, ponder_move = choose_move_time(engine, board, game, correspondence_move_time)
-                    else:
-                        best_move, ponder_move = get_pondering_result(engine, game, board.move_stack, ponder_thread, ponder_usi)
-                        move_attempted = True
-                        if best_move is None:
-                            best_move, ponder_move = play_midgame_move(engine, board, upd["btime"], upd["wtime"], move_overhead, start_time, logger, game)
+                            print_move_number(game.moves())
+                        start_time = time.perf_counter_ns()
+                        stop_mate_search(mate_search)
+                        fake_thinking(config, board, game)
+                        correspondence_disconnect_time = correspondence_cfg.get("disconnect_time", 300)
+
+                        book_move = get_book_move(opening_book, board)
+                        managed_search = False
+                        if impasse_tracker is not None and impasse_tracker.can_declare(board):
+                            best_move, ponder_move = get_impasse_declaration(board, impasse_tracker)
+                        elif book_move is not None:
+                            best_move, ponder_move = book_move, None
+                        elif time_manager is not None and (len(board.move_stack) < 2 or is_correspondence):
+                            best_move, ponder_move = play_managed_move(engine, board, game, time_manager, start_time)
+                            managed_search = True
+                        elif len(board.move_stack) < 2:
+                            # need to hardcode first movetime since Lishogi has 30 sec limit
+                            best_move, ponder_move = choose_move_time(engine, board, game, 1000)
+                        elif is_correspondence:
+                            best_move, ponder_move = choose_move_time(engine, board, game, correspondence_move_time)
+                        else:
+                            best_move, ponder_move = get_pondering_result(engine, game, board.move_stack, ponder_thread, ponder_usi)
+                            move_attempted = True
                             if best_move is None:
-                                best_move, ponder_move = get_online_move(li, board, game, online_moves_cfg)
-                    li.make_move(game.id, best_move)
-                    if can_ponder:
-                        ponder_thread, ponder_usi = start_pondering(engine, board, best_move, ponder_move, upd["btime"], upd["wtime"], game, logger, move_overhead, start_time, can_ponder)
-                    time.sleep(delay_seconds)
-                elif len(board.move_stack) == 0:
-                    correspondence_disconnect_time = correspondence_cfg.get("disconnect_time", 300)
-
-                bw = "b" if board.turn == shogi.BLACK else "w"
-                game.ping(config.get("abort_time", 30), (upd[f"{bw}time"] + upd[f"{bw}inc"] + upd["byo"]) / 1000 + 60, correspondence_disconnect_time)
-
-            elif u_type == "ping":
-                if is_correspondence and not is_engine_move(game, board) and game.should_disconnect_now():
-                    break
-                elif game.should_abort_now():
-                    logger.info(f"Aborting [{game.url()}] by lack of activity")
-                    li.abort(game.id)
+                                best_move, ponder_move = get_cached_move(game, board, search_cache_min_depth)
+                            if best_move is None and search_cache_low_time:
+                                best_move, ponder_move = get_low_time_move(game, board, search_cache_low_time + move_overhead)
+                            if best_move is None and mate_solver is not None:
+                                best_move, ponder_move = get_mate_move(mate_solver, board, tsume_cfg)
+                            if best_move is None:
+                                if time_manager is not None:
+                                    best_move, ponder_move = play_managed_move(engine, board, game, time_manager, start_time)
+                                    managed_search = True
+                                else:
+                                    best_move, ponder_move = play_midgame_move(engine, board, game.state.btime, game.state.wtime, move_overhead, start_time, logger, game)
+                                if best_move is None:
+                                    best_move, ponder_move = get_online_move(li, board, game, online_moves_cfg)
+                                search_cache.put(SearchResult(position_key(game, board), best_move, ponder_move, engine.get_info()))
+                        with outbox.sending_move(game.id):
+                            li.make_move(game.id, best_move)
+                        if managed_search:
+                            time_manager.record_move(game, board, start_time, engine.get_info())
+                        elif time_manager is not None:
+                            # The clock lag is only measured after moves the time manager planned
+                            time_manager.skip_move()
+                        if game_checkpoint is not None:
+                            write_checkpoint(game_checkpoint, game, engine_profile)
+                        if can_ponder:
+                            ponder_thread, ponder_usi = start_pondering(engine, board, best_move, ponder_move, game.state.btime, game.state.wtime, game, logger, move_overhead, start_time, can_ponder, game_checkpoint)
+                        if mate_solver is not None:
+                            mate_search = start_mate_search(mate_solver, board, best_move, ponder_move, tsume_cfg)
+                        time.sleep(delay_seconds)
+                    elif len(board.move_stack) == 0:
+                        correspondence_disconnect_time = correspondence_cfg.get("disconnect_time", 300)
+
+                    bw = "b" if board.turn == shogi.BLACK else "w"
+                    game.ping(config.get("abort_time", 30), (game.state.time(bw) + game.state.inc(bw) + game.state.byo) / 1000 + 60, correspondence_disconnect_time)
+            except (HTTPError, ReadTimeout, RemoteDisconnected, ChunkedEncodingError, ConnectionError):
+                if stream_closed.is_set():
                     break
-                elif game.should_terminate_now():
-                    logger.info(f"Terminating {game.url()} by lack of activity")
-                    if game.is_abortable():
-                        li.abort(game.id)
+                if move_attempted:
+                    continue
+                if game.id not in (ongoing_game["gameId"] for ongoing_game in li.get_ongoing_games()):
                     break
-        except (HTTPError, ReadTimeout, RemoteDisconnected, ChunkedEncodingError, ConnectionError):
-            if move_attempted:
-                continue
-            if game.id not in (ongoing_game["gameId"] for ongoing_game in li.get_ongoing_games()):
+                # the stream can't be read after an error, a new one starts with the whole game to catch up from
+                response.close()
+                response = li.get_game_stream(game_id, timeout=(GAME_STREAM_CONNECT_TIMEOUT, GAME_STREAM_IDLE_TIMEOUT))
+                lines = response.iter_lines()
+                initial_state = ndjson.decode(next(lines))
+                first_move = True
+            except StopIteration:
                 break
-        except StopIteration:
-            break
-
-    engine.stop()
-    engine.quit()
+    finally:
+        # also after an error, before play_game is retried
+        game.unwatch()
+        response.close()
+        if outbox is not None:
+            outbox.set_time_pressure(game.id, False)
+        engine.stop()
+        if ponder_thread is not None:
+            ponder_thread.join()
+        stop_mate_search(mate_search)
+        engine_wrapper.engine_pool.release(config, engine, engine_profile)
+        ponder_results.clear(game.id)
 
-    if ponder_thread is not None:
-        ponder_thread.join()
+    if abort_requested.is_set():
+        try:
+            li.abort(game.id)
+        except (HTTPError, ReadTimeout, RemoteDisconnected, ChunkedEncodingError, ConnectionError):
+            logger.warning(f"Unable to abort {game.url()}")
 
-    engine.kill_process()
+    if opening_book is not None:
+        if is_game_over(game):
+            opening_book.record_game(game)
+        opening_book.close()
 
     if is_game_over(game):
         logger.info(f"--- {game.url()} Game over")
+        if game_log is not None and game.state.status == engine_wrapper.Termination.TIMEOUT and game.state.winner == game.opponent_color:
+            game_log.dump(game.id, "flagged")
+        if game_checkpoint is not None:
+            game_checkpoint.remove()
     elif is_correspondence:
         logger.info(f"--- Disconnecting from {game.url()}")
         correspondence_queue.put(game_id)
 
-    control_queue.put_nowait({"type": "free_process"})
+    if is_game_over(game) and game.variant_name == "Standard":
+        # the idle analysis reviews finished games
+        return {"type": "free_process", "id": game_id, "initial_sfen": game.initial_sfen, "moves": list(game.state.moves), "is_sente": game.is_sente}
+    return {"type": "free_process", "id": game_id}
+
+
+def write_checkpoint(game_checkpoint, game, engine_profile):
+    # the moves are replayed from the game stream, only what orders and sets up the resumed games is kept
+    game_checkpoint.append({"seconds_left": game.my_remaining_seconds(), "profile": engine_profile, "written_at": time.time()})
+
+
+def correspondence_batch_worker(li, config, user_profile, batch_queue, control_queue):
+    correspondence_cfg = config.get("correspondence") or {}
+    move_time = correspondence_cfg.get("move_time", 60) * 1000
+    engines = {}
+
+    while not terminated:
+        game_id = batch_queue.get()
+        if game_id is None:
+            break
+        try:
+            # Only the initial game state is needed, so the stream is closed right away
+            with li.get_game_stream(game_id) as response:
+                initial_state = ndjson.decode(next(response.iter_lines()))
+            game = model.Game(initial_state, user_profile["username"], li.baseUrl, config.get("abort_time", 20))
+            board = setup_board(game)
+            if is_game_over(game) or not is_engine_move(game, board):
+                logger.info(f"--- {game.url()} No move needed")
+            else:
+                profile = engine_wrapper.choose_profile(config, game)
+                if profile not in engines:
+                    engines[profile] = engine_wrapper.engine_pool.acquire(config, profile)
+                logger.info(f"+++ Searching {game}")
+                best_move, ponder_move = choose_move_time(engines[profile], board, game, move_time)
+                li.make_move(game.id, best_move)
+        except Exception:
+            logger.exception(f"Unable to play correspondence game {game_id}")
+        control_queue.put_nowait({"type": "correspondence_move", "id": game_id})
+
+    for profile, engine in engines.items():
+        engine.quit()
+        engine.kill_process()
 
 
 def play_midgame_move(engine, board, btime, wtime, move_overhead, start_time, logger, game):
     btime, wtime = adjust_game_time(btime, wtime, board, move_overhead, start_time)
     logger.info(f"Searching for btime {btime} wtime {wtime}")
-    best_move, ponder_move = engine.search_with_ponder(game, board, btime, wtime, game.state["binc"], game.state["winc"], game.state["byo"])
+    best_move, ponder_move = engine.search_with_ponder(game, board, btime, wtime, game.state.binc, game.state.winc, game.state.byo)
+    return best_move, ponder_move
+
+
+def play_managed_move(engine, board, game, time_manager, start_time):
+    budget = time_manager.plan(game, board, start_time)
+    best_move, ponder_move = engine.search_with_budget(game, board, budget)
+    logger.info(f"Searched {budget.elapsed()} ms of budget {budget}")
     return best_move, ponder_move
 
 
@@ -403,7 +830,7 @@ def adjust_game_time(btime, wtime, board, move_overhead, start_time, binc=0, win
     return btime, wtime
 
 
-def start_pondering(engine, board, best_move, ponder_move, btime, wtime, game, logger, move_overhead, start_time, can_ponder):
+def start_pondering(engine, board, best_move, ponder_move, btime, wtime, game, logger, move_overhead, start_time, can_ponder, game_checkpoint=None):
     if not can_ponder or ponder_move is None:
         return None, None
     ponder_board = copy.deepcopy(board)
@@ -414,16 +841,20 @@ def start_pondering(engine, board, best_move, ponder_move, btime, wtime, game, l
         ponder_board.push(shogi.Move.null())
         ponder_board.push(shogi.Move.null())
     ponder_usi = ponder_move
+    ponder_key = position_key(game, ponder_board)
 
-    btime, wtime = adjust_game_time(btime, wtime, board, move_overhead, start_time, game.state["winc"], game.state["binc"], game.state["byo"])
+    btime, wtime = adjust_game_time(btime, wtime, board, move_overhead, start_time, game.state.winc, game.state.binc, game.state.byo)
     logger.info(f"Pondering {ponder_move} for btime {btime} wtime {wtime}")
 
-    def ponder_thread_func(game, engine, board, btime, wtime, binc, winc, byo):
-        global ponder_results
+    def ponder_thread_func(game, engine, board, key, btime, wtime, binc, winc, byo):
         best_move, ponder_move = engine.search_with_ponder(game, board, btime, wtime, binc, winc, byo, True)
-        ponder_results[game.id] = (best_move, ponder_move)
+        result = SearchResult(key, best_move, ponder_move, engine.get_info())
+        ponder_results.put(game.id, result)
+        # a search that ended before the opponent moved (e.g. it found a mate) is what a restarted bot can still play
+        if game_checkpoint is not None and key is not None and best_move is not None and len(game.state.moves) < len(board.move_stack):
+            game_checkpoint.append({"results": [result.to_dict()]})
 
-    ponder_thread = threading.Thread(target=ponder_thread_func, args=(game, engine, ponder_board, btime, wtime, game.state["binc"], game.state["winc"], game.state["byo"]))
+    ponder_thread = threading.Thread(target=ponder_thread_func, args=(game, engine, ponder_board, ponder_key, btime, wtime, game.state.binc, game.state.winc, game.state.byo))
     ponder_thread.start()
     return ponder_thread, ponder_usi
 
@@ -433,18 +864,98 @@ def get_pondering_result(engine, game, moves, ponder_thread, ponder_usi):
         return None, None
 
     if ponder_usi == moves[-1].usi():
-        engine.ponderhit()
+        # The engine may already have answered, e.g. after finding a mate or reaching its depth limit
+        if ponder_thread.is_alive():
+            engine.ponderhit()
+        else:
+            logger.info(f"Ponder search already finished: {ponder_results.get(game.id)}")
         ponder_thread.join()
-        return ponder_results[game.id]
+        result = ponder_results.pop(game.id)
+        if result is None:
+            return None, None
+        search_cache.put(result)
+        return result.moves()
     else:
-        engine.stop()
+        if ponder_thread.is_alive():
+            engine.stop()
         ponder_thread.join()
+        # Keep the partial search in case the position is reached later
+        search_cache.put(ponder_results.pop(game.id))
         return None, None
 
 
+def get_cached_move(game, board, min_depth):
+    if not min_depth:
+        return None, None
+    result = search_cache.get(position_key(game, board), min_depth)
+    if result is None:
+        return None, None
+    logger.info(f"Got move {result.best_move} from search cache (depth: {result.depth}, score: {result.score})")
+    return result.moves()
+
+
+def get_low_time_move(game, board, low_time):
+    # with the clock nearly out, a shallow remembered search (e.g. a stopped ponder search) beats searching for no time
+    color = "b" if board.turn == shogi.BLACK else "w"
+    if game.state.time(color) + game.state.inc(color) + game.state.byo >= low_time:
+        return None, None
+    result = search_cache.get(position_key(game, board))
+    if result is None:
+        return None, None
+    logger.info(f"Low on time, got move {result.best_move} from search cache (depth: {result.depth}, score: {result.score})")
+    return result.moves()
+
+
+def get_book_move(opening_book, board):
+    if opening_book is None:
+        return None
+    move = opening_book.choose(board)
+    if move is not None:
+        logger.info(f"Got move {move} from the opening book")
+    return move
+
+
+def get_impasse_declaration(board, impasse_tracker):
+    color = board.turn
+    logger.info(f"Declaring impasse with {impasse_tracker.points[color]} points and {impasse_tracker.pieces[color]} pieces in the promotion zone")
+    return impasse.DECLARATION, None
+
+
+def get_mate_move(mate_solver, board, tsume_cfg):
+    started = time.perf_counter()
+    moves = mate_solver.solve(board, tsume_cfg.get("time", 100))
+    if not moves:
+        return None, None
+    logger.info(f"Found mate in {len(moves)} plies in {(time.perf_counter() - started) * 1000:.0f} ms: {' '.join(moves)}")
+    return moves[0], moves[1] if len(moves) > 1 else None
+
+
+def start_mate_search(mate_solver, board, best_move, ponder_move, tsume_cfg):
+    """Looks for a mate in the position expected after the opponent's answer, during the opponent's turn."""
+    ponder_time = tsume_cfg.get("ponder_time", 1000)
+    if not ponder_time or ponder_move is None:
+        return None
+    board.push(shogi.Move.from_usi(best_move))
+    board.push(shogi.Move.from_usi(ponder_move))
+    sfen = board.sfen()
+    board.pop()
+    board.pop()
+    stop_event = threading.Event()
+    thread = threading.Thread(target=mate_solver.solve, args=(sfen, ponder_time, None, stop_event))
+    thread.start()
+    return thread, stop_event
+
+
+def stop_mate_search(mate_search):
+    if mate_search is not None:
+        thread, stop_event = mate_search
+        stop_event.set()
+        thread.join()
+
+
 def get_lishogi_cloud_move(li, board, game, lishogi_cloud_cfg):
     bw = "b" if board.turn == shogi.BLACK else "w"
-    if not lishogi_cloud_cfg.get("enabled", False) or game.state[f"{bw}time"] < lishogi_cloud_cfg.get("min_time", 20) * 1000:
+    if not lishogi_cloud_cfg.get("enabled", False) or game.state.time(bw) < lishogi_cloud_cfg.get("min_time", 20) * 1000:
         return None
 
     move = None
@@ -508,9 +1019,7 @@ def fake_thinking(config, board, game):
 
 
 def print_move_number(moves):
-    if moves:
-        moves = moves.split(" ")
-    move = moves[-1] if moves and len(moves) > 0 else None
+    move = moves[-1] if moves else None
     logger.info("")
     logger.info(f"move: {len(moves)}. {move}")
 
@@ -522,21 +1031,43 @@ def setup_board(game):
         else:
             board = shogi.Board() # Standard
 
-        for move in game.state["moves"].split():
+        for move in game.state.moves:
             usi_move = shogi.Move.from_usi(move)
             if board.is_legal(usi_move):
                 board.push(usi_move)
             else:
-                logger.debug(f"Ignoring illegal move {move} on board {board.sfen()}")
+                logger.debug("Ignoring illegal move %s on board %s", move, board.sfen())
     else:
         board = shogi.Board()
-        if game.variant_name == "Kyoto shogi":
-            for move in game.state["fairyMoves"].split():
-                board.push(shogi.Move.null())
+        for move in game.moves():
+            board.push(shogi.Move.null())
+
+    return board
+
+
+def update_board(game, board, impasse_tracker=None):
+    # Only push the moves played since the last update, the board is set up again after a takeback
+    moves = game.moves()
+    played = len(board.move_stack) if board is not None else 0
+    if board is None or played > len(moves) or (played and game.variant_name == "Standard" and board.move_stack[-1].usi() != moves[played - 1]):
+        return setup_board_with_tracker(game, impasse_tracker)
+    for move in moves[played:]:
+        if game.variant_name == "Standard":
+            usi_move = shogi.Move.from_usi(move)
+            if not board.is_legal(usi_move):
+                return setup_board_with_tracker(game, impasse_tracker)
+            if impasse_tracker is not None:
+                impasse_tracker.push(board, usi_move)
+            board.push(usi_move)
         else:
-            for move in game.state["moves"].split():
-                board.push(shogi.Move.null())
+            board.push(shogi.Move.null())
+    return board
+
 
+def setup_board_with_tracker(game, impasse_tracker):
+    board = setup_board(game)
+    if impasse_tracker is not None:
+        impasse_tracker.reset(board)
     return board
 
 
@@ -545,12 +1076,12 @@ def is_engine_move(game, board):
 
 
 def is_game_over(game):
-    return game.state["status"] != "started"
+    return game.state.status != "started"
 
 
 def tell_user_game_result(game):
-    winner = game.state.get("winner")
-    termination = game.state.get("status")
+    winner = game.state.winner
+    termination = game.state.status
 
     if winner is not None:
         winning_name = game.sente.name if winner == "sente" else game.gote.name
@@ -591,15 +1122,36 @@ def start_lishogi_bot():
     parser.add_argument("-v", action="store_true", help="Make output more verbose. Include all communication with lishogi.org.")
     parser.add_argument("--config", help="Specify a configuration file (defaults to ./config.yml)")
     parser.add_argument("-l", "--logfile", help="Record all console output to a log file.", default=None)
+    parser.add_argument("--profile-startup", action="store_true", help="Report the time spent in each startup step once the bot is ready to accept challenges.")
+    subparsers = parser.add_subparsers(dest="command")
+    analyze = subparsers.add_parser("analyze", help="Search positions from files with the engine instead of playing, writing the results as JSON lines.")
+    analyze.add_argument("inputs", nargs="+", help="KIF files (.kif, .kifu) or text files with one SFEN or USI position per line, or directories of them.")
+    analyze.add_argument("-o", "--output", default="analysis.jsonl", help="Results are appended to this file. Positions it already has are skipped.")
+    analyze.add_argument("--depth", type=int, help="Search depth.")
+    analyze.add_argument("--nodes", type=int, help="Nodes to search.")
+    analyze.add_argument("--movetime", type=int, help="Time (in ms) to search each position.")
+    analyze.add_argument("--engines", type=int, default=1, help="Number of engines searching at the same time.")
     args = parser.parse_args()
+    if args.command == "analyze" and args.depth is None and args.nodes is None and args.movetime is None:
+        parser.error("analyze needs at least one of --depth, --nodes and --movetime")
 
     logging_level = logging.DEBUG if args.v else logging.INFO
     logging_configurer(logging_level, args.logfile)
     logger.info(intro(), extra={"highlighter": None})
+    startup_profile.mark("logging")
     CONFIG = load_config(args.config or "./config.yml")
+    log_format = (CONFIG.get("logging") or {}).get("format", "rich")
+    if log_format != "rich":
+        logging_configurer(logging_level, args.logfile, log_format)
+    startup_profile.mark("config")
+    if args.command == "analyze":
+        limits = {"depth": args.depth, "nodes": args.nodes, "movetime": args.movetime}
+        analysis.analyse(CONFIG, args.inputs, args.output, limits, args.engines)
+        return
     li = lishogi.Lishogi(CONFIG["token"], CONFIG["url"], __version__, logging_level)
 
     user_profile = li.get_profile()
+    startup_profile.mark("profile request")
     username = user_profile["username"]
     is_bot = user_profile.get("title") == "BOT"
     logger.info(f"Welcome {username}!")
@@ -608,7 +1160,7 @@ def start_lishogi_bot():
         is_bot = upgrade_account(li)
 
     if is_bot:
-        start(li, user_profile, CONFIG, logging_level, args.logfile)
+        start(li, user_profile, CONFIG, logging_level, args.logfile, profile_startup=args.profile_startup)
     else:
         logger.error(f"{username} is not a bot account. Please upgrade it to a bot account!")
 
@@ -3,7 +3,9 @@ from urllib.parse import urljoin
 from requests.exceptions import ConnectionError, HTTPError, ReadTimeout
 from http.client import RemoteDisconnected
 import backoff
+import ndjson
 import logging
+import socket
 import time
 
 ENDPOINTS = {
@@ -34,6 +36,19 @@ def rate_limit_check(response):
     return False
 
 
+def shutdown_stream(response):
+    """
+    Ends a read of a streamed response that another thread is blocked in. Closing the response
+    doesn't wake that thread up, shutting its socket down does. The reader still closes it.
+    """
+    connection = response.raw.connection
+    if connection is not None and connection.sock is not None:
+        try:
+            connection.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+
 # docs: https://lichess.org/api
 class Lishogi:
     def __init__(self, token, url, version, logging_level):
@@ -64,8 +79,9 @@ class Lishogi:
         response = self.session.get(url, timeout=timeout)
         if rate_limit_check(response) or raise_for_status:
             response.raise_for_status()
-        logger.debug(response.json())
-        return response.json()
+        data = ndjson.decode_response(response)
+        logger.debug("%s", data)
+        return data
 
     @backoff.on_exception(backoff.constant,
                           (RemoteDisconnected, ConnectionError, HTTPError, ReadTimeout),
@@ -81,8 +97,9 @@ class Lishogi:
         response = self.session.post(url, data=data, timeout=timeout)
         if rate_limit_check(response) or raise_for_status:
             response.raise_for_status()
-        logger.debug(response.json())
-        return response.json()
+        data = ndjson.decode_response(response)
+        logger.debug("%s", data)
+        return data
 
     def get_game(self, game_id):
         return self.api_get(ENDPOINTS["game"].format(game_id))
@@ -100,15 +117,15 @@ class Lishogi:
     def abort(self, game_id):
         return self.api_post(ENDPOINTS["abort"].format(game_id))
 
-    def get_event_stream(self):
+    def get_event_stream(self, timeout=None):
         url = urljoin(self.baseUrl, ENDPOINTS["stream_event"])
         logger.debug("GET %s", url)
-        return requests.get(url, headers=self.header, stream=True)
+        return requests.get(url, headers=self.header, stream=True, timeout=timeout)
 
-    def get_game_stream(self, game_id):
+    def get_game_stream(self, game_id, timeout=None):
         url = urljoin(self.baseUrl, ENDPOINTS["stream"].format(game_id))
         logger.debug("GET %s", url)
-        return requests.get(url, headers=self.header, stream=True)
+        return requests.get(url, headers=self.header, stream=True, timeout=timeout)
 
     def accept_challenge(self, challenge_id):
         return self.api_post(ENDPOINTS["accept"].format(challenge_id))
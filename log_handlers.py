@@ -0,0 +1,71 @@
+import os
+import copy
+import json
+import time
+import logging
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+FILE_FORMAT = "%(asctime)s %(name)s %(levelname)s %(message)s"
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line, for log collectors."""
+    def format(self, record):
+        entry = {"time": self.formatTime(record), "name": record.name, "level": record.levelname, "message": record.getMessage()}
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry)
+
+
+def make_formatter(log_format):
+    return JsonFormatter() if log_format == "json" else logging.Formatter(FILE_FORMAT)
+
+
+class GameLog(logging.Handler):
+    """
+    Keeps the last `capacity` log records of the current game in memory, including
+    debug records of the game's loggers that are not logged anywhere else. Only their
+    message is made when they are kept, the rest of the format when they are written
+    to disk, after a game errors or is lost on time.
+    """
+    def __init__(self, capacity, directory, log_format="plain"):
+        super().__init__(logging.DEBUG)
+        self.records = deque(maxlen=capacity)
+        self.directory = directory
+        self.setFormatter(make_formatter(log_format))
+
+    def attach(self, level, names):
+        # Other handlers keep logging at `level`, only this one sees the debug records of the loggers in `names`
+        root = logging.getLogger()
+        for handler in root.handlers:
+            if handler.level < level:
+                handler.setLevel(level)
+        root.addHandler(self)
+        for name in names:
+            logging.getLogger(name).setLevel(logging.DEBUG)
+
+    def emit(self, record):
+        # The arguments, e.g. a game state, may change before the record is written
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        self.records.append(record)
+
+    def clear(self):
+        self.records.clear()
+
+    def dump(self, game_id, reason):
+        records = list(self.records)
+        path = os.path.join(self.directory, f"{game_id}-{reason}-{time.strftime('%Y%m%d-%H%M%S')}.log")
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(path, "w") as file:
+                for record in records:
+                    file.write(self.format(record) + "\n")
+        except OSError as error:
+            logger.warning(f"Unable to write the log of {game_id}: {error}")
+            return None
+        logger.info(f"Wrote the last {len(records)} log records of {game_id} to {path}")
+        return path
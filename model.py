@@ -1,8 +1,12 @@
+import sys
 import time
 from urllib.parse import urljoin
 
 
 class Challenge:
+    __slots__ = ("id", "rated", "variant", "perf_name", "speed", "increment", "byoyomi", "base", "challenger", "challenger_title",
+                 "challenger_is_bot", "challenger_master_title", "challenger_name", "challenger_rating_int", "challenger_rating")
+
     def __init__(self, c_info):
         self.id = c_info["id"]
         self.rated = c_info["rated"]
@@ -66,6 +70,10 @@ class Challenge:
 
 
 class Game:
+    __slots__ = ("username", "id", "speed", "clock_initial", "clock_increment", "clock_byoyomi", "perf_name", "variant_name", "sente", "gote",
+                 "initial_sfen", "state", "is_sente", "my_color", "opponent_color", "me", "opponent", "base_url", "sente_starts",
+                 "abort_at", "terminate_at", "disconnect_at", "timers", "deadline_callbacks")
+
     def __init__(self, json, username, base_url, abort_time):
         self.username = username
         self.id = json.get("id")
@@ -82,7 +90,7 @@ class Game:
             self.initial_sfen = json.get("fairyInitialSfen")
         else:
             self.initial_sfen = json.get("initialSfen")
-        self.state = json.get("state")
+        self.state = GameState(json.get("state"))
         self.is_sente = bool(self.sente.name and self.sente.name.lower() == username.lower())
         self.my_color = "sente" if self.is_sente else "gote"
         self.opponent_color = "gote" if self.is_sente else "sente"
@@ -93,18 +101,45 @@ class Game:
         self.abort_at = time.time() + abort_time
         self.terminate_at = time.time() + (self.clock_initial + self.clock_increment + self.clock_byoyomi) / 1000 + abort_time + 60
         self.disconnect_at = time.time()
+        self.timers = None
+        self.deadline_callbacks = {}
 
     def url(self):
         return urljoin(self.base_url, f"{self.id}/{self.my_color}")
 
+    def moves(self):
+        return self.state.fairy_moves if self.variant_name == "Kyoto shogi" else self.state.moves
+
     def is_abortable(self):
-        return len(self.state["moves"]) < 6
+        return len(self.state.moves) < 2
 
     def ping(self, abort_in, terminate_in, disconnect_in):
         if self.is_abortable():
             self.abort_at = time.time() + abort_in
         self.terminate_at = time.time() + terminate_in
         self.disconnect_at = time.time() + disconnect_in
+        self.schedule_deadlines()
+
+    def watch(self, timers, on_abort, on_terminate, on_disconnect):
+        self.timers = timers
+        self.deadline_callbacks = {"abort": on_abort, "terminate": on_terminate, "disconnect": on_disconnect}
+        self.schedule_deadlines()
+
+    def unwatch(self):
+        if self.timers is not None:
+            for name in self.deadline_callbacks:
+                self.timers.cancel((self.id, name))
+        self.timers = None
+
+    def schedule_deadlines(self):
+        if self.timers is None:
+            return
+        if self.is_abortable():
+            self.timers.schedule((self.id, "abort"), self.abort_at, self.deadline_callbacks["abort"])
+        else:
+            self.timers.cancel((self.id, "abort"))
+        self.timers.schedule((self.id, "terminate"), self.terminate_at, self.deadline_callbacks["terminate"])
+        self.timers.schedule((self.id, "disconnect"), self.disconnect_at, self.deadline_callbacks["disconnect"])
 
     def should_abort_now(self):
         return self.is_abortable() and time.time() > self.abort_at
@@ -116,7 +151,7 @@ class Game:
         return time.time() > self.disconnect_at
 
     def my_remaining_seconds(self):
-        return (self.state["btime"] if self.is_sente else self.state["wtime"]) / 1000
+        return (self.state.btime if self.is_sente else self.state.wtime) / 1000
 
     def __str__(self):
         return f"{self.url()} {self.perf_name} vs {self.opponent.__str__()}"
@@ -125,7 +160,65 @@ class Game:
         return self.__str__()
 
 
+class GameState:
+    """
+    A gameState decoded once. The move lists are only appended to when new moves
+    arrive, so every consumer can share them instead of splitting the moves again.
+    """
+    __slots__ = ("moves", "fairy_moves", "moves_text", "fairy_moves_text", "btime", "wtime", "binc", "winc", "byo", "status", "winner")
+
+    def __init__(self, json):
+        self.moves = []
+        self.fairy_moves = []
+        self.moves_text = ""
+        self.fairy_moves_text = ""
+        self.update(json)
+
+    def update(self, json):
+        self.moves_text = append_moves(self.moves, self.moves_text, json.get("moves") or "")
+        self.fairy_moves_text = append_moves(self.fairy_moves, self.fairy_moves_text, json.get("fairyMoves") or "")
+        self.btime = json.get("btime")
+        self.wtime = json.get("wtime")
+        self.binc = json.get("binc", 0)
+        self.winc = json.get("winc", 0)
+        self.byo = json.get("byo", 0)
+        self.status = json.get("status")
+        self.winner = json.get("winner")
+
+    def time(self, bw):
+        return self.btime if bw == "b" else self.wtime
+
+    def inc(self, bw):
+        return self.binc if bw == "b" else self.winc
+
+    def to_dict(self):
+        return {"moves": " ".join(self.moves), "fairyMoves": " ".join(self.fairy_moves), "btime": self.btime, "wtime": self.wtime,
+                "binc": self.binc, "winc": self.winc, "byo": self.byo, "status": self.status, "winner": self.winner}
+
+    def __str__(self):
+        return str(self.to_dict())
+
+    def __repr__(self):
+        return self.__str__()
+
+
+def append_moves(moves, known, text):
+    """
+    Updates `moves`, split from the text `known`, to the moves of `text` and returns `text`.
+    Only the moves after `known` are split if `text` starts with all of it, which a takeback followed by
+    other moves doesn't, even if it is as long and ends with the same move.
+    """
+    if moves and text.startswith(known) and text[len(known):len(known) + 1] in ("", " "):
+        moves.extend(map(sys.intern, text[len(known):].split()))
+    else:
+        # First update or a takeback
+        moves[:] = map(sys.intern, text.split())
+    return text
+
+
 class Player:
+    __slots__ = ("id", "name", "title", "rating", "provisional", "aiLevel")
+
     def __init__(self, json):
         self.id = json.get("id")
         self.name = json.get("name")
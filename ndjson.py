@@ -0,0 +1,26 @@
+"""
+Decoding of lishogi's JSON responses and NDJSON streams.
+Lines are parsed straight from bytes with orjson when it is installed, and with the json module otherwise.
+"""
+
+import json
+
+try:
+    import orjson
+    backend = "orjson"
+    loads = orjson.loads
+except ImportError:
+    backend = "json"
+
+    def loads(data):
+        # Faster than json.loads(data), which first guesses the encoding of bytes
+        return json.loads(data.decode("utf-8"))
+
+
+def decode(line):
+    # lishogi keeps streams alive with empty lines
+    return loads(line) if line else None
+
+
+def decode_response(response):
+    return loads(response.content)
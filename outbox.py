@@ -0,0 +1,91 @@
+import logging
+import threading
+from collections import deque
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+MAX_CHAT_LENGTH = 140
+
+
+class ChatMessage:
+    def __init__(self, game_id, room, text, droppable):
+        self.game_id = game_id
+        self.room = room
+        self.text = text
+        self.droppable = droppable
+
+
+class Outbox:
+    """
+    Posts chat messages from a background thread, so the game loop never waits for them.
+    `li` should have its own session: posting a message is retried for up to a minute.
+    Nothing is posted while a move is being sent. Droppable messages (replies to
+    commands) of games under time pressure are dropped, and messages queued for
+    the same room are joined when they fit in one chat line.
+    """
+    def __init__(self, li):
+        self.li = li
+        self.messages = deque()
+        self.moving = set()
+        self.time_pressure = set()
+        self.condition = threading.Condition()
+        self.thread = None
+
+    def chat(self, game_id, room, text, droppable=True):
+        with self.condition:
+            if droppable and game_id in self.time_pressure:
+                logger.debug("Dropping chat message for %s under time pressure: %s", game_id, text)
+                return
+            self.messages.append(ChatMessage(game_id, room, text, droppable))
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+            self.condition.notify()
+            logger.debug("Chat messages queued: %s", len(self.messages))
+
+    @contextmanager
+    def sending_move(self, game_id):
+        with self.condition:
+            self.moving.add(game_id)
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.moving.discard(game_id)
+                self.condition.notify()
+
+    def set_time_pressure(self, game_id, under_pressure):
+        with self.condition:
+            if not under_pressure:
+                self.time_pressure.discard(game_id)
+                return
+            self.time_pressure.add(game_id)
+            dropped = [message for message in self.messages if message.game_id == game_id and message.droppable]
+            for message in dropped:
+                self.messages.remove(message)
+            if dropped:
+                logger.info(f"Dropped {len(dropped)} chat messages for {game_id} under time pressure")
+
+    def depth(self):
+        return len(self.messages)
+
+    def next_message(self):
+        with self.condition:
+            while not self.messages or self.moving:
+                self.condition.wait()
+            message = self.messages.popleft()
+            # Join messages for the same room while they fit in one chat line
+            while self.messages and (self.messages[0].game_id, self.messages[0].room) == (message.game_id, message.room) \
+                    and len(message.text) + len(self.messages[0].text) + 1 <= MAX_CHAT_LENGTH:
+                following = self.messages.popleft()
+                message = ChatMessage(message.game_id, message.room, f"{message.text} {following.text}", message.droppable and following.droppable)
+            return message
+
+    def run(self):
+        while True:
+            message = self.next_message()
+            try:
+                self.li.chat(message.game_id, message.room, message.text)
+            except Exception:
+                logger.warning(f"Unable to send chat message to {message.game_id}: {message.text}")
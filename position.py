@@ -0,0 +1,429 @@
+"""
+A compact shogi position for homemade engines. The board is a list of 81 small ints and
+the hands a list of 16 counts, moves are ints, and making and unmaking a move updates the
+Zobrist hash in place instead of creating objects. Squares and piece types are numbered
+as in python-shogi, so positions and moves convert to and from shogi.Board and USI.
+"""
+
+import random
+
+EMPTY = 0
+PAWN, LANCE, KNIGHT, SILVER, GOLD, BISHOP, ROOK, KING = range(1, 9)
+PROM_PAWN, PROM_LANCE, PROM_KNIGHT, PROM_SILVER, PROM_BISHOP, PROM_ROOK = range(9, 15)
+BLACK, WHITE = 0, 1
+
+# A piece is its type, plus 16 for white pieces
+WHITE_PIECE = 16
+
+PROMOTED = [0, PROM_PAWN, PROM_LANCE, PROM_KNIGHT, PROM_SILVER, 0, PROM_BISHOP, PROM_ROOK, 0, 0, 0, 0, 0, 0, 0]
+UNPROMOTED = [0, PAWN, LANCE, KNIGHT, SILVER, GOLD, BISHOP, ROOK, KING, PAWN, LANCE, KNIGHT, SILVER, BISHOP, ROOK]
+SYMBOLS = ["", "p", "l", "n", "s", "g", "b", "r", "k", "+p", "+l", "+n", "+s", "+b", "+r"]
+HAND_ORDER = [ROOK, BISHOP, GOLD, SILVER, KNIGHT, LANCE, PAWN]
+STARTING_SFEN = "lnsgkgsnl/1r5b1/ppppppppp/9/9/9/PPPPPPPPP/1B5R1/LNSGKGSNL b - 1"
+SQUARE_NAMES = [f"{9 - file}{'abcdefghi'[rank]}" for rank in range(9) for file in range(9)]
+
+# Moves are ints: from square + 1 (0 for drops), to square << 7, promotion << 14, dropped piece type << 15
+DROP_SHIFT = 15
+
+
+def make_move(from_square, to_square, promotion=False, drop_piece_type=0):
+    return (0 if from_square is None else from_square + 1) | to_square << 7 | promotion << 14 | drop_piece_type << DROP_SHIFT
+
+
+def usi(move):
+    to_square = SQUARE_NAMES[move >> 7 & 127]
+    if move >> DROP_SHIFT:
+        return f"{SYMBOLS[move >> DROP_SHIFT].upper()}*{to_square}"
+    return f"{SQUARE_NAMES[(move & 127) - 1]}{to_square}{'+' if move >> 14 & 1 else ''}"
+
+
+def parse_usi(text):
+    to_square = SQUARE_NAMES.index(text[2:4])
+    if text[1] == "*":
+        return make_move(None, to_square, False, SYMBOLS.index(text[0].lower()))
+    return make_move(SQUARE_NAMES.index(text[0:2]), to_square, text.endswith("+"))
+
+
+def in_board(rank, file):
+    return 0 <= rank < 9 and 0 <= file < 9
+
+
+# Steps and slides of black pieces as (rank, file) offsets, black moves towards rank 0
+GOLD_STEPS = [(-1, -1), (-1, 0), (-1, 1), (0, -1), (0, 1), (1, 0)]
+KING_STEPS = [(-1, -1), (-1, 0), (-1, 1), (0, -1), (0, 1), (1, -1), (1, 0), (1, 1)]
+ORTHOGONAL = [(-1, 0), (1, 0), (0, -1), (0, 1)]
+DIAGONAL = [(-1, -1), (-1, 1), (1, -1), (1, 1)]
+PIECE_STEPS = {PAWN: [(-1, 0)], KNIGHT: [(-2, -1), (-2, 1)], SILVER: [(-1, -1), (-1, 0), (-1, 1), (1, -1), (1, 1)],
+               GOLD: GOLD_STEPS, KING: KING_STEPS, PROM_PAWN: GOLD_STEPS, PROM_LANCE: GOLD_STEPS, PROM_KNIGHT: GOLD_STEPS,
+               PROM_SILVER: GOLD_STEPS, PROM_BISHOP: ORTHOGONAL, PROM_ROOK: DIAGONAL}
+PIECE_SLIDES = {LANCE: [(-1, 0)], BISHOP: DIAGONAL, ROOK: ORTHOGONAL, PROM_BISHOP: DIAGONAL, PROM_ROOK: ORTHOGONAL}
+
+
+def steps_from(square, offsets, color):
+    rank, file = divmod(square, 9)
+    sign = 1 if color == BLACK else -1
+    return [(rank + sign * rank_step) * 9 + file + sign * file_step for rank_step, file_step in offsets
+            if in_board(rank + sign * rank_step, file + sign * file_step)]
+
+
+def ray(square, rank_step, file_step):
+    rank, file = divmod(square, 9)
+    squares = []
+    rank, file = rank + rank_step, file + file_step
+    while in_board(rank, file):
+        squares.append(rank * 9 + file)
+        rank, file = rank + rank_step, file + file_step
+    return squares
+
+
+# STEPS[color][piece_type][square] and SLIDES[color][piece_type][square]: squares a piece moves to, and rays it slides along
+STEPS = [[[steps_from(square, PIECE_STEPS.get(piece_type, []), color) for square in range(81)] for piece_type in range(15)] for color in (BLACK, WHITE)]
+SLIDES = [[[[ray(square, (1 if color == BLACK else -1) * rank_step, (1 if color == BLACK else -1) * file_step)
+             for rank_step, file_step in PIECE_SLIDES.get(piece_type, [])] for square in range(81)] for piece_type in range(15)]
+          for color in (BLACK, WHITE)]
+
+
+def step_attackers(square, color):
+    # The squares next to `square` (and a knight's jump away) with the pieces of `color` that attack it from there
+    attackers = {}
+    for piece_type, offsets in PIECE_STEPS.items():
+        for source in steps_from(square, offsets, color ^ 1):
+            attackers.setdefault(source, set()).add(piece_type | (WHITE_PIECE if color == WHITE else 0))
+    return [(source, frozenset(pieces)) for source, pieces in attackers.items()]
+
+
+def slide_attackers(square, color):
+    # Rays from `square` with the sliding pieces of `color` that attack it along each ray
+    piece = WHITE_PIECE if color == WHITE else 0
+    lance_rank_step = 1 if color == BLACK else -1
+    rays = []
+    for rank_step, file_step in ORTHOGONAL + DIAGONAL:
+        if (rank_step, file_step) in ORTHOGONAL:
+            pieces = {ROOK | piece, PROM_ROOK | piece}
+            if (rank_step, file_step) == (lance_rank_step, 0):
+                pieces.add(LANCE | piece)
+        else:
+            pieces = {BISHOP | piece, PROM_BISHOP | piece}
+        squares = ray(square, rank_step, file_step)
+        if squares:
+            rays.append((squares, frozenset(pieces)))
+    return rays
+
+
+STEP_ATTACKERS = [[step_attackers(square, color) for square in range(81)] for color in (BLACK, WHITE)]
+SLIDE_ATTACKERS = [[slide_attackers(square, color) for square in range(81)] for color in (BLACK, WHITE)]
+
+
+def promotion_zone(square, color):
+    return square < 27 if color == BLACK else square >= 54
+
+
+def must_promote(square, piece_type, color):
+    rank = square // 9 if color == BLACK else 8 - square // 9
+    return (piece_type in (PAWN, LANCE) and rank == 0) or (piece_type == KNIGHT and rank <= 1)
+
+
+IN_PROMOTION_ZONE = [[promotion_zone(square, color) for square in range(81)] for color in (BLACK, WHITE)]
+MUST_PROMOTE = [[[must_promote(square, piece_type, color) for square in range(81)] for piece_type in range(15)] for color in (BLACK, WHITE)]
+# Pieces must be dropped where they can still move
+DROP_SQUARES = [[[square for square in range(81) if not must_promote(square, piece_type, color)] for piece_type in range(8)] for color in (BLACK, WHITE)]
+
+_random = random.Random(20230613)
+PIECE_KEYS = [[_random.getrandbits(64) for _ in range(81)] for _ in range(32)]
+HAND_KEYS = [[_random.getrandbits(64) for _ in range(19)] for _ in range(16)]
+WHITE_TO_MOVE_KEY = _random.getrandbits(64)
+
+
+class Position:
+    """
+    `board[square]` is a piece, `hands[color * 8 + piece_type]` a count. `push` and `pop`
+    make and unmake moves and keep `key`, the Zobrist hash, up to date.
+    """
+    __slots__ = ("board", "hands", "turn", "move_number", "key", "kings", "captured", "keys", "moves")
+
+    def __init__(self, sfen=STARTING_SFEN):
+        self.board = [EMPTY] * 81
+        self.hands = [0] * 16
+        self.kings = [None, None]
+        self.captured = []
+        self.keys = []
+        self.moves = []
+        self.set_sfen(sfen)
+
+    @classmethod
+    def from_board(cls, board):
+        return cls(board.sfen())
+
+    def set_sfen(self, sfen):
+        parts = sfen.split()
+        board = [EMPTY] * 81
+        square = 0
+        promoted = False
+        for char in parts[0]:
+            if char == "/":
+                continue
+            if char.isdigit():
+                square += int(char)
+            elif char == "+":
+                promoted = True
+            else:
+                piece_type = SYMBOLS.index(char.lower())
+                if promoted:
+                    piece_type = PROMOTED[piece_type]
+                    promoted = False
+                board[square] = piece_type | (WHITE_PIECE if char.islower() else 0)
+                square += 1
+        hands = [0] * 16
+        count = 0
+        if len(parts) > 2 and parts[2] != "-":
+            for char in parts[2]:
+                if char.isdigit():
+                    count = count * 10 + int(char)
+                else:
+                    hands[(WHITE if char.islower() else BLACK) * 8 + SYMBOLS.index(char.lower())] += count or 1
+                    count = 0
+        self.board = board
+        self.hands = hands
+        self.turn = WHITE if len(parts) > 1 and parts[1] == "w" else BLACK
+        self.move_number = int(parts[3]) if len(parts) > 3 else 1
+        self.kings = [None, None]
+        for square, piece in enumerate(board):
+            if piece & 15 == KING:
+                self.kings[piece >> 4] = square
+        self.captured.clear()
+        self.keys.clear()
+        self.moves.clear()
+        self.key = self.compute_key()
+
+    def sfen(self):
+        rows = []
+        for rank in range(9):
+            row = ""
+            empty = 0
+            for piece in self.board[rank * 9:rank * 9 + 9]:
+                if not piece:
+                    empty += 1
+                    continue
+                if empty:
+                    row += str(empty)
+                    empty = 0
+                symbol = SYMBOLS[piece & 15]
+                row += symbol if piece & WHITE_PIECE else symbol.upper()
+            rows.append(row + (str(empty) if empty else ""))
+        hand = ""
+        for color in (BLACK, WHITE):
+            for piece_type in HAND_ORDER:
+                count = self.hands[color * 8 + piece_type]
+                if count:
+                    symbol = SYMBOLS[piece_type]
+                    hand += (str(count) if count > 1 else "") + (symbol.upper() if color == BLACK else symbol)
+        return f"{'/'.join(rows)} {'w' if self.turn == WHITE else 'b'} {hand or '-'} {self.move_number}"
+
+    def to_board(self):
+        import shogi
+        return shogi.Board(self.sfen())
+
+    def compute_key(self):
+        key = WHITE_TO_MOVE_KEY if self.turn == WHITE else 0
+        for square, piece in enumerate(self.board):
+            if piece:
+                key ^= PIECE_KEYS[piece][square]
+        for index, count in enumerate(self.hands):
+            key ^= HAND_KEYS[index][count]
+        return key
+
+    def push(self, move):
+        board = self.board
+        hands = self.hands
+        turn = self.turn
+        key = self.key
+        self.keys.append(key)
+        self.moves.append(move)
+        to_square = move >> 7 & 127
+        drop = move >> DROP_SHIFT
+        captured = board[to_square]
+        self.captured.append(captured)
+        if drop:
+            piece = drop | (WHITE_PIECE if turn else 0)
+            index = turn * 8 + drop
+            count = hands[index]
+            key ^= HAND_KEYS[index][count] ^ HAND_KEYS[index][count - 1]
+            hands[index] = count - 1
+        else:
+            from_square = (move & 127) - 1
+            piece = board[from_square]
+            board[from_square] = EMPTY
+            key ^= PIECE_KEYS[piece][from_square]
+            if move >> 14 & 1:
+                piece = PROMOTED[piece & 15] | (piece & WHITE_PIECE)
+            if captured:
+                key ^= PIECE_KEYS[captured][to_square]
+                index = turn * 8 + UNPROMOTED[captured & 15]
+                count = hands[index]
+                key ^= HAND_KEYS[index][count] ^ HAND_KEYS[index][count + 1]
+                hands[index] = count + 1
+            if piece & 15 == KING:
+                self.kings[turn] = to_square
+        board[to_square] = piece
+        self.key = key ^ PIECE_KEYS[piece][to_square] ^ WHITE_TO_MOVE_KEY
+        self.turn = turn ^ 1
+        self.move_number += 1
+
+    def pop(self):
+        board = self.board
+        hands = self.hands
+        move = self.moves.pop()
+        captured = self.captured.pop()
+        self.key = self.keys.pop()
+        self.move_number -= 1
+        turn = self.turn ^ 1
+        self.turn = turn
+        to_square = move >> 7 & 127
+        drop = move >> DROP_SHIFT
+        piece = board[to_square]
+        board[to_square] = captured
+        if drop:
+            hands[turn * 8 + drop] += 1
+        else:
+            from_square = (move & 127) - 1
+            if move >> 14 & 1:
+                piece = UNPROMOTED[piece & 15] | (piece & WHITE_PIECE)
+            board[from_square] = piece
+            if captured:
+                hands[turn * 8 + UNPROMOTED[captured & 15]] -= 1
+            if piece & 15 == KING:
+                self.kings[turn] = from_square
+        return move
+
+    def is_attacked(self, square, color):
+        """Whether a piece of `color` attacks `square`."""
+        board = self.board
+        for source, pieces in STEP_ATTACKERS[color][square]:
+            if board[source] in pieces:
+                return True
+        for squares, pieces in SLIDE_ATTACKERS[color][square]:
+            for source in squares:
+                piece = board[source]
+                if piece:
+                    if piece in pieces:
+                        return True
+                    break
+        return False
+
+    def is_check(self):
+        king = self.kings[self.turn]
+        return king is not None and self.is_attacked(king, self.turn ^ 1)
+
+    def pseudo_legal_moves(self):
+        """All moves of the side to move, including those that leave its king in check."""
+        board = self.board
+        turn = self.turn
+        own = WHITE_PIECE if turn else 0
+        steps = STEPS[turn]
+        slides = SLIDES[turn]
+        in_zone = IN_PROMOTION_ZONE[turn]
+        must_promote = MUST_PROMOTE[turn]
+        moves = []
+        append = moves.append
+        pawn_files = [False] * 9
+        for from_square, piece in enumerate(board):
+            if not piece or piece & WHITE_PIECE != own:
+                continue
+            piece_type = piece & 15
+            if piece_type == PAWN:
+                pawn_files[from_square % 9] = True
+            promotable = PROMOTED[piece_type]
+            targets = [to_square for to_square in steps[piece_type][from_square] if not board[to_square] or board[to_square] & WHITE_PIECE != own]
+            for squares in slides[piece_type][from_square]:
+                for to_square in squares:
+                    target = board[to_square]
+                    if not target:
+                        targets.append(to_square)
+                        continue
+                    if target & WHITE_PIECE != own:
+                        targets.append(to_square)
+                    break
+            base = from_square + 1
+            for to_square in targets:
+                move = base | to_square << 7
+                if promotable and (in_zone[from_square] or in_zone[to_square]):
+                    append(move | 1 << 14)
+                    if must_promote[piece_type][to_square]:
+                        continue
+                append(move)
+
+        hands = self.hands
+        for piece_type in range(PAWN, KING):
+            if not hands[turn * 8 + piece_type]:
+                continue
+            drop = piece_type << DROP_SHIFT
+            for to_square in DROP_SQUARES[turn][piece_type]:
+                if not board[to_square] and not (piece_type == PAWN and pawn_files[to_square % 9]):
+                    append(drop | to_square << 7)
+        return moves
+
+    def legal_moves(self):
+        """All legal moves of the side to move, generated at once as a list of ints."""
+        turn = self.turn
+        king = self.kings[turn]
+        in_check = self.is_check()
+        enemy_king = self.kings[turn ^ 1]
+        # A pawn dropped in front of the enemy king gives check
+        pawn_check_square = None
+        if enemy_king is not None:
+            pawn_check_square = enemy_king + (9 if turn == BLACK else -9)
+        legal = []
+        for move in self.pseudo_legal_moves():
+            from_square = (move & 127) - 1
+            # Other moves can't expose the king: they don't leave a line through it
+            if king is not None and (in_check or from_square == king or (from_square >= 0 and ON_LINE[king][from_square])):
+                self.push(move)
+                suicide = self.is_attacked(self.kings[turn], turn ^ 1)
+                self.pop()
+                if suicide:
+                    continue
+            if move >> DROP_SHIFT == PAWN and (move >> 7 & 127) == pawn_check_square and self.is_pawn_drop_mate(move):
+                continue
+            legal.append(move)
+        return legal
+
+    def is_pawn_drop_mate(self, move):
+        self.push(move)
+        mate = not self.has_legal_move()
+        self.pop()
+        return mate
+
+    def has_legal_move(self):
+        turn = self.turn
+        for move in self.pseudo_legal_moves():
+            self.push(move)
+            king = self.kings[turn]
+            legal = king is None or not self.is_attacked(king, turn ^ 1)
+            self.pop()
+            if legal:
+                return True
+        return False
+
+    def is_repetition(self):
+        return self.key in self.keys
+
+    def perft(self, depth):
+        """Number of move sequences of `depth` plies."""
+        moves = self.legal_moves()
+        if depth <= 1:
+            return len(moves) if depth == 1 else 1
+        nodes = 0
+        for move in moves:
+            self.push(move)
+            nodes += self.perft(depth - 1)
+            self.pop()
+        return nodes
+
+
+def on_line(first, second):
+    first_rank, first_file = divmod(first, 9)
+    second_rank, second_file = divmod(second, 9)
+    return first_rank == second_rank or first_file == second_file or abs(first_rank - second_rank) == abs(first_file - second_file)
+
+
+ON_LINE = [[on_line(king, square) for square in range(81)] for king in range(81)]
@@ -0,0 +1,75 @@
+import os
+import sys
+import time
+import pstats
+import cProfile
+import logging
+import threading
+import traceback
+import tracemalloc
+import multiprocessing
+
+logger = logging.getLogger(__name__)
+
+
+class Profiler:
+    """
+    Profiles a running process on demand. The first toggle starts cProfile (for the thread
+    that toggled it) and tracemalloc, the second one writes their results to timestamped
+    files in `directory`. Every toggle also writes the stacks of all threads.
+    """
+    def __init__(self, directory="profiles"):
+        self.directory = directory
+        self.profile = None
+        self.lock = threading.Lock()
+
+    def toggle(self):
+        # A signal arriving while the profiler is being toggled is ignored
+        if not self.lock.acquire(blocking=False):
+            return
+        try:
+            if self.profile is None:
+                self.start()
+            else:
+                self.stop()
+        finally:
+            self.lock.release()
+
+    def start(self):
+        self.dump_threads(self.prefix())
+        tracemalloc.start()
+        self.profile = cProfile.Profile()
+        self.profile.enable()
+        logger.info(f"Profiling {multiprocessing.current_process().name} ({os.getpid()})")
+
+    def stop(self):
+        self.profile.disable()
+        snapshot = tracemalloc.take_snapshot()
+        tracemalloc.stop()
+        prefix = self.prefix()
+        self.profile.dump_stats(f"{prefix}.prof")
+        with open(f"{prefix}-cpu.txt", "w") as file:
+            pstats.Stats(self.profile, stream=file).sort_stats("cumulative").print_stats(50)
+        self.profile = None
+
+        with open(f"{prefix}-memory.txt", "w") as file:
+            for stat in snapshot.statistics("lineno")[:50]:
+                file.write(f"{stat}\n")
+        self.dump_threads(prefix)
+        logger.info(f"Wrote the profile of {multiprocessing.current_process().name} ({os.getpid()}) to {prefix}*")
+
+    def dump_threads(self, prefix):
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        with open(f"{prefix}-threads.txt", "w") as file:
+            for ident, frame in sys._current_frames().items():
+                file.write(f"Thread {names.get(ident, ident)}:\n")
+                file.write("".join(traceback.format_stack(frame)))
+                file.write("\n")
+
+    def prefix(self):
+        os.makedirs(self.directory, exist_ok=True)
+        name = multiprocessing.current_process().name
+        return os.path.join(self.directory, f"{time.strftime('%Y%m%d-%H%M%S')}-{name}-{os.getpid()}")
+
+
+profiler = Profiler()
@@ -0,0 +1,109 @@
+import time
+import threading
+from collections import OrderedDict
+
+
+def position_key(game, board):
+    # Only standard games have a real board to derive a transposition-safe key from
+    if game.variant_name != "Standard":
+        return None
+    return board_key(board)
+
+
+def board_key(board):
+    """
+    The key of a standard position, shared by the search cache, idle analysis, analyze and the opening book.
+    A position that occurred before gets how many times it did, as its best move may lead to sennichite.
+    """
+    key = " ".join(board.sfen().split()[:3])
+    repetitions = board.transpositions[board.zobrist_hash()]
+    return key if repetitions <= 1 else f"{key} {repetitions}"
+
+
+class SearchResult:
+    def __init__(self, key, best_move, ponder_move, info=None):
+        info = info or {}
+        self.key = key
+        self.best_move = best_move
+        self.ponder_move = ponder_move
+        self.depth = info.get("depth", 0)
+        self.score = info.get("score")
+        self.nodes = info.get("nodes")
+        self.pv = info.get("pv")
+        self.finished_at = time.time()
+
+    def moves(self):
+        return self.best_move, self.ponder_move
+
+    def to_dict(self):
+        return {"key": self.key, "best_move": self.best_move, "ponder_move": self.ponder_move, "depth": self.depth,
+                "score": self.score, "nodes": self.nodes, "pv": self.pv, "finished_at": self.finished_at}
+
+    @classmethod
+    def from_dict(cls, data):
+        result = cls(data["key"], data["best_move"], data.get("ponder_move"), data)
+        result.finished_at = data.get("finished_at", result.finished_at)
+        return result
+
+    def __str__(self):
+        return f"{self.best_move} (depth: {self.depth}, score: {self.score}, nodes: {self.nodes})"
+
+    def __repr__(self):
+        return self.__str__()
+
+
+class SearchCache:
+    def __init__(self, max_size=10000):
+        self.max_size = max_size
+        self.results = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, min_depth=0):
+        if key is None:
+            return None
+        with self.lock:
+            result = self.results.get(key)
+            if result is None or result.depth < min_depth:
+                return None
+            self.results.move_to_end(key)
+            return result
+
+    def put(self, result):
+        if result is None or result.key is None or result.best_move is None:
+            return
+        with self.lock:
+            old = self.results.get(result.key)
+            # Keep the deeper search when the same position was searched twice
+            if old is None or result.depth >= old.depth:
+                self.results[result.key] = result
+            self.results.move_to_end(result.key)
+            while len(self.results) > self.max_size:
+                self.results.popitem(last=False)
+
+    def __len__(self):
+        return len(self.results)
+
+
+class PonderStore:
+    """Completed or stopped ponder searches, one per game."""
+    def __init__(self):
+        self.results = {}
+        self.lock = threading.Lock()
+
+    def put(self, game_id, result):
+        with self.lock:
+            self.results[game_id] = result
+
+    def get(self, game_id, key=None):
+        with self.lock:
+            result = self.results.get(game_id)
+        if result is not None and key is not None and result.key != key:
+            return None
+        return result
+
+    def pop(self, game_id):
+        with self.lock:
+            return self.results.pop(game_id, None)
+
+    def clear(self, game_id):
+        self.pop(game_id)
@@ -0,0 +1,41 @@
+import sys
+import time
+import importlib.util
+
+
+def lazy_import(name):
+    """
+    Returns the module `name` without running it. It is loaded the first time one of
+    its attributes is used, so processes that never use it don't pay for importing it.
+    """
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
+
+
+class StartupProfile:
+    """Time spent in each step from launch until the bot is ready to accept challenges."""
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.last = self.started
+        self.steps = []
+
+    def mark(self, step):
+        now = time.perf_counter()
+        self.steps.append((step, now - self.last))
+        self.last = now
+
+    def total(self):
+        return self.last - self.started
+
+    def report(self):
+        lines = [f"Startup profile ({self.total() * 1000:.0f} ms):"]
+        for step, seconds in self.steps:
+            lines.append(f"  {step:<24}{seconds * 1000:8.1f} ms")
+        return "\n".join(lines)
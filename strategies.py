@@ -3,8 +3,16 @@ Some example strategies for people who want to create a custom, homemade bot.
 And some handy classes to extend
 """
 
+import time
 import random
+import logging
+import threading
+import shogi
+import alphabeta
 from engine_wrapper import EngineWrapper
+from engine_ctrl.snapshots import InfoChannel
+
+logger = logging.getLogger(__name__)
 
 
 class FillerEngine:
@@ -17,6 +25,8 @@ class FillerEngine:
         self.id = {
             "name": name
         }
+        self.info = {}
+        self.info_channel = InfoChannel()
         self.name = name
         self.main_engine = main_engine
 
@@ -40,9 +50,9 @@ class MinimalEngine(EngineWrapper):
     however you can also change other methods like
     `notify`, `first_search`, `get_time_control`, etc.
     """
-    def __init__(self, commands, options, stderr, name=None):
-        super().__init__(options)
-        self.go_commands = options.pop("go_commands", {}) or {}
+    def __init__(self, commands, options, go_commands=None, stderr=None, name=None, startup_lines=0, cwd=None):
+        super().__init__(go_commands or {})
+        self.options = options or {}
 
         self.engine_name = self.__class__.__name__ if name is None else name
 
@@ -55,7 +65,21 @@ class MinimalEngine(EngineWrapper):
     def search_for(self, board, game, movetime):
         return self.search(board, movetime, False)
 
-    def search(self, board, ponder):
+    def search_with_budget(self, game, board, budget):
+        return self.search(board, budget.hard, False)
+
+    def search_with_ponder(self, game, board, btime, wtime, binc, winc, byo, ponder=False):
+        return self.search(board, self.time_limit(board, btime, wtime, binc, winc, byo), ponder)
+
+    def time_limit(self, board, btime, wtime, binc, winc, byo):
+        """Milliseconds to search: "movetime" of `go_commands`, or a share of the clock."""
+        movetime = self.go_commands.get("movetime")
+        if movetime is not None:
+            return float(movetime)
+        time_left, increment = (btime, binc) if board.turn == shogi.BLACK else (wtime, winc)
+        return max(50, time_left / 30 + 0.8 * ((increment or 0) + (byo or 0)))
+
+    def search(self, board, time_limit, ponder):
         raise NotImplementedError("The search method is not implemented")
 
     def notify(self, method_name, *args, **kwargs):
@@ -88,4 +112,79 @@ class FirstMove(ExampleEngine):
     def search(self, board, *args):
         moves = list(board.legal_moves)
         moves.sort(key=str)
-        return moves[0].usi(), None
\ No newline at end of file
+        return moves[0].usi(), None
+
+
+class AlphaBeta(ExampleEngine):
+    """
+    Iterative deepening alpha-beta search (see alphabeta.py) in Python. It is far weaker
+    than a USI engine but always available. The transposition table takes
+    `homemade_options: Hash` megabytes, 16 by default. `go_commands` "depth", "nodes"
+    and "movetime" are respected.
+    """
+    def __init__(self, commands, options, go_commands=None, stderr=None, name=None, startup_lines=0, cwd=None):
+        super().__init__(commands, options, go_commands, stderr, name)
+        self.searcher = alphabeta.Searcher(int(self.options.get("Hash", 16)))
+        self.stopped = threading.Event()
+        self.ponder_hit = threading.Event()
+        self.time_limit_seconds = None
+
+    def search(self, board, time_limit, ponder, stop_condition=None):
+        searcher = self.searcher
+        started = time.monotonic()
+        # stop() and ponderhit() may arrive before a ponder search starts
+        if not ponder:
+            self.stopped.clear()
+            self.ponder_hit.set()
+        self.time_limit_seconds = time_limit / 1000
+        searcher.deadline = None if ponder else started + self.time_limit_seconds
+        searcher.max_nodes = self.go_commands.get("nodes")
+        searcher.should_stop = self.should_stop
+
+        best_move, ponder_move = None, None
+        info = {}
+        self.engine.info_channel.begin()
+        for depth, score, pv in searcher.iterate(board, int(self.go_commands.get("depth") or alphabeta.MAX_PLY)):
+            best_move = pv[0].usi()
+            ponder_move = pv[1].usi() if len(pv) > 1 else None
+            elapsed = time.monotonic() - started
+            info = {"depth": depth, "score": alphabeta.usi_score(score), "nodes": searcher.nodes, "nps": int(searcher.nodes / max(elapsed, 0.001)),
+                    "time": int(elapsed * 1000), "pv": " ".join(move.usi() for move in pv)}
+            self.engine.info = info
+            self.engine.info_channel.offer(info)
+            if stop_condition is not None and stop_condition(info):
+                break
+            # The next depth would take several times longer than all of them so far
+            deadline = searcher.deadline
+            if deadline is not None and time.monotonic() - started > (deadline - started) / 2:
+                break
+        self.stopped.clear()
+        self.ponder_hit.clear()
+        self.engine.info_channel.end(info)
+        if best_move is None:
+            moves = list(board.legal_moves)
+            best_move = moves[0].usi() if moves else None
+        self.print_stats()
+        return best_move, ponder_move
+
+    def search_with_budget(self, game, board, budget):
+        return self.search(board, budget.hard, False, None if budget.is_fixed() else budget.should_stop)
+
+    def should_stop(self):
+        if self.stopped.is_set():
+            return True
+        # After ponderhit() the search gets the time it was given when it started
+        if self.searcher.deadline is None and self.ponder_hit.is_set():
+            self.searcher.deadline = time.monotonic() + self.time_limit_seconds
+        return False
+
+    def ponderhit(self):
+        self.ponder_hit.set()
+
+    def stop(self):
+        self.stopped.set()
+
+    def reset(self):
+        self.stopped.clear()
+        self.ponder_hit.clear()
+        self.searcher.new_game()
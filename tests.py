@@ -1,4 +1,8 @@
+import io
 import os
+import json
+import queue
+import contextlib
 import pytest
 import pytest_timeout
 import requests
@@ -6,16 +10,880 @@ import time
 import zipfile
 import yaml
 import shutil
+import random
+import threading
 import importlib
+import logging
+import http.server
+import shogi
+from search_cache import SearchCache, SearchResult, PonderStore, board_key
+from time_manager import TimeManager
+from model import Game, GameState, append_moves
+from engine_wrapper import RacingEngine, EnginePool
+from correspondence import CorrespondenceScheduler
+from idle import IdleScheduler
+from book import OpeningBook
+from config import load_config
+from timers import TimerService
+from log_handlers import GameLog
+from outbox import Outbox, MAX_CHAT_LENGTH
+from profiler import Profiler
+from conversation import Conversation, ChatLine
+import position
+import tsume
+import impasse
+import analysis
+import checkpoint
+import ndjson
+import engine_wrapper
+import idle
+import lishogi
+import socket
+import sys
+from engine_ctrl import remote, server
+from engine_ctrl.snapshots import InfoChannel, MATE_SCORE
+from engine_wrapper import RemoteUSIEngine
+from benchmark import SEARCH_POSITIONS, TSUME_PROBLEMS, board_perft
 lishogi_bot = importlib.import_module("lishogi-bot")
 
-TOKEN = os.environ['BOT_TOKEN']
+# Only test_bot plays on lishogi, the other tests run offline
+TOKEN = os.environ.get('BOT_TOKEN')
 
 
 def test_nothing():
     assert True
 
 
+def test_search_cache_keeps_deeper_result():
+    cache = SearchCache()
+    cache.put(SearchResult("key", "7g7f", "3c3d", {"depth": 20}))
+    cache.put(SearchResult("key", "2g2f", "8c8d", {"depth": 10}))
+    assert cache.get("key").best_move == "7g7f"
+    cache.put(SearchResult("key", "2g2f", "8c8d", {"depth": 25}))
+    assert cache.get("key").best_move == "2g2f"
+    assert cache.get("key", min_depth=30) is None
+    assert len(cache) == 1
+
+
+def test_search_cache_evicts_least_recently_used():
+    cache = SearchCache(max_size=2)
+    cache.put(SearchResult("a", "7g7f", None, {"depth": 1}))
+    cache.put(SearchResult("b", "2g2f", None, {"depth": 1}))
+    assert cache.get("a") is not None
+    cache.put(SearchResult("c", "5g5f", None, {"depth": 1}))
+    assert cache.get("b") is None
+    assert cache.get("a") is not None
+    assert cache.get("c") is not None
+
+
+def test_search_cache_ignores_results_without_move():
+    cache = SearchCache()
+    cache.put(None)
+    cache.put(SearchResult("a", None, None, {"depth": 30}))
+    cache.put(SearchResult(None, "7g7f", None, {"depth": 30}))
+    assert len(cache) == 0
+
+
+def test_ponder_store_matches_position():
+    store = PonderStore()
+    store.put("game", SearchResult("key", "7g7f", "3c3d", {"depth": 12}))
+    assert store.get("game", "other key") is None
+    assert store.get("game", "key").best_move == "7g7f"
+    assert store.pop("game").best_move == "7g7f"
+    assert store.get("game") is None
+
+
+def test_finished_ponder_search_is_played():
+    class Engine:
+        def ponderhit(self):
+            raise AssertionError("the ponder search had already finished")
+
+    class Game:
+        id = "game"
+        variant_name = "Standard"
+
+    board = shogi.Board()
+    board.push_usi("7g7f")
+    board.push_usi("3c3d")
+    key = lishogi_bot.position_key(Game, board)
+    ponder_thread = threading.Thread(target=lishogi_bot.ponder_results.put, args=(Game.id, SearchResult(key, "2g2f", "8c8d", {"depth": 15})))
+    ponder_thread.start()
+    ponder_thread.join()
+    moves = [shogi.Move.from_usi("7g7f"), shogi.Move.from_usi("3c3d")]
+    assert lishogi_bot.get_pondering_result(Engine(), Game, moves, ponder_thread, "3c3d") == ("2g2f", "8c8d")
+    assert lishogi_bot.get_cached_move(Game, board, 15) == ("2g2f", "8c8d")
+    assert lishogi_bot.get_cached_move(Game, board, 16) == (None, None)
+
+
+def test_search_cache_key_counts_repetitions():
+    board = shogi.Board()
+    first = lishogi_bot.position_key(make_game(), board)
+    for move in ["5i4h", "5a4b", "4h5i", "4b5a"]:
+        board.push_usi(move)
+    # the same position once more, where the remembered move may now lead into sennichite
+    assert board.sfen().split()[:3] == shogi.Board().sfen().split()[:3]
+    assert lishogi_bot.position_key(make_game(), board) == first + " 2"
+
+
+def test_shallow_cached_move_is_played_when_low_on_time():
+    board = middlegame_board()
+    lishogi_bot.search_cache.put(SearchResult(lishogi_bot.position_key(make_game(), board), "2g2f", "8c8d", {"depth": 3}))
+    assert lishogi_bot.get_cached_move(make_game(), board, 20) == (None, None)
+    assert lishogi_bot.get_low_time_move(make_game(btime=60000), board, 2000) == (None, None)
+    assert lishogi_bot.get_low_time_move(make_game(btime=1500), board, 2000) == ("2g2f", "8c8d")
+    # byoyomi counts as time left for the move
+    assert lishogi_bot.get_low_time_move(make_game(btime=0, byo=5000), board, 2000) == (None, None)
+
+
+def game_full(moves="", btime=60000, wtime=60000, binc=0, winc=0, byo=0, perf="Blitz", game_id="game"):
+    return {"id": game_id, "variant": {"name": "Standard"}, "perf": {"name": perf}, "initialSfen": "startpos",
+            "sente": {"name": "bot"}, "gote": {"name": "opponent"},
+            "state": {"moves": moves, "btime": btime, "wtime": wtime, "binc": binc, "winc": winc, "byo": byo, "status": "started"}}
+
+
+def make_game(moves="", btime=60000, wtime=60000, binc=0, winc=0, byo=0, perf="Blitz"):
+    return Game(game_full(moves, btime, wtime, binc, winc, byo, perf), "bot", "https://lishogi.org/", 30)
+
+
+def middlegame_board():
+    # 40 plies with sente to move
+    board = shogi.Board()
+    for _ in range(10):
+        for move in ["5i4h", "5a4b", "4h5i", "4b5a"]:
+            board.push_usi(move)
+    return board
+
+
+def test_time_manager_first_move():
+    time_manager = TimeManager({"first_move_time": 800}, 0, 60000)
+    budget = time_manager.plan(make_game(), shogi.Board(), time.perf_counter_ns())
+    assert budget.soft == budget.hard == 800
+
+
+def test_time_manager_spends_byoyomi():
+    time_manager = TimeManager({"min_overhead": 300}, 0, 60000)
+    budget = time_manager.plan(make_game(btime=0, wtime=0, byo=10000), middlegame_board(), time.perf_counter_ns())
+    assert budget.soft == budget.hard == 10000 - 300
+
+
+def test_time_manager_uses_increment():
+    time_manager = TimeManager({"min_overhead": 300}, 0, 60000)
+    budget = time_manager.plan(make_game(btime=60000, binc=5000), middlegame_board(), time.perf_counter_ns())
+    # (59700 / 50 moves to go + 0.8 * 5000) * 1.2 for the middlegame
+    assert abs(budget.soft - 3739) <= 2
+    assert abs(budget.hard - 59700 * 0.25) <= 2
+    # Almost out of time, the increment is still used but not more than what is left on the clock
+    budget = time_manager.plan(make_game(btime=1000, binc=5000), middlegame_board(), time.perf_counter_ns())
+    assert 690 <= budget.hard <= 700
+    assert budget.soft <= budget.hard
+
+
+def test_append_moves():
+    moves = []
+    known = append_moves(moves, "", "7g7f 3c3d")
+    assert moves == ["7g7f", "3c3d"] and known == "7g7f 3c3d"
+    known = append_moves(moves, known, "7g7f 3c3d 2g2f")
+    assert moves == ["7g7f", "3c3d", "2g2f"]
+    # A takeback doesn't start with the known moves
+    known = append_moves(moves, known, "7g7f 3c3d")
+    assert moves == ["7g7f", "3c3d"]
+    # Neither does a move that only starts like a longer one
+    known = append_moves(moves, known, "7g7f 3c3d+ 2g2f")
+    assert moves == ["7g7f", "3c3d+", "2g2f"]
+    # Nor a takeback followed by other moves of the same length that end with the same move
+    known = append_moves(moves, known, "7g7f 3c3d 2g2f")
+    known = append_moves(moves, known, "2g2f 3c3d 2g2f")
+    assert moves == ["2g2f", "3c3d", "2g2f"]
+    assert append_moves(moves, known, "") == "" and moves == []
+
+
+def test_game_state_update():
+    state = GameState({"moves": "7g7f", "btime": 1000, "wtime": 2000, "byo": 10000, "status": "started"})
+    moves = state.moves
+    state.update({"moves": "7g7f 3c3d", "btime": 900, "wtime": 2000, "binc": 5, "winc": 6, "status": "started"})
+    # Consumers can keep a reference to the move list
+    assert state.moves is moves and moves == ["7g7f", "3c3d"]
+    assert (state.time("b"), state.time("w"), state.inc("b"), state.inc("w"), state.byo) == (900, 2000, 5, 6, 0)
+    assert state.to_dict()["moves"] == "7g7f 3c3d"
+    assert GameState(state.to_dict()).to_dict() == state.to_dict()
+
+
+def test_game():
+    game = make_game("7g7f 3c3d", btime=30000)
+    assert game.is_sente and game.my_color == "sente" and game.opponent.name == "opponent"
+    assert game.moves() == ["7g7f", "3c3d"] and not game.is_abortable()
+    assert game.my_remaining_seconds() == 30
+    assert game.sente_starts
+    # Games have slots only, so a misspelt attribute fails instead of being ignored
+    with pytest.raises(AttributeError):
+        game.unknown = True
+
+
+def test_position_perft():
+    assert position.Position().perft(3) == 25470
+    for sfen in SEARCH_POSITIONS[:2]:
+        assert position.Position(sfen).perft(2) == board_perft(shogi.Board(sfen), 2)
+
+
+def test_position_follows_board():
+    generator = random.Random(1)
+    for sfen in SEARCH_POSITIONS:
+        board = shogi.Board(sfen)
+        pos = position.Position(sfen)
+        sfens = []
+        for _ in range(60):
+            moves = sorted(move.usi() for move in board.legal_moves)
+            assert sorted(map(position.usi, pos.legal_moves())) == moves
+            assert pos.sfen() == board.sfen()
+            assert pos.key == pos.compute_key()
+            if not moves:
+                break
+            move = generator.choice(moves)
+            sfens.append(pos.sfen())
+            board.push_usi(move)
+            pos.push(position.parse_usi(move))
+        # Popping every move gives back the same positions and keys
+        while sfens:
+            pos.pop()
+            assert pos.sfen() == sfens.pop()
+            assert pos.key == pos.compute_key()
+
+
+def test_mate_solver_forgets_ply_limited_disproofs():
+    sfen, plies = TSUME_PROBLEMS[3]
+    mate = tsume.MateSolver().solve(sfen)
+    assert len(mate) == plies
+    # Too deep for this solver from the start, but not after the first two moves
+    solver = tsume.MateSolver(max_plies=plies - 2)
+    assert solver.solve(sfen) is None
+    board = shogi.Board(sfen)
+    board.push_usi(mate[0])
+    board.push_usi(mate[1])
+    assert len(solver.solve(board) or []) == plies - 2
+
+
+def test_impasse_declaration():
+    board = shogi.Board("RB7/4K4/PPPPPPPP1/9/9/9/9/9/8k b RB 1")
+    assert impasse.ImpasseTracker(board).can_declare(board)
+    # 27 points are one short for sente
+    board = shogi.Board("RB7/4K4/PPPPPPPP1/9/9/9/9/9/8k b R4P 1")
+    assert not impasse.ImpasseTracker(board).can_declare(board)
+    board = shogi.Board("RB7/4K4/PPPPPPPP1/9/9/9/9/9/8k w RB 1")
+    assert not impasse.ImpasseTracker(board).can_declare(board)
+
+
+def test_impasse_tracker_follows_moves():
+    generator = random.Random(2)
+    for sfen in SEARCH_POSITIONS:
+        board = shogi.Board(sfen)
+        tracker = impasse.ImpasseTracker(board)
+        for _ in range(80):
+            moves = list(board.legal_moves)
+            if not moves:
+                break
+            move = generator.choice(moves)
+            tracker.push(board, move)
+            board.push(move)
+            rescanned = impasse.ImpasseTracker(board)
+            assert (tracker.kings, tracker.pieces, tracker.points) == (rescanned.kings, rescanned.pieces, rescanned.points)
+
+
+def test_analysis_output_is_resumed_after_last_id(tmp_path):
+    output = tmp_path / "analysis.jsonl"
+    assert analysis.read_output(str(output)) == (0, None)
+    output.write_text('{"id": "a.txt:1"}\n{"id": "a.txt:2"}\n{"id": "a.t')
+    assert analysis.read_output(str(output)) == (2, "a.txt:2")
+    # The line cut short is dropped
+    assert output.read_text() == '{"id": "a.txt:1"}\n{"id": "a.txt:2"}\n'
+    positions = tmp_path / "b.txt"
+    positions.write_text("startpos\nstartpos moves 7g7f\n")
+    with pytest.raises(Exception, match="doesn't continue these inputs"):
+        analysis.analyse({"engine": {"protocol": "usi"}}, [str(positions)], str(output), {"depth": 1})
+    with pytest.raises(Exception, match="needs a USI engine"):
+        analysis.analyse({"engine": {"protocol": "homemade"}}, [str(positions)], str(output), {"depth": 1})
+
+
+class RaceEngine:
+    def __init__(self, best_move, delay, go_delay=0):
+        self.engine = None
+        self.best_move = best_move
+        self.delay = delay
+        self.go_delay = go_delay
+        self.searching = threading.Event()
+        self.stopped = threading.Event()
+
+    def search(self, sfen, moves, **kwargs):
+        if self.best_move is None:
+            raise RuntimeError("engine crashed")
+        time.sleep(self.go_delay)
+        # Like a USI engine, a stop sent before go is lost
+        self.stopped.clear()
+        self.searching.set()
+        self.stopped.wait(self.delay)
+        self.searching.clear()
+        return self.best_move, None
+
+    def wait_searching(self, timeout):
+        return self.searching.wait(timeout)
+
+    def get_info(self):
+        return {"depth": 10}
+
+    def stop(self):
+        self.stopped.set()
+
+    def name(self):
+        return self.best_move or "crashed"
+
+
+def test_race_skips_failed_engine():
+    Engine = RaceEngine
+    race = RacingEngine([Engine(None, 0), Engine("7g7f", 0.1)], policy="first")
+    assert race.search("startpos", []) == ("7g7f", None)
+    race = RacingEngine([Engine(None, 0), Engine(None, 0)], policy="first")
+    assert race.search("startpos", []) == (None, None)
+
+
+def test_race_stops_engines_that_start_late():
+    # The slow engine is sent go after the fast one answers, and would search forever if it missed the stop
+    race = RacingEngine([RaceEngine("7g7f", 0), RaceEngine("2g2f", None, go_delay=0.2)], policy="first")
+    thread = threading.Thread(target=lambda: race.search("startpos", []), daemon=True)
+    thread.start()
+    thread.join(5)
+    assert not thread.is_alive()
+
+
+STUB_USI_ENGINE = """
+import sys
+for line in sys.stdin:
+    command = line.split()[0] if line.split() else ""
+    if command == "usi":
+        print("id name stub\\nusiok", flush=True)
+    elif command == "isready":
+        print("readyok", flush=True)
+    elif command == "go":
+        print("info depth 1 score cp 0 pv 7g7f\\nbestmove 7g7f", flush=True)
+    elif command == "quit":
+        break
+"""
+
+
+def test_engine_server_over_loopback(tmp_path):
+    stub = tmp_path / "stub.py"
+    stub.write_text(STUB_USI_ENGINE)
+    pool = server.EnginePool(f"{sys.executable} {stub}", str(tmp_path), 0, 1)
+    engine_server = server.EngineServer(("127.0.0.1", 0), pool, "secret")
+    threading.Thread(target=engine_server.serve_forever, daemon=True).start()
+    address = engine_server.server_address
+    try:
+        # a wrong token gets no engine
+        with socket.create_connection(address, timeout=5) as sock:
+            sock.sendall(b"#auth wrong\nusi\n")
+            assert sock.makefile("r").read() == "#denied\n"
+
+        engine = RemoteUSIEngine([address], {}, {}, heartbeat=0.05, timeout=5, token="secret")
+        connection = engine.engine.proccess
+        assert engine.name() == "stub"
+        assert engine.search("startpos", [], movetime=100) == ("7g7f", None)
+        # the heartbeat's #ping is answered with #pong through the engine
+        deadline = time.monotonic() + 5
+        while engine.engine.latency() is None and time.monotonic() < deadline:
+            time.sleep(0.05)
+        assert engine.engine.latency() is not None
+        # #release is answered with #released, and the connection is kept for the next engine
+        engine.kill_process()
+        assert connection.alive
+        assert remote.idle_connections[address] == [connection]
+
+        engine = RemoteUSIEngine([address], {}, {}, heartbeat=0.05, timeout=5, token="secret")
+        assert engine.engine.proccess is connection
+        assert engine.search("startpos", ["7g7f"], movetime=100) == ("7g7f", None)
+        engine.kill_process()
+    finally:
+        engine_server.shutdown()
+        engine_server.server_close()
+        for connection in remote.idle_connections.pop(address, []):
+            connection.close()
+        while not pool.idle.empty():
+            pool.idle.get().engine.kill_process()
+
+
+class IdleEngine:
+    def __init__(self):
+        self.running = True
+
+    def reset(self):
+        pass
+
+    def quit(self):
+        self.running = False
+
+    def kill_process(self):
+        pass
+
+
+def test_engine_pool_keeps_warm_engines_per_profile():
+    config = {"engine": {"warm": 1, "max_warm": 2}, "engine_profiles": {"fast": {}, "heavy": {}}}
+    pool = EnginePool()
+    default, fast, extra, heavy = IdleEngine(), IdleEngine(), IdleEngine(), IdleEngine()
+    pool.release(config, default)
+    pool.release(config, fast, "fast")
+    # only `warm` engines of each profile are kept
+    pool.release(config, extra, "fast")
+    assert not extra.running
+    # over `max_warm`, the profile released least recently gives its engine up
+    pool.release(config, heavy, "heavy")
+    assert not default.running
+    assert fast.running and heavy.running
+    assert pool.acquire(config, "fast") is fast
+    assert pool.acquire(config, "heavy") is heavy
+
+
+def test_correspondence_scheduler_most_urgent_first():
+    scheduler = CorrespondenceScheduler()
+    scheduler.update([{"gameId": "slow", "perf": "correspondence", "isMyTurn": True, "secondsLeft": 3000},
+                      {"gameId": "urgent", "perf": "correspondence", "isMyTurn": True, "secondsLeft": 100},
+                      {"gameId": "unlimited", "perf": "correspondence", "isMyTurn": True},
+                      {"gameId": "waiting", "perf": "correspondence", "isMyTurn": False},
+                      {"gameId": "blitz", "perf": "blitz", "isMyTurn": True, "secondsLeft": 10}])
+    assert len(scheduler) == 3
+    assert "waiting" in scheduler and "blitz" not in scheduler
+    # A game pushed again is only popped once, with its new deadline
+    scheduler.push("slow", time.time() + 50)
+    assert [scheduler.pop(), scheduler.pop(), scheduler.pop(), scheduler.pop()] == ["slow", "urgent", "unlimited", None]
+    assert not scheduler.has_due_games()
+
+
+def test_correspondence_scheduler_reschedules_finished_process():
+    scheduler = CorrespondenceScheduler()
+    ongoing = [{"gameId": "game", "perf": "correspondence", "isMyTurn": True, "secondsLeft": 100}]
+    scheduler.update(ongoing)
+    assert scheduler.pop() == "game"
+    # Games in progress are left alone until their process is done with them
+    scheduler.update(ongoing)
+    assert not scheduler.has_due_games()
+    scheduler.done("game")
+    scheduler.update(ongoing)
+    assert scheduler.pop() == "game"
+    scheduler.wait("game")
+    scheduler.update([])
+    assert "game" not in scheduler
+
+
+def test_game_start_resumes_real_time_games():
+    scheduler = CorrespondenceScheduler()
+    # a game ongoing at startup where it is the opponent's turn, with pondering on
+    assert lishogi_bot.game_start_action("ponder", False, set(), scheduler, {"ponder": 30}, [], False, True) == "resume"
+    # a new game while every process is busy
+    assert lishogi_bot.game_start_action("late", False, set(), scheduler, {}, [], True, False) == "resume"
+    assert lishogi_bot.game_start_action("new", False, set(), scheduler, {}, [], False, False) == "play"
+    assert lishogi_bot.game_start_action("new", False, {"new"}, scheduler, {}, [], False, False) == "ignore"
+
+
+def test_game_start_ignores_games_waiting_to_resume():
+    resume_games, active_games = [], set()
+    lishogi_bot.push_resumed_game(resume_games, active_games, "late", 30)
+    # the event stream repeats gameStart for every ongoing game when it reconnects
+    assert lishogi_bot.game_start_action("late", False, active_games, CorrespondenceScheduler(), {}, [], False, False) == "ignore"
+    assert resume_games == [(30, "late")]
+
+
+def test_game_start_waits_for_correspondence_games():
+    scheduler = CorrespondenceScheduler()
+    assert lishogi_bot.game_start_action("corr", True, set(), scheduler, {}, ["corr"], True, False) == "wait"
+    assert lishogi_bot.game_start_action("corr", True, set(), scheduler, {}, ["corr"], False, True) == "wait"
+    assert lishogi_bot.game_start_action("corr", True, set(), scheduler, {}, ["corr"], False, False) == "schedule"
+    scheduler.push("corr")
+    assert lishogi_bot.game_start_action("corr", True, set(), scheduler, {}, [], False, False) == "scheduled"
+
+
+class CorrespondenceLishogi:
+    baseUrl = "https://lishogi.org/"
+
+    def __init__(self, games):
+        self.games = games
+        self.moves = []
+
+    @contextlib.contextmanager
+    def get_game_stream(self, game_id):
+        response = requests.Response()
+        response.raw = io.BytesIO(json.dumps(self.games[game_id]).encode("utf-8") + b"\n")
+        yield response
+
+    def make_move(self, game_id, move):
+        self.moves.append((game_id, move))
+
+
+def test_correspondence_batch_worker_moves_only_where_it_is_the_bots_turn():
+    li = CorrespondenceLishogi({"mine": game_full(perf="Correspondence", game_id="mine"),
+                                "theirs": game_full("7g7f", perf="Correspondence", game_id="theirs")})
+    config = {"engine": {"dir": "engines", "name": "AlphaBeta", "protocol": "homemade", "go_commands": {"depth": 1}},
+              "correspondence": {"move_time": 1}}
+    batch_queue, control_queue = queue.Queue(), queue.Queue()
+    for game_id in ["mine", "theirs", None]:
+        batch_queue.put(game_id)
+    lishogi_bot.correspondence_batch_worker(li, config, {"username": "bot"}, batch_queue, control_queue)
+    assert [game_id for game_id, move in li.moves] == ["mine"]
+    assert shogi.Move.from_usi(li.moves[0][1]) in shogi.Board().legal_moves
+    # each game is handed back to the scheduler, whether a move was needed or not
+    assert [control_queue.get_nowait() for _ in range(2)] == [{"type": "correspondence_move", "id": "mine"},
+                                                             {"type": "correspondence_move", "id": "theirs"}]
+
+
+class ChatLishogi:
+    def __init__(self):
+        self.messages = []
+        self.condition = threading.Condition()
+
+    def chat(self, game_id, room, text):
+        with self.condition:
+            self.messages.append((game_id, room, text))
+            self.condition.notify_all()
+
+    def wait_for(self, count):
+        with self.condition:
+            assert self.condition.wait_for(lambda: len(self.messages) >= count, 5)
+            return self.messages
+
+
+def test_outbox_joins_messages_for_the_same_room():
+    li = ChatLishogi()
+    outbox = Outbox(li)
+    with outbox.sending_move("game"):
+        outbox.chat("game", "player", "Good luck!")
+        outbox.chat("game", "player", "Have fun!")
+        outbox.chat("game", "spectator", "Hello")
+        outbox.chat("game", "spectator", "x" * MAX_CHAT_LENGTH)
+        time.sleep(0.1)
+        # nothing is posted while a move is being sent
+        assert li.messages == []
+    assert li.wait_for(3) == [("game", "player", "Good luck! Have fun!"), ("game", "spectator", "Hello"), ("game", "spectator", "x" * MAX_CHAT_LENGTH)]
+
+
+def test_outbox_drops_replies_under_time_pressure():
+    li = ChatLishogi()
+    outbox = Outbox(li)
+    with outbox.sending_move("game"):
+        outbox.chat("game", "spectator", "depth 20")
+        outbox.chat("game", "player", "Good game", droppable=False)
+        outbox.chat("other", "spectator", "depth 10")
+        outbox.set_time_pressure("game", True)
+        outbox.chat("game", "spectator", "depth 21")
+    assert li.wait_for(2) == [("game", "player", "Good game"), ("other", "spectator", "depth 10")]
+    outbox.set_time_pressure("game", False)
+    outbox.chat("game", "spectator", "depth 22")
+    assert li.wait_for(3)[2] == ("game", "spectator", "depth 22")
+
+
+def test_checkpoint_survives_a_cut_short_line(tmp_path):
+    directory = str(tmp_path / "checkpoints")
+    game_checkpoint = checkpoint.GameCheckpoint(directory, "game")
+    assert game_checkpoint.load() is None
+    game_checkpoint.append({"seconds_left": 300, "profile": None})
+    game_checkpoint.append({"results": [{"key": "a"}]})
+    # a crash while writing leaves half a line
+    with open(game_checkpoint.path, "a") as file:
+        file.write('{"seconds_left": 1')
+    game_checkpoint.append({"seconds_left": 200, "results": [{"key": "b"}]})
+    assert game_checkpoint.load() == {"seconds_left": 200, "profile": None, "results": [{"key": "a"}, {"key": "b"}]}
+
+
+def test_checkpoints_of_finished_games_are_removed(tmp_path):
+    directory = str(tmp_path)
+    for game_id in ["ongoing", "finished"]:
+        checkpoint.GameCheckpoint(directory, game_id).append({"seconds_left": 60})
+    checkpoint.remove_finished(directory, {"ongoing"})
+    assert list(checkpoint.load_checkpoints(directory)) == ["ongoing"]
+    assert checkpoint.load_checkpoints(str(tmp_path / "missing")) == {}
+
+
+def test_profiler_writes_profile_on_second_toggle(tmp_path):
+    profiler = Profiler(str(tmp_path))
+    profiler.toggle()
+    assert [name.endswith("-threads.txt") for name in os.listdir(tmp_path)] == [True]
+    board_perft(shogi.Board(), 2)
+    profiler.toggle()
+    assert profiler.profile is None
+    for suffix in [".prof", "-cpu.txt", "-memory.txt", "-threads.txt"]:
+        assert list(tmp_path.glob(f"*{suffix}"))
+    with open(next(tmp_path.glob("*-cpu.txt"))) as file:
+        assert "board_perft" in file.read()
+
+
+def test_only_admins_toggle_profiling():
+    toggles = []
+    li = ChatLishogi()
+    conversation = Conversation(make_game(), None, li, "1.0", [], ["Admin"], lambda: toggles.append(True))
+    conversation.react(ChatLine({"room": "player", "username": "opponent", "text": "!profile"}), make_game())
+    assert toggles == [] and li.messages == []
+    conversation.react(ChatLine({"room": "spectator", "username": "admin", "text": "!profile"}), make_game())
+    assert toggles == [True]
+    assert li.messages == [("game", "spectator", "Profiling toggled.")]
+
+
+def test_ndjson_falls_back_to_json_without_orjson(monkeypatch):
+    line = '{"type": "chatLine", "text": "よろしく", "moves": [1, 2.5, null]}'.encode("utf-8")
+    expected = {"type": "chatLine", "text": "よろしく", "moves": [1, 2.5, None]}
+    assert ndjson.decode(line) == expected
+    monkeypatch.setitem(sys.modules, "orjson", None)
+    try:
+        importlib.reload(ndjson)
+        assert ndjson.backend == "json"
+        assert ndjson.decode(line) == expected
+        # the empty lines that keep streams alive
+        assert ndjson.decode(b"") is None
+    finally:
+        monkeypatch.undo()
+        importlib.reload(ndjson)
+
+
+def test_alphabeta_finds_mate_in_one():
+    engine = engine_wrapper.engine_from_cfg({"dir": "engines", "name": "AlphaBeta", "protocol": "homemade"})
+    board = shogi.Board("4k4/9/4P4/9/9/9/9/9/4K4 b G 1")
+    assert engine.search_for(board, make_game(), 5000) == ("G*5b", None)
+    assert engine.get_info()["score"] == {"mate": 1}
+
+
+def test_alphabeta_respects_time_limit():
+    engine = engine_wrapper.engine_from_cfg({"dir": "engines", "name": "AlphaBeta", "protocol": "homemade"})
+    start = time.monotonic()
+    best_move, ponder_move = engine.search_for(middlegame_board(), make_game(), 300)
+    assert time.monotonic() - start < 1
+    assert shogi.Move.from_usi(best_move) in middlegame_board().legal_moves
+
+
+def write_config(tmp_path, **sections):
+    config = {"token": "token", "url": "https://lishogi.org/",
+              "engine": {"dir": str(tmp_path), "name": "missing", "protocol": "usi"},
+              "challenge": {"modes": ["casual", "rated"]}}
+    for name, section in sections.items():
+        if isinstance(section, dict) and isinstance(config.get(name), dict):
+            config[name] = {**config[name], **section}
+        else:
+            config[name] = section
+    path = tmp_path / "config.yml"
+    path.write_text(yaml.safe_dump(config))
+    return str(path)
+
+
+def test_config_falls_back_to_homemade_engine(tmp_path):
+    config = load_config(write_config(tmp_path, engine={"fallback": "AlphaBeta"}, engine_profiles={"bullet": {"name": "also_missing", "speeds": ["bullet"]}}))
+    assert (config["engine"]["protocol"], config["engine"]["name"]) == ("homemade", "AlphaBeta")
+    assert config["engine_profiles"]["bullet"] == {"protocol": "homemade", "name": "AlphaBeta", "speeds": ["bullet"]}
+    # the fallback engine doesn't play rated games
+    assert config["challenge"]["modes"] == ["casual"]
+
+
+def test_config_rejects_missing_engines_without_fallback(tmp_path):
+    with pytest.raises(Exception, match="does not exist"):
+        load_config(write_config(tmp_path))
+    with pytest.raises(Exception, match="engine profile `bullet` does not exist"):
+        load_config(write_config(tmp_path, engine={"protocol": "homemade", "name": "AlphaBeta"}, engine_profiles={"bullet": {"protocol": "usi", "name": "missing"}}))
+    with pytest.raises(Exception, match="Engine profile `bullet` must be a dictionary"):
+        load_config(write_config(tmp_path, engine={"protocol": "homemade", "name": "AlphaBeta"}, engine_profiles={"bullet": "fast"}))
+
+
+def idle_result(sfen, best_move, ponder_move):
+    return {"stopped": False, "result": SearchResult(board_key(shogi.Board(sfen)), best_move, ponder_move, {"depth": 20}).to_dict()}
+
+
+def test_idle_scheduler_order():
+    results = {}
+    scheduler = IdleScheduler({"movetime": 100, "max_movetime": 250, "review_movetime": 10}, results)
+    start = shogi.STARTING_SFEN
+    job = scheduler.next_job()
+    assert job == (start, 100)
+    scheduler.record_result(job, idle_result(start, "7g7f", "3c3d"))
+    assert results[board_key(shogi.Board())]["best_move"] == "7g7f"
+    board = shogi.Board()
+    for move in ["7g7f", "3c3d"]:
+        board.push_usi(move)
+    reply = board.sfen()
+    for _ in range(2):
+        scheduler.record_game("startpos", ["7g7f", "3c3d", "2g2f"], True)
+    # the positions of finished games first, then the expected replies, then the positions met most often
+    assert [scheduler.next_job() for _ in range(4)] == [(start, 10), (reply, 10), (start, 10), (reply, 10)]
+    job = scheduler.next_job()
+    assert job == (reply, 100)
+    scheduler.record_result(job, idle_result(reply, "2g2f", None))
+    assert scheduler.next_job() == (start, 200)
+    scheduler.record_result((start, 200), idle_result(start, "7g7f", "3c3d"))
+    assert scheduler.next_job() == (reply, 200)
+
+
+def test_stopped_idle_search_is_retried():
+    scheduler = IdleScheduler({}, {})
+    job = scheduler.next_job()
+    stop_event = threading.Event()
+    stop_event.set()
+    # a stop requested before the search starts doesn't even take an engine
+    result = idle.search_position({}, job[0], job[1], stop_event)
+    assert result == {"stopped": True}
+    scheduler.record_result(job, result)
+    assert scheduler.next_job() == job
+    assert scheduler.results == {}
+
+
+def test_config_rejects_idle_analysis_without_search_cache(tmp_path):
+    engine = {"protocol": "homemade", "name": "AlphaBeta"}
+    assert load_config(write_config(tmp_path, engine=engine, idle_analysis={"enabled": True}))["idle_analysis"]["enabled"]
+    with pytest.raises(Exception, match="min_depth"):
+        load_config(write_config(tmp_path, engine={**engine, "search_cache": {"min_depth": 0}}, idle_analysis={"enabled": True}))
+
+
+def finished_game(game_id, moves, winner, status="resign"):
+    json = game_full(moves, game_id=game_id)
+    json["state"].update({"status": status, "winner": winner})
+    return Game(json, "bot", "https://lishogi.org/", 30)
+
+
+def test_opening_book_compiles_only_new_games(tmp_path):
+    path = str(tmp_path / "book.sqlite")
+    opening_book = OpeningBook({"path": path, "min_games": 2, "min_score": 0.5})
+    assert opening_book.compile() == 0
+    opening_book.record_game(finished_game("won", "7g7f 3c3d 2g2f", "sente"))
+    opening_book.record_game(finished_game("aborted", "7g7f", None, "aborted"))
+    assert opening_book.compile() == 1
+    assert opening_book.choose(shogi.Board()) is None
+    opening_book.record_game(finished_game("won again", "7g7f 3c3d 2g2f", "sente"))
+    # another game process compiles the games it hasn't seen yet
+    other_book = OpeningBook({"path": path})
+    assert other_book.compile() == 1
+    other_book.close()
+    assert opening_book.compile() == 0
+    assert opening_book.connection.execute("SELECT key, games FROM book WHERE move = '7g7f'").fetchall() == [(board_key(shogi.Board()), 2)]
+    assert opening_book.choose(shogi.Board()) == "7g7f"
+    opening_book.close()
+
+
+def test_opening_book_chooses_moves_that_scored_well(tmp_path):
+    path = str(tmp_path / "book.sqlite")
+    opening_book = OpeningBook({"path": path, "min_games": 2, "min_score": 0.5})
+    for game_id, moves, winner in [("a", "7g7f 3c3d 2g2f", "sente"), ("b", "7g7f 3c3d 2g2f", None),
+                                   ("c", "2g2f 8c8d", "gote"), ("d", "2g2f 8c8d", "gote"), ("e", "5g5f", "sente")]:
+        opening_book.record_game(finished_game(game_id, moves, winner))
+    opening_book.compile()
+    # 2g2f lost both games and 5g5f was played only once
+    assert {opening_book.choose(shogi.Board()) for _ in range(20)} == {"7g7f"}
+    board = shogi.Board()
+    for move in ["7g7f", "3c3d"]:
+        board.push_usi(move)
+    assert opening_book.choose(board) == "2g2f"
+    opening_book.close()
+    # past max_plies the bot searches
+    opening_book = OpeningBook({"path": path, "max_plies": 2, "min_games": 2, "min_score": 0.5})
+    assert opening_book.choose(board) is None
+    opening_book.close()
+
+
+def test_info_channel_throttles_snapshots():
+    channel = InfoChannel(rate=10)
+    channel.begin()
+    channel.offer({"depth": 1, "score": {"cp": 20}, "pv": "7g7f 3c3d", "time": 1})
+    assert channel.snapshot.depth == 1
+    channel.offer({"depth": 2, "score": {"cp": 30}, "pv": "2g2f", "time": 2})
+    # within 1 / rate seconds of the last one
+    assert channel.snapshot.depth == 1
+    time.sleep(0.15)
+    channel.offer({"depth": 2, "score": {"cp": 40}, "pv": "2g2f 8c8d", "time": 3})
+    assert channel.snapshot.as_info() == {"depth": 2, "score": {"cp": 40}, "time": 3, "pv": "2g2f 8c8d"}
+    with pytest.raises(TypeError):
+        channel.snapshot.score["cp"] = 0
+
+
+def test_info_channel_keeps_last_info_of_each_depth():
+    channel = InfoChannel(rate=10)
+    channel.begin()
+    channel.offer({"depth": 1, "seldepth": 2, "score": {"cp": 20}, "pv": "7g7f 3c3d", "time": 1, "nodes": 10})
+    channel.offer({"depth": 2, "seldepth": 3, "score": {"cp": 30}, "pv": "2g2f", "time": 2, "nodes": 50})
+    channel.offer({"depth": 2, "seldepth": 4, "score": {"cp": -100}, "pv": "5g5f", "multipv": 2})
+    channel.offer({"depth": 2, "seldepth": 4, "score": {"cp": 35}, "pv": "2g2f 8c8d", "time": 3, "nodes": 80})
+    # the history is only replaced when the search ends
+    assert channel.history == ()
+    final = {"depth": 3, "seldepth": 5, "score": {"mate": 3}, "pv": "G*5b", "time": 4, "nodes": 120}
+    channel.offer(final)
+    channel.end(final)
+    assert channel.history == ((1, 2, 1, 10, 20, "7g7f"), (2, 4, 3, 80, 35, "2g2f"), (3, 5, 4, 120, MATE_SCORE - 3, "G*5b"))
+    assert channel.snapshot.depth == 3
+    channel.begin()
+    assert len(channel.history) == 3
+
+
+def test_game_log_keeps_messages_as_logged(tmp_path):
+    root = logging.getLogger()
+    root_level = root.level
+    game_log = GameLog(10, str(tmp_path))
+    game_log.attach(logging.INFO, ["tests.game"])
+    try:
+        state = {"moves": "7g7f"}
+        logging.getLogger("tests.game").debug("Game state: %s", state)
+        logging.getLogger("tests.other").debug("Not a game record")
+        state["moves"] = "7g7f 3c3d"
+        with open(game_log.dump("game", "flagged")) as file:
+            lines = file.read().splitlines()
+    finally:
+        root.removeHandler(game_log)
+        logging.getLogger("tests.game").setLevel(logging.NOTSET)
+    assert root.level == root_level
+    assert len(lines) == 1 and lines[0].endswith("Game state: {'moves': '7g7f'}")
+
+
+def test_timer_service_runs_callbacks_in_deadline_order():
+    timers = TimerService()
+    fired = []
+    done = threading.Event()
+    now = time.time()
+    timers.schedule("late", now + 0.2, lambda: (fired.append("late"), done.set()))
+    timers.schedule("early", now + 0.05, lambda: fired.append("early"))
+    timers.schedule("cancelled", now + 0.1, lambda: fired.append("cancelled"))
+    timers.cancel("cancelled")
+    # Scheduling a key again replaces its deadline and callback
+    timers.schedule("moved", now + 0.05, lambda: fired.append("moved too early"))
+    timers.schedule("moved", now + 0.1, lambda: fired.append("moved"))
+    assert done.wait(5)
+    assert fired == ["early", "moved", "late"]
+
+
+def test_shutdown_stream_ends_blocked_read():
+    class SilentStream(http.server.BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_GET(self):
+            self.send_response(200)
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            self.wfile.write(b"3\r\n{}\n\r\n")
+            self.wfile.flush()
+            time.sleep(10)
+
+        def log_message(self, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), SilentStream)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        response = requests.get(f"http://127.0.0.1:{server.server_address[1]}/", stream=True, timeout=(5, 10))
+        lines = response.iter_lines()
+        assert next(lines) == b"{}"
+        threading.Timer(0.2, lishogi.shutdown_stream, [response]).start()
+        started = time.monotonic()
+        with pytest.raises((requests.exceptions.ChunkedEncodingError, requests.exceptions.ConnectionError, StopIteration)):
+            next(lines)
+        assert time.monotonic() - started < 5
+        response.close()
+    finally:
+        server.shutdown()
+
+
+def test_timer_service_survives_failing_callback():
+    timers = TimerService()
+    done = threading.Event()
+    timers.schedule("fails", time.time(), lambda: 1 / 0)
+    timers.schedule("runs", time.time() + 0.05, done.set)
+    assert done.wait(5)
+
+
 def run_bot(CONFIG, logging_level):
     lishogi_bot.logger.info(lishogi_bot.intro())
     li = lishogi_bot.lishogi.Lishogi(CONFIG["token"], CONFIG["url"], lishogi_bot.__version__, logging_level)
@@ -0,0 +1,142 @@
+import time
+import logging
+from startup import lazy_import
+
+shogi = lazy_import("shogi")
+
+logger = logging.getLogger(__name__)
+
+
+class TimeBudget:
+    """
+    Time to spend on a single move.
+    The search is sent as "go movetime <hard>" and stopped after <soft>
+    milliseconds once the best move stops changing between depths.
+    """
+    def __init__(self, soft, hard, stable_depths=4, last_score=None):
+        self.hard = max(1, int(hard))
+        self.soft = min(self.hard, max(1, int(soft)))
+        self.stable_depths = stable_depths
+        self.last_score = last_score
+        self.started = time.perf_counter()
+        self.best_moves = []
+        self.depth = 0
+        self.score = None
+
+    def is_fixed(self):
+        return self.soft >= self.hard
+
+    def elapsed(self):
+        return int((time.perf_counter() - self.started) * 1000)
+
+    def should_stop(self, info):
+        depth = info.get("depth")
+        pv = info.get("pv")
+        if depth is None or not pv or info.get("multipv", 1) != 1:
+            return False
+        if depth != self.depth:
+            self.depth = depth
+            self.best_moves.append(pv.split()[0])
+        elif self.best_moves:
+            self.best_moves[-1] = pv.split()[0]
+        self.score = score_to_cp(info.get("score"))
+
+        elapsed = self.elapsed()
+        if elapsed < self.soft:
+            return False
+        # Give a falling score more time to find a way out
+        if self.last_score is not None and self.score is not None and self.score < self.last_score - 50 and elapsed < min(self.hard, self.soft * 2):
+            return False
+        recent = self.best_moves[-self.stable_depths:]
+        return len(recent) == self.stable_depths and len(set(recent)) == 1
+
+    def __str__(self):
+        return f"soft {self.soft} hard {self.hard}"
+
+
+class TimeManager:
+    def __init__(self, config, move_overhead, correspondence_move_time):
+        self.first_move_time = config.get("first_move_time", 1000)
+        self.correspondence_move_time = correspondence_move_time
+        self.expected_plies = config.get("expected_plies", 140)
+        self.min_moves_to_go = config.get("min_moves_to_go", 15)
+        self.min_overhead = config.get("min_overhead", 300)
+        self.stable_depths = config.get("stable_depths", 4)
+        self.overhead = max(self.min_overhead, move_overhead)
+        self.last_score = None
+        self.pending = None
+
+    def plan(self, game, board, start_time):
+        ply = len(board.move_stack)
+        if ply < 2:
+            # Lishogi aborts games whose first move takes longer than 30 seconds
+            return TimeBudget(self.first_move_time, self.first_move_time)
+
+        if game.perf_name == "Correspondence":
+            move_time = self.correspondence_move_time
+            return TimeBudget(move_time / 4, move_time, self.stable_depths, self.last_score)
+
+        bw = "b" if board.turn == shogi.BLACK else "w"
+        remaining = game.state.time(bw)
+        increment = game.state.inc(bw)
+        byoyomi = game.state.byo
+        self.measure_overhead(remaining, increment)
+
+        remaining = max(0, remaining - int((time.perf_counter_ns() - start_time) / 1000000))
+        usable = max(0, remaining - self.overhead)
+        # Byoyomi is lost when it is not used, so always spend it
+        byoyomi_time = max(0, byoyomi - self.overhead)
+
+        moves_to_go = max(self.min_moves_to_go, (self.expected_plies - ply) // 2)
+        optimum = (usable / moves_to_go + increment * 0.8) * phase_factor(ply)
+        optimum = min(optimum, usable * 0.5)
+
+        soft = byoyomi_time + optimum * 0.6
+        hard = byoyomi_time + min(optimum * 3, usable * 0.25)
+        if increment and not byoyomi:
+            hard = max(hard, min(increment - self.overhead, usable))
+        budget = TimeBudget(max(soft, 50), max(hard, 50), self.stable_depths, self.last_score)
+        logger.info(f"Time budget {budget} (remaining: {remaining}, increment: {increment}, byoyomi: {byoyomi}, overhead: {self.overhead})")
+        return budget
+
+    def record_move(self, game, board, start_time, info=None):
+        bw = "b" if board.turn == shogi.BLACK else "w"
+        think_time = int((time.perf_counter_ns() - start_time) / 1000000)
+        self.pending = (game.state.time(bw), think_time)
+        if info:
+            score = score_to_cp(info.get("score"))
+            if score is not None:
+                self.last_score = score
+
+    def skip_move(self):
+        self.pending = None
+
+    def measure_overhead(self, remaining, increment):
+        if self.pending is None:
+            return
+        remaining_before, think_time = self.pending
+        self.pending = None
+        # In byoyomi the main clock stays at 0, so nothing can be measured
+        if remaining_before <= 0 or remaining <= 0:
+            return
+        lag = remaining_before - remaining + increment - think_time
+        self.overhead = max(self.min_overhead, int(self.overhead * 0.7 + lag * 0.3))
+
+
+def phase_factor(ply):
+    # Spend less time in the opening and most of it in the middlegame
+    if ply < 20:
+        return 0.7
+    if ply < 80:
+        return 1.2
+    return 1.0
+
+
+def score_to_cp(score):
+    if not score:
+        return None
+    if "cp" in score:
+        return score["cp"]
+    if "mate" in score:
+        return 100000 if score["mate"] > 0 else -100000
+    return None
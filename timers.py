@@ -0,0 +1,60 @@
+import time
+import heapq
+import logging
+import itertools
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+class TimerService:
+    """
+    Runs callbacks at their deadlines (in time.time() seconds) on one background thread.
+    Scheduling a key again replaces its previous deadline.
+    """
+    def __init__(self):
+        self.heap = []
+        self.timers = {}
+        self.counter = itertools.count()
+        self.condition = threading.Condition()
+        self.thread = None
+
+    def schedule(self, key, deadline, callback):
+        with self.condition:
+            self.cancel_locked(key)
+            entry = [deadline, next(self.counter), key, callback, True]
+            self.timers[key] = entry
+            heapq.heappush(self.heap, entry)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+            self.condition.notify()
+
+    def cancel(self, key):
+        with self.condition:
+            self.cancel_locked(key)
+
+    def cancel_locked(self, key):
+        entry = self.timers.pop(key, None)
+        if entry is not None:
+            entry[4] = False
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.heap or not self.heap[0][4] or self.heap[0][0] > time.time():
+                    if self.heap and not self.heap[0][4]:
+                        heapq.heappop(self.heap)
+                    elif self.heap:
+                        self.condition.wait(self.heap[0][0] - time.time())
+                    else:
+                        self.condition.wait()
+                deadline, _, key, callback, _ = heapq.heappop(self.heap)
+                del self.timers[key]
+            try:
+                callback()
+            except Exception:
+                logger.exception(f"Timer {key} failed")
+
+
+timer_service = TimerService()
@@ -0,0 +1,226 @@
+"""
+Finds forced mates (tsume) with depth-first proof-number search (df-pn) over position.Position.
+"""
+
+import time
+import random
+import logging
+
+from position import ON_LINE, STEPS, KNIGHT, WHITE, Position, usi
+
+logger = logging.getLogger(__name__)
+
+INFINITE = 1 << 30
+
+_random = random.Random(20230712)
+ATTACKER_KEYS = [_random.getrandbits(64), _random.getrandbits(64)]
+
+# Squares a check to the king on each square can come from: on a line through it or a knight's jump away
+CHECK_SQUARES = [[ON_LINE[king][square] or square in STEPS[color ^ 1][KNIGHT][king] for square in range(81)] for color in (0, WHITE) for king in range(81)]
+
+
+class SolverStopped(Exception):
+    pass
+
+
+class MateSolver:
+    """
+    Proves or disproves that the side to move can mate with checks only.
+    Proof and disproof numbers are kept in a table of at most `size` positions that is
+    shared between calls, so a position worked on during the opponent's turn is solved
+    at once when it is reached. Disproofs that only hold on the path they were found on
+    (by repetition or the ply limit) are dropped before each call. Not thread-safe: stop a search with its `stop_event`
+    before solving again from another thread.
+    """
+    def __init__(self, size=200000, max_plies=63):
+        self.size = size
+        self.max_plies = max_plies
+        self.table = {}
+        self.path = set()
+        self.path_disproofs = set()
+        self.salt = 0
+        self.nodes = 0
+        self.deadline = None
+        self.max_nodes = None
+        self.stop_event = None
+
+    def solve(self, board, time_limit=None, max_nodes=None, stop_event=None):
+        """
+        Returns the moves (USI) of a forced mate by the side to move of `board`, a shogi.Board
+        or an SFEN, or None if none is found within `time_limit` milliseconds and `max_nodes`
+        nodes or before `stop_event` (a threading.Event) is set. Only the first move is sure
+        to start a mate if the table overflowed.
+        """
+        position = Position(board if isinstance(board, str) else board.sfen())
+        self.salt = ATTACKER_KEYS[position.turn]
+        self.path = set()
+        for key in self.path_disproofs:
+            self.table.pop(key, None)
+        self.path_disproofs = set()
+        self.nodes = 0
+        self.deadline = None if time_limit is None else time.monotonic() + time_limit / 1000
+        self.max_nodes = max_nodes
+        self.stop_event = stop_event
+        try:
+            self.mid(position, True, INFINITE, INFINITE, 0)
+        except SolverStopped:
+            return None
+        if self.table.get(position.key ^ self.salt, (1, 1))[0] != 0:
+            return None
+        return self.mate_moves(position)
+
+    def check_limits(self):
+        if (self.stop_event is not None and self.stop_event.is_set()) or (self.deadline is not None and time.monotonic() >= self.deadline) \
+                or (self.max_nodes is not None and self.nodes >= self.max_nodes):
+            raise SolverStopped()
+
+    def store(self, key, numbers):
+        if len(self.table) >= self.size:
+            # Solved positions are worth keeping, the others are quickly searched again
+            solved = {key: value for key, value in self.table.items() if value[0] == 0 or value[1] == 0}
+            self.table = solved if len(solved) < self.size // 2 else {}
+        self.table[key] = numbers
+
+    def children(self, position, attacking):
+        """The checks of the attacker or the legal moves of the defender, with the keys of the positions they lead to."""
+        moves = []
+        keys = []
+        king = position.kings[position.turn ^ 1]
+        if attacking and king is None:
+            return moves, keys
+        check_squares = CHECK_SQUARES[position.turn * 81 + king] if attacking else None
+        for move in position.legal_moves():
+            # A check moves to a square that attacks the king, or moves away from a line through it
+            if attacking and not check_squares[move >> 7 & 127] and not (move & 127 and ON_LINE[king][(move & 127) - 1]):
+                continue
+            position.push(move)
+            if not attacking or position.is_check():
+                key = position.key ^ self.salt
+                moves.append(move)
+                keys.append(key)
+                # Mates in one are found before searching any deeper
+                if attacking and key not in self.table and not position.has_legal_move():
+                    self.store(key, (0, INFINITE))
+            position.pop()
+        return moves, keys
+
+    def mid(self, position, attacking, proof_threshold, disproof_threshold, ply):
+        """
+        Searches `position` until its proof number reaches `proof_threshold` or its disproof
+        number `disproof_threshold`. Both are counted for the attacker, in every position.
+        """
+        self.nodes += 1
+        if self.nodes & 255 == 0:
+            self.check_limits()
+        key = position.key ^ self.salt
+        table = self.table
+
+        if ply >= self.max_plies:
+            self.store(key, (INFINITE, 0))
+            self.path_disproofs.add(key)
+            return
+        moves, keys = self.children(position, attacking)
+        if not moves:
+            # No check to give, or checkmate
+            self.store(key, (INFINITE, 0) if attacking else (0, INFINITE))
+            return
+
+        path = self.path
+        path_disproofs = self.path_disproofs
+        path.add(key)
+        while True:
+            best = 0
+            best_proof, best_disproof = INFINITE, INFINITE
+            second = INFINITE
+            proof_sum = disproof_sum = 0
+            on_path = False
+            for index, child_key in enumerate(keys):
+                # Repeating a position is no way to mate
+                if child_key in path or child_key in path_disproofs:
+                    on_path = True
+                proof, disproof = (INFINITE, 0) if child_key in path else table.get(child_key, (1, 1))
+                proof_sum += proof
+                disproof_sum += disproof
+                value = proof if attacking else disproof
+                if value < (best_proof if attacking else best_disproof):
+                    second = best_proof if attacking else best_disproof
+                    best = index
+                    best_proof, best_disproof = proof, disproof
+                elif value < second:
+                    second = value
+            if attacking:
+                proof, disproof = best_proof, min(disproof_sum, INFINITE)
+            else:
+                proof, disproof = min(proof_sum, INFINITE), best_disproof
+            if proof >= proof_threshold or disproof >= disproof_threshold:
+                break
+            if attacking:
+                child_proof_threshold = min(proof_threshold, second + 1)
+                child_disproof_threshold = min(INFINITE, disproof_threshold - disproof + best_disproof)
+            else:
+                child_proof_threshold = min(INFINITE, proof_threshold - proof + best_proof)
+                child_disproof_threshold = min(disproof_threshold, second + 1)
+            position.push(moves[best])
+            try:
+                self.mid(position, not attacking, child_proof_threshold, child_disproof_threshold, ply + 1)
+            finally:
+                position.pop()
+        path.discard(key)
+        self.store(key, (proof, disproof))
+        if disproof == 0 and on_path:
+            path_disproofs.add(key)
+        else:
+            path_disproofs.discard(key)
+
+    def mate_moves(self, position):
+        """
+        The moves of a proven mate, following proven positions in the table. The attacker
+        takes the shortest mate and the defender the longest defence among them.
+        """
+        lengths = {}
+        moves = []
+        attacking = True
+        while len(moves) <= self.max_plies:
+            candidates, keys = self.children(position, attacking)
+            proven = [index for index, key in enumerate(keys) if self.table.get(key, (1, 1))[0] == 0]
+            if not proven:
+                break
+            distances = {}
+            for index in proven:
+                position.push(candidates[index])
+                distances[index] = self.mate_length(position, not attacking, lengths, len(moves) + 1)
+                position.pop()
+            index = min(proven, key=distances.get) if attacking else max(proven, key=distances.get)
+            position.push(candidates[index])
+            moves.append(candidates[index])
+            attacking = not attacking
+        for _ in moves:
+            position.pop()
+        return [usi(move) for move in moves]
+
+    def mate_length(self, position, attacking, lengths, ply):
+        """Plies to mate from a proven position, INFINITE where the table doesn't hold the whole proof."""
+        key = position.key ^ self.salt
+        if key in lengths:
+            return lengths[key]
+        lengths[key] = INFINITE
+        candidates, keys = self.children(position, attacking)
+        if not candidates:
+            length = INFINITE if attacking else 0
+        elif ply >= self.max_plies:
+            length = INFINITE
+        else:
+            length = INFINITE if attacking else 0
+            for move, child_key in zip(candidates, keys):
+                if self.table.get(child_key, (1, 1))[0] != 0:
+                    if attacking:
+                        continue
+                    length = INFINITE
+                    break
+                position.push(move)
+                child_length = self.mate_length(position, not attacking, lengths, ply + 1)
+                position.pop()
+                length = min(length, child_length + 1) if attacking else max(length, child_length + 1)
+            length = min(length, INFINITE)
+        lengths[key] = length
+        return length